@@ -0,0 +1,413 @@
+"""
+Асинхронная обёртка над db.py.
+
+Синхронные функции db.* выполняются вне event loop:
+- все записи идут через один поток-писатель (SQLite всё равно допускает одного писателя,
+  а так commit'ы не толкаются между собой и не блокируют loop);
+- чтения — через небольшой пул потоков, у каждого потока своё соединение.
+"""
+import asyncio
+import functools
+import time
+from collections import Counter
+from contextvars import ContextVar
+from concurrent.futures import ThreadPoolExecutor
+
+import db
+import metrics
+from config import DB_READ_THREADS, GROUP_COMMIT_MAX_ROWS, GROUP_COMMIT_MS
+
+_writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db-write")
+_readers = ThreadPoolExecutor(max_workers=DB_READ_THREADS, thread_name_prefix="db-read")
+# аренда продлевается в своём потоке (и соединении): за очередью записей
+# к писателю продление опоздало бы и живой лидер потерял бы аренду
+_lease_thread = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db-lease")
+
+
+# число обращений к БД по функциям db.* (для бенчмарков и метрик)
+op_counts: Counter = Counter()
+
+
+# время в БД текущего апдейта: bench/replay.py кладёт сюда [0.0] перед feed_update,
+# а обращения к БД из этого же контекста прибавляют к нему свою длительность
+db_time: ContextVar[list[float] | None] = ContextVar("db_time", default=None)
+
+
+def _spent(started: float) -> float:
+    elapsed = time.perf_counter() - started
+    acc = db_time.get()
+    if acc is not None:
+        acc[0] += elapsed
+    return elapsed
+
+
+async def _run(executor: ThreadPoolExecutor, fn, *args, **kwargs):
+    op_counts[fn.__name__] += 1
+    loop = asyncio.get_running_loop()
+    # время вместе с ожиданием своей очереди в пуле — именно его видит хендлер
+    started = time.perf_counter()
+    try:
+        return await loop.run_in_executor(executor, functools.partial(fn, *args, **kwargs))
+    finally:
+        metrics.observe("bot_db_call_seconds", _spent(started), fn=fn.__name__)
+
+
+# вызовов, ждущих поток-писатель (вместе с выполняемым), — сигнал перегрузки для throttle.py
+_write_depth = 0
+
+# выставляет throttle.py: пока True, необязательные записи (активность, фоновое обслуживание) откладываются
+overloaded = False
+
+
+async def _write(fn, *args, **kwargs):
+    global _write_depth
+    _write_depth += 1
+    try:
+        return await _run(_writer, fn, *args, **kwargs)
+    finally:
+        _write_depth -= 1
+
+
+def write_queue_depth() -> int:
+    # ответы в очереди group commit тоже ждут писателя
+    return _write_depth + (_answers.qsize() if _answers is not None else 0)
+
+
+async def _read(fn, *args, **kwargs):
+    return await _run(_readers, fn, *args, **kwargs)
+
+
+def shutdown():
+    # дожидаемся хвоста записей и закрываем соединения всех потоков
+    # (буфер активности и очередь ответов нужно сбросить до этого:
+    # await flush_activity(), await stop_answers())
+    _writer.shutdown(wait=True)
+    _readers.shutdown(wait=True)
+    _lease_thread.shutdown(wait=True)
+    db.close_all()
+
+
+# ---------- users ----------
+
+async def upsert_user(user_id: int, notify_time: str | None, timezone_group: str | None, is_active: int):
+    await _write(db.upsert_user, user_id, notify_time, timezone_group, is_active)
+
+
+async def get_user(user_id: int):
+    # попадание в кэш не требует похода в поток
+    u = db.cached_user(user_id)
+    if u is None:
+        u = await _read(db.get_user, user_id)
+    # ещё не сброшенная активность новее того, что лежит в БД
+    ts = _activity.get(user_id)
+    if u is not None and ts is not None:
+        u["last_activity_at"] = ts
+        u["updated_at"] = ts
+    return u
+
+
+async def set_active(user_id: int, is_active: int):
+    await _write(db.set_active, user_id, is_active)
+
+
+async def update_timezone_group(user_id: int, timezone_group: str):
+    await _write(db.update_timezone_group, user_id, timezone_group)
+
+
+async def update_notify_time(user_id: int, notify_time: str):
+    await _write(db.update_notify_time, user_id, notify_time)
+
+
+# ---------- activity (write-behind) ----------
+
+# user_id -> last_activity_at; повторные касания одного пользователя схлопываются,
+# в БД всё уходит одной транзакцией в flush_activity (по интервалу и при остановке)
+_activity: dict[int, str] = {}
+
+
+async def touch_activity(user_id: int):
+    _activity[user_id] = db.now_utc_iso()
+
+
+async def flush_activity(force: bool = True) -> int:
+    # плановый сброс (force=False) при перегрузке пропускаем: касания копятся в памяти
+    # и уйдут следующим сбросом; перед выборкой неактивных и при остановке — сбрасываем всегда
+    global _activity
+    if not _activity or (overloaded and not force):
+        return 0
+    batch, _activity = _activity, {}
+    try:
+        await _write(db.touch_activity_many, list(batch.items()))
+    except Exception:
+        # вернём в буфер, не затирая более свежие касания
+        for user_id, ts in batch.items():
+            _activity.setdefault(user_id, ts)
+        raise
+    return len(batch)
+
+
+async def set_skip_date(user_id: int, skip_date: str):
+    await _write(db.set_skip_date, user_id, skip_date)
+
+
+async def clear_skip_date(user_id: int):
+    await _write(db.clear_skip_date, user_id)
+
+
+async def backfill_timezone_groups(default_group: str) -> int:
+    return await _write(db.backfill_timezone_groups, default_group)
+
+
+async def get_slot_sizes() -> dict[tuple[str, str], int]:
+    return await _read(db.get_slot_sizes)
+
+
+async def iter_slot_users(hhmm: str, tz_group: str, chunk_size: int):
+    """Активные пользователи слота кусками по chunk_size."""
+    after = 0
+    while True:
+        rows = await _read(db.get_slot_users_page, hhmm, tz_group, after, chunk_size)
+        if not rows:
+            return
+        yield rows
+        if len(rows) < chunk_size:
+            return
+        after = rows[-1]
+
+
+async def iter_users_for_nudge(activity_before: str, nudge_before: str, chunk_size: int):
+    """Кандидаты на пинг кусками по chunk_size; каждый кусок — отдельный короткий запрос."""
+    after = None
+    while True:
+        rows = await _read(db.get_users_for_nudge_page, activity_before, nudge_before, after, chunk_size)
+        if not rows:
+            return
+        yield [r["user_id"] for r in rows]
+        if len(rows) < chunk_size:
+            return
+        after = (rows[-1]["last_activity_at"], rows[-1]["user_id"])
+
+
+async def save_nudge_sent_many(user_ids: list[int]):
+    if user_ids:
+        await _write(db.save_nudge_sent_many, user_ids)
+
+
+# ---------- answers ----------
+
+# Group commit: ответы от параллельных хендлеров копятся в очереди и пишутся
+# одной транзакцией. Пока идёт commit, набирается следующая пачка; плюс
+# коммиттер ждёт ещё до GROUP_COMMIT_MS, если пачка не набрала GROUP_COMMIT_MAX_ROWS.
+# save_answer возвращается только после commit'а своей пачки.
+_answers: asyncio.Queue | None = None
+_committer: asyncio.Task | None = None
+
+metrics.describe("bot_answer_batch_rows", "Rows per group commit of answers", buckets=(1, 2, 4, 8, 16, 32, 64, 128, 256, 512))
+metrics.describe("bot_answer_commit_seconds", "Group commit latency of answers")
+
+
+async def save_answer(user_id: int, session_date: str, q_index: int, question: str, answer: str,
+                      question_set: str = db.DEFAULT_QUESTION_SET, completes: bool = False):
+    # completes=True — последний шаг набора: статистика дня обновится в той же транзакции
+    global _answers, _committer
+    if _committer is None:
+        _answers = asyncio.Queue()
+        _committer = asyncio.create_task(_commit_answers())
+    fut = asyncio.get_running_loop().create_future()
+    row = (user_id, session_date, q_index, question, answer, db.now_utc_iso(), question_set, completes)
+    _answers.put_nowait((row, fut))
+    started = time.perf_counter()
+    try:
+        await fut
+    finally:
+        _spent(started)
+
+
+async def _commit_answers():
+    # задачу создал чей-то save_answer: его счётчик времени в БД сюда не относится
+    db_time.set(None)
+    loop = asyncio.get_running_loop()
+    while True:
+        batch = [await _answers.get()]
+        deadline = loop.time() + GROUP_COMMIT_MS / 1000
+        while len(batch) < GROUP_COMMIT_MAX_ROWS:
+            if not _answers.empty():
+                batch.append(_answers.get_nowait())
+                continue
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(_answers.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+
+        started = loop.time()
+        try:
+            await _write(db.save_answers_many, [row for row, _ in batch])
+        except Exception as e:
+            for _, fut in batch:
+                if not fut.done():
+                    fut.set_exception(e)
+        else:
+            for _, fut in batch:
+                if not fut.done():
+                    fut.set_result(None)
+        metrics.observe("bot_answer_batch_rows", len(batch))
+        metrics.observe("bot_answer_commit_seconds", loop.time() - started)
+        for _ in batch:
+            _answers.task_done()
+
+
+async def flush_answers():
+    # дождаться, пока всё принятое закоммичено
+    if _answers is not None:
+        await _answers.join()
+
+
+async def stop_answers():
+    # при остановке, до shutdown(): дописать принятое и остановить коммиттер,
+    # иначе его задача висит на пустой очереди, пока loop не снимет её с предупреждением
+    global _answers, _committer
+    await flush_answers()
+    if _committer is not None:
+        _committer.cancel()
+        try:
+            await _committer
+        except asyncio.CancelledError:
+            pass
+        _answers = _committer = None
+
+
+async def iter_answers(user_id: int, chunk_size: int = 500):
+    """Вся история пользователя (архив + свежие ответы) кусками по chunk_size."""
+    after = None
+    while True:
+        rows = await _read(db.get_answers_page, user_id, after, chunk_size)
+        if not rows:
+            return
+        yield rows
+        if len(rows) < chunk_size:
+            return
+        last = rows[-1]
+        after = (last["session_date"], last["q_index"], last["id"])
+
+
+async def get_answers_page(user_id: int, after: tuple[str, int, int] | None, limit: int, desc: bool = False) -> list[dict]:
+    return await _read(db.get_answers_page, user_id, after, limit, desc)
+
+
+async def normalize_answers_chunk(limit: int) -> int:
+    return await _write(db.normalize_answers_chunk, limit)
+
+
+async def get_months_to_archive(before_month: str, from_user_id: int, limit: int) -> list[tuple[int, str]]:
+    return await _read(db.get_months_to_archive, before_month, from_user_id, limit)
+
+
+async def archive_user_month(user_id: int, month: str) -> int:
+    return await _write(db.archive_user_month, user_id, month)
+
+
+# ---------- search ----------
+
+async def search_answers(user_id: int, query: str, limit: int, offset: int = 0) -> list[dict]:
+    return await _read(db.search_answers, user_id, query, limit, offset)
+
+
+async def search_backfill_chunk(limit: int) -> int:
+    return await _write(db.search_backfill_chunk, limit)
+
+
+# ---------- stats ----------
+
+async def record_skipped(user_id: int, day: str):
+    await _write(db.record_day, user_id, day, False)
+
+
+async def get_user_stats(user_id: int) -> dict | None:
+    return await _read(db.get_user_stats, user_id)
+
+
+async def iter_digest(tz_group: str, week_start: str, chunk_size: int):
+    """Строки user_stats для недельной сводки кусками по chunk_size."""
+    after = 0
+    while True:
+        rows = await _read(db.get_digest_page, tz_group, week_start, after, chunk_size)
+        if not rows:
+            return
+        yield rows
+        if len(rows) < chunk_size:
+            return
+        after = rows[-1]["user_id"]
+
+
+# ---------- replicas ----------
+
+async def acquire_lease(name: str, holder: str, ttl: float) -> tuple[bool, bool]:
+    return await _run(_lease_thread, db.acquire_lease, name, holder, ttl)
+
+
+async def release_lease(name: str, holder: str):
+    await _run(_lease_thread, db.release_lease, name, holder)
+
+
+async def claim_deliveries(user_ids: list[int], local_date: str, kind: str) -> list[int]:
+    return await _write(db.claim_deliveries, user_ids, local_date, kind)
+
+
+async def release_deliveries(user_ids: list[int], local_date: str, kind: str):
+    if user_ids:
+        await _write(db.release_deliveries, user_ids, local_date, kind)
+
+
+async def prune_deliveries(before_date: str) -> int:
+    return await _write(db.prune_deliveries, before_date)
+
+
+async def meta_get(key: str) -> str | None:
+    return await _read(db.meta_get, key)
+
+
+# ---------- broadcasts ----------
+
+async def create_broadcast(text: str, created_by: int | None = None) -> int:
+    return await _write(db.create_broadcast, text, created_by)
+
+
+async def get_broadcast(broadcast_id: int) -> dict | None:
+    return await _read(db.get_broadcast, broadcast_id)
+
+
+async def list_broadcasts(limit: int = 20) -> list[dict]:
+    return await _read(db.list_broadcasts, limit)
+
+
+async def next_broadcast() -> dict | None:
+    return await _read(db.next_broadcast)
+
+
+async def get_broadcast_recipients(after_user_id: int, limit: int) -> list[int]:
+    return await _read(db.get_broadcast_recipients, after_user_id, limit)
+
+
+async def claim_broadcast(broadcast_id: int, user_ids: list[int]) -> list[int]:
+    return await _write(db.claim_broadcast, broadcast_id, user_ids)
+
+
+async def save_broadcast_batch(broadcast_id: int, cursor: int, outcomes: dict[int, str], released: list[int]):
+    await _write(db.save_broadcast_batch, broadcast_id, cursor, outcomes, released)
+
+
+async def finish_broadcast(broadcast_id: int, status: str = "done") -> bool:
+    return await _write(db.finish_broadcast, broadcast_id, status)
+
+
+# ---------- fsm ----------
+
+async def fsm_load(key: str):
+    return await _read(db.fsm_load, key)
+
+
+async def fsm_save_many(upserts: list[tuple[str, str | None, str, str]], deletes: list[tuple[str]]):
+    await _write(db.fsm_save_many, upserts, deletes)
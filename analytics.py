@@ -0,0 +1,411 @@
+"""
+Аналитика вовлечённости по answers и users — офлайн-задача рядом с живым ботом.
+
+    python analytics.py                      # дочитать новые ответы и обновить отчёты
+    python analytics.py --full               # пересчитать всё (вместе с answers_archive)
+    python analytics.py --out reports --chunk-size 5000 --pause-ms 5
+
+Один проход по answers в порядке id, кусками, через соединение только для
+чтения (mode=ro, query_only). Каждый кусок — отдельная короткая читающая
+транзакция с паузой после неё: в WAL писатель бота её не ждёт, а checkpoint
+не упирается в долгий снимок. В памяти — только счётчики по маленьким доменам
+(шаг набора, регион×время, корзины длины и задержки), сколько бы ни было ответов.
+
+Инкрементально: последний обработанный id и накопленные счётчики лежат
+в OUT/state.json, следующий запуск дочитывает только строки после него.
+
+Отчёты в OUT:
+- questions.csv — ответов на каждый шаг набора и доля от первого шага (отсев по шагам);
+- slots.csv     — ответов по региону и времени рассылки (по текущим настройкам пользователя);
+- delay.csv     — через сколько после рассылки пришёл ответ на первый вопрос: время отправки
+                  из журнала доставок, если он ещё хранит этот день, иначе плановое время слота
+                  (строки с битым временем или датой считаются отдельно, как invalid);
+- lengths.csv   — распределение длины ответов по шагам;
+- nudge.csv     — пинги «тихого правила»: сколько пользователей после последнего пинга
+                  вернулись и ответили. Первый ответ после пинга тоже копится в state.json
+                  (по пингованным пользователям) и дополняется новыми строками answers;
+                  заново по answers ищется только для тех, чей пинг сменился;
+- report.json   — всё вместе.
+
+С numpy (необязательная зависимость) корзины куска считаются векторно.
+"""
+import argparse
+import bisect
+import csv
+import json
+import logging
+import os
+import re
+import sqlite3
+import time
+import zlib
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache
+from zoneinfo import ZoneInfo
+
+from config import (
+    ANALYTICS_CHUNK_SIZE, ANALYTICS_DIR, ANALYTICS_PAUSE_MS, DB_BUSY_TIMEOUT_MS, DB_PATH, DEFAULT_TZ, TZ_GROUPS,
+)
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+log = logging.getLogger(__name__)
+
+# верхние границы корзин (последняя корзина — всё, что больше)
+LENGTH_BOUNDS = (10, 25, 50, 100, 200, 500, 1000, 2000)     # символов
+DELAY_BOUNDS = (5, 15, 30, 60, 120, 240, 480, 1440)         # минут
+NUDGE_WINDOWS = (1, 3, 7)                                   # дней
+
+# db.DEFAULT_QUESTION_SET: ответы, ещё не переведённые на questions.id
+_DEFAULT_SET = "default"
+
+# строка куска: id, q_index, session_date, created_at, длина ответа, набор, регион, время, sent_at, user_id
+_ANSWERS_SQL = """
+    SELECT a.id, a.q_index, a.session_date, a.created_at, length(a.answer),
+           COALESCE(qs.name, ?), u.timezone_group, u.notify_time, d.sent_at, a.user_id
+    FROM answers a
+    LEFT JOIN questions q ON q.id = a.question_id
+    LEFT JOIN question_sets qs ON qs.id = q.set_id
+    LEFT JOIN users u ON u.user_id = a.user_id
+    LEFT JOIN deliveries d ON a.q_index = 1 AND d.local_date = a.session_date
+                          AND d.kind = 'daily' AND d.user_id = a.user_id
+    WHERE a.id > ?
+    ORDER BY a.id
+    LIMIT ?
+"""
+
+
+def connect_ro(path: str = DB_PATH) -> sqlite3.Connection:
+    c = sqlite3.connect(f"file:{path}?mode=ro", uri=True, timeout=DB_BUSY_TIMEOUT_MS / 1000)
+    c.execute("PRAGMA query_only=1")
+    return c
+
+
+def bucket_labels(bounds: tuple) -> list[str]:
+    lows = (0,) + bounds
+    return [f"{lo}-{hi}" for lo, hi in zip(lows, bounds)] + [f"{bounds[-1]}+"]
+
+
+def bucketize(values: list[float], bounds: tuple) -> list[int]:
+    """Число значений в каждой корзине [bounds[i-1], bounds[i])."""
+    if np is not None:
+        idx = np.searchsorted(np.asarray(bounds, dtype=float), np.asarray(values, dtype=float), side="right")
+        return np.bincount(idx, minlength=len(bounds) + 1).tolist()
+    counts = [0] * (len(bounds) + 1)
+    for v in values:
+        counts[bisect.bisect_right(bounds, v)] += 1
+    return counts
+
+
+_HHMM = re.compile(r"\d{2}:\d{2}")
+
+
+@lru_cache(maxsize=4096)
+def slot_utc(session_date: str, notify_time: str, tz_group: str | None) -> datetime | None:
+    """Плановое время рассылки дня в UTC (naive, как created_at); None — время или дата битые."""
+    if not _HHMM.fullmatch(notify_time or ""):
+        return None
+    zone = ZoneInfo(TZ_GROUPS.get(tz_group, DEFAULT_TZ))
+    try:
+        local = datetime.fromisoformat(f"{session_date}T{notify_time}").replace(tzinfo=zone)
+    except (TypeError, ValueError):
+        return None
+    return local.astimezone(timezone.utc).replace(tzinfo=None)
+
+
+class Stats:
+    """Накопленные счётчики; складываются кусками и сохраняются между запусками."""
+
+    def __init__(self):
+        self.last_id = 0
+        self.rows = 0
+        self.steps: Counter = Counter()         # (набор, шаг) -> ответов
+        self.slots: Counter = Counter()         # (регион, время) -> ответов
+        self.delay = [0] * (len(DELAY_BOUNDS) + 1)
+        self.delay_early = 0                    # ответ раньше рассылки (начал сам)
+        self.delay_unknown = 0                  # время рассылки не выбрано
+        self.delay_invalid = 0                  # время рассылки, дата или created_at не разбираются
+        self.lengths: dict[int, list[int]] = {}  # шаг -> корзины длины
+        self.length_sum: Counter = Counter()    # шаг -> сумма длин
+        # пингованные: user_id -> [last_nudge_at, первый ответ после него или None]
+        self.nudged: dict[int, list] = {}
+
+    def add(self, rows: list[tuple]):
+        delays = []
+        by_step: dict[int, list[int]] = {}
+        for _id, q_index, session_date, created_at, length, qset, tz_group, notify_time, sent_at, user_id in rows:
+            self.steps[(qset, q_index)] += 1
+            self.slots[(tz_group or "", notify_time or "")] += 1
+            by_step.setdefault(q_index, []).append(length or 0)
+            nudge = self.nudged.get(user_id)
+            if nudge is not None and created_at > nudge[0] and (nudge[1] is None or created_at < nudge[1]):
+                nudge[1] = created_at
+            if q_index != 1:
+                continue
+            if sent_at is None and not notify_time:
+                self.delay_unknown += 1
+                continue
+            try:
+                sent = datetime.fromisoformat(sent_at) if sent_at else slot_utc(session_date, notify_time, tz_group)
+                answered = datetime.fromisoformat(created_at)
+            except (TypeError, ValueError):
+                sent = None
+            if sent is None:
+                self.delay_invalid += 1
+                continue
+            minutes = (answered - sent).total_seconds() / 60
+            if minutes < 0:
+                self.delay_early += 1
+            else:
+                delays.append(minutes)
+
+        for q_index, lengths in by_step.items():
+            counts = bucketize(lengths, LENGTH_BOUNDS)
+            acc = self.lengths.setdefault(q_index, [0] * len(counts))
+            self.lengths[q_index] = [a + b for a, b in zip(acc, counts)]
+            self.length_sum[q_index] += sum(lengths)
+        self.delay = [a + b for a, b in zip(self.delay, bucketize(delays, DELAY_BOUNDS))]
+        self.rows += len(rows)
+        self.last_id = max(self.last_id, max(r[0] for r in rows))
+
+    # ---------- state.json ----------
+
+    def to_json(self) -> dict:
+        return {
+            "last_id": self.last_id,
+            "rows": self.rows,
+            "steps": [[s, q, n] for (s, q), n in sorted(self.steps.items())],
+            "slots": [[g, t, n] for (g, t), n in sorted(self.slots.items())],
+            "delay": self.delay,
+            "delay_early": self.delay_early,
+            "delay_unknown": self.delay_unknown,
+            "delay_invalid": self.delay_invalid,
+            "lengths": {str(q): c for q, c in sorted(self.lengths.items())},
+            "length_sum": {str(q): n for q, n in sorted(self.length_sum.items())},
+            "nudged": {str(u): n for u, n in self.nudged.items()},
+        }
+
+    @classmethod
+    def from_json(cls, d: dict) -> "Stats":
+        s = cls()
+        s.last_id, s.rows = d["last_id"], d["rows"]
+        s.steps = Counter({(qs, q): n for qs, q, n in d["steps"]})
+        s.slots = Counter({(g, t): n for g, t, n in d["slots"]})
+        s.delay, s.delay_early, s.delay_unknown = d["delay"], d["delay_early"], d["delay_unknown"]
+        s.lengths = {int(q): c for q, c in d["lengths"].items()}
+        s.length_sum = Counter({int(q): n for q, n in d["length_sum"].items()})
+        # state.json старых версий этих полей не знает
+        s.delay_invalid = d.get("delay_invalid", 0)
+        s.nudged = {int(u): n for u, n in d.get("nudged", {}).items()}
+        return s
+
+
+# ---------- проход по ответам ----------
+
+def _pause(pause_ms: int):
+    if pause_ms:
+        time.sleep(pause_ms / 1000)
+
+
+def scan_answers(conn: sqlite3.Connection, stats: Stats, chunk_size: int, pause_ms: int) -> int:
+    total = 0
+    while True:
+        rows = conn.execute(_ANSWERS_SQL, (_DEFAULT_SET, stats.last_id, chunk_size)).fetchall()
+        if not rows:
+            return total
+        stats.add(rows)
+        total += len(rows)
+        _pause(pause_ms)
+
+
+def scan_archive(conn: sqlite3.Connection, stats: Stats, chunk_size: int, pause_ms: int) -> int:
+    """Ответы из answers_archive (только для --full)."""
+    sets = dict(conn.execute(
+        "SELECT q.id, qs.name FROM questions q JOIN question_sets qs ON qs.id = q.set_id"
+    ).fetchall())
+    total = 0
+    after = (0, "")
+    last_id = stats.last_id
+    while True:
+        groups = conn.execute(
+            """
+            SELECT ar.user_id, ar.month, ar.data, u.timezone_group, u.notify_time
+            FROM answers_archive ar LEFT JOIN users u ON u.user_id = ar.user_id
+            WHERE (ar.user_id, ar.month) > (?, ?)
+            ORDER BY ar.user_id, ar.month
+            LIMIT ?
+            """,
+            (*after, max(1, chunk_size // 100)),
+        ).fetchall()
+        if not groups:
+            break
+        rows = []
+        for user_id, month, data, tz_group, notify_time in groups:
+            # формат строки архива — db._pack: [id, session_date, q_index, question_id, question, answer, created_at]
+            for id_, session_date, q_index, question_id, _question, answer, created_at in json.loads(zlib.decompress(data)):
+                rows.append((id_, q_index, session_date, created_at, len(answer or ""),
+                             sets.get(question_id, _DEFAULT_SET), tz_group, notify_time, None, user_id))
+        stats.add(rows)
+        total += len(rows)
+        after = (groups[-1][0], groups[-1][1])
+        _pause(pause_ms)
+    # метка — только по живым ответам: строки архива из answers уже удалены,
+    # так что дальше answers читается с прежней метки, без пропусков и повторов
+    stats.last_id = last_id
+    return total
+
+
+def nudges(conn: sqlite3.Connection, stats: Stats, chunk_size: int, pause_ms: int) -> dict:
+    """
+    Пользователи с пингом: вернулись ли и ответили ли после последнего пинга.
+    Вызывается после scan_answers: первый ответ после уже известного пинга тот
+    дополнил из новых строк, здесь по answers ищем только для сменившихся пингов.
+    """
+    out = {"nudged": 0, "returned": 0, "answered": 0, **{f"answered_{d}d": 0 for d in NUDGE_WINDOWS}}
+    seen = set()
+    after = 0
+    while True:
+        rows = conn.execute(
+            """
+            SELECT user_id, last_nudge_at, last_activity_at
+            FROM users
+            WHERE last_nudge_at IS NOT NULL AND user_id > ?
+            ORDER BY user_id
+            LIMIT ?
+            """,
+            (after, chunk_size),
+        ).fetchall()
+        if not rows:
+            break
+        for user_id, nudged_at, activity_at in rows:
+            seen.add(user_id)
+            nudge = stats.nudged.get(user_id)
+            if nudge is None or nudge[0] != nudged_at:
+                first = conn.execute(
+                    "SELECT MIN(created_at) FROM answers WHERE user_id = ? AND created_at > ?",
+                    (user_id, nudged_at),
+                ).fetchone()[0]
+                nudge = stats.nudged[user_id] = [nudged_at, first]
+            first_answer = nudge[1]
+            out["nudged"] += 1
+            if activity_at and activity_at > nudged_at:
+                out["returned"] += 1
+            if first_answer is None:
+                continue
+            out["answered"] += 1
+            waited = datetime.fromisoformat(first_answer) - datetime.fromisoformat(nudged_at)
+            for d in NUDGE_WINDOWS:
+                if waited <= timedelta(days=d):
+                    out[f"answered_{d}d"] += 1
+        after = rows[-1][0]
+        _pause(pause_ms)
+    # пользователя удалили — его пинг больше не считаем
+    for user_id in stats.nudged.keys() - seen:
+        del stats.nudged[user_id]
+    return out
+
+
+# ---------- отчёты ----------
+
+def _write_csv(path: str, header: list[str], rows):
+    with open(path, "w", encoding="utf-8", newline="") as f:
+        w = csv.writer(f)
+        w.writerow(header)
+        w.writerows(rows)
+
+
+def write_reports(out: str, stats: Stats, nudge: dict, meta: dict):
+    first = {qs: n for (qs, q), n in stats.steps.items() if q == 1}
+    steps = [
+        [qs, q, n, round(n / first[qs], 4) if first.get(qs) else ""]
+        for (qs, q), n in sorted(stats.steps.items())
+    ]
+    _write_csv(os.path.join(out, "questions.csv"), ["question_set", "q_index", "answers", "share_of_first"], steps)
+    _write_csv(os.path.join(out, "slots.csv"), ["timezone_group", "notify_time", "answers"],
+               [[g, t, n] for (g, t), n in sorted(stats.slots.items())])
+
+    delay_rows = [["early", stats.delay_early], *zip(bucket_labels(DELAY_BOUNDS), stats.delay),
+                  ["unknown", stats.delay_unknown], ["invalid", stats.delay_invalid]]
+    _write_csv(os.path.join(out, "delay.csv"), ["delay_minutes", "answers"], delay_rows)
+
+    labels = bucket_labels(LENGTH_BOUNDS)
+    _write_csv(os.path.join(out, "lengths.csv"), ["q_index", "length_chars", "answers"],
+               [[q, label, n] for q, counts in sorted(stats.lengths.items()) for label, n in zip(labels, counts)])
+    _write_csv(os.path.join(out, "nudge.csv"), list(nudge), [list(nudge.values())])
+
+    mean_length = {
+        q: round(stats.length_sum[q] / sum(c), 1) for q, c in sorted(stats.lengths.items()) if sum(c)
+    }
+    report = {
+        **meta,
+        "questions": [dict(zip(("question_set", "q_index", "answers", "share_of_first"), r)) for r in steps],
+        "slots": [{"timezone_group": g, "notify_time": t, "answers": n} for (g, t), n in sorted(stats.slots.items())],
+        "delay_minutes": dict(delay_rows),
+        "length_chars": {q: dict(zip(labels, c)) for q, c in sorted(stats.lengths.items())},
+        "mean_length": mean_length,
+        "nudge": nudge,
+    }
+    _atomic_json(os.path.join(out, "report.json"), report)
+
+
+def _atomic_json(path: str, obj):
+    tmp = path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(obj, f, ensure_ascii=False, indent=1)
+    os.replace(tmp, path)
+
+
+def run(out: str = ANALYTICS_DIR, full: bool = False, chunk_size: int = ANALYTICS_CHUNK_SIZE,
+        pause_ms: int = ANALYTICS_PAUSE_MS) -> dict:
+    os.makedirs(out, exist_ok=True)
+    state_path = os.path.join(out, "state.json")
+    stats = Stats()
+    # первый запуск — всегда полный, чтобы захватить и архив
+    full = full or not os.path.exists(state_path)
+    if not full:
+        with open(state_path, encoding="utf-8") as f:
+            stats = Stats.from_json(json.load(f))
+    since = stats.last_id
+
+    started = time.monotonic()
+    conn = connect_ro()
+    try:
+        archived = scan_archive(conn, stats, chunk_size, pause_ms) if full else 0
+        scanned = scan_answers(conn, stats, chunk_size, pause_ms)
+        nudge = nudges(conn, stats, chunk_size, pause_ms)
+    finally:
+        conn.close()
+
+    meta = {
+        "generated_at": datetime.utcnow().isoformat(),
+        "last_id": stats.last_id,
+        "rows_total": stats.rows,
+        "rows_this_run": scanned + archived,
+        "since_id": since,
+        "numpy": np is not None,
+        "elapsed_s": round(time.monotonic() - started, 3),
+    }
+    write_reports(out, stats, nudge, meta)
+    # метка — после отчётов: упали посередине — следующий запуск просто повторит кусок
+    _atomic_json(state_path, stats.to_json())
+    log.info("analytics: %s new rows (%s total) in %.1fs -> %s", meta["rows_this_run"], stats.rows, meta["elapsed_s"], out)
+    return meta
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--out", default=ANALYTICS_DIR)
+    parser.add_argument("--full", action="store_true", help="пересчитать всё, не глядя на state.json")
+    parser.add_argument("--chunk-size", type=int, default=ANALYTICS_CHUNK_SIZE)
+    parser.add_argument("--pause-ms", type=int, default=ANALYTICS_PAUSE_MS)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    print(json.dumps(run(args.out, args.full, args.chunk_size, args.pause_ms), ensure_ascii=False))
+
+
+if __name__ == "__main__":
+    main()
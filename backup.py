@@ -0,0 +1,197 @@
+"""
+Резервные копии users.db без остановки бота.
+
+Снимок снимается online backup API SQLite из отдельного соединения в отдельном
+потоке, по BACKUP_STEP_PAGES страниц с паузой между шагами: event loop и
+поток-писатель adb его не ждут, а в WAL читатель не блокирует писателей.
+Всё копирование идёт внутри одной читающей транзакции — это один
+согласованный срез базы (без неё каждая запись бота перезапускала бы
+копирование с начала, и на живой базе оно могло не закончиться никогда).
+
+Дальше (BACKUP_VACUUM=1) копия пересобирается VACUUM INTO в компактный файл,
+проверяется PRAGMA integrity_check и только после этого получает итоговое имя
+users-YYYYmmddTHHMMSS.db в BACKUP_DIR; хранятся BACKUP_KEEP последних снимков.
+В боте это ночная задача (выполняет держатель аренды).
+
+    python backup.py run                          # снять снимок сейчас
+    python backup.py list
+    python backup.py verify SNAPSHOT              # integrity_check и число строк
+    python backup.py restore SNAPSHOT [--force]   # вернуть DB_PATH к снимку (бот должен быть остановлен)
+
+restore сначала проверяет снимок, а текущую базу сохраняет рядом
+(DB_PATH.before-restore).
+"""
+import argparse
+import asyncio
+import logging
+import os
+import re
+import sqlite3
+import time
+from contextlib import closing
+from datetime import datetime
+
+import metrics
+from config import (
+    BACKUP_DIR, BACKUP_KEEP, BACKUP_STEP_PAGES, BACKUP_STEP_SLEEP_MS, BACKUP_VACUUM, DB_BUSY_TIMEOUT_MS, DB_PATH,
+)
+
+log = logging.getLogger(__name__)
+
+_NAME = re.compile(r"^users-\d{8}T\d{6}\.db$")
+
+# что показывать в verify
+_COUNT_TABLES = ("users", "answers", "answers_archive", "user_stats")
+
+
+def _copy(src_path: str, dst_path: str, step_pages: int = BACKUP_STEP_PAGES, sleep_ms: int = BACKUP_STEP_SLEEP_MS):
+    src = sqlite3.connect(src_path, timeout=DB_BUSY_TIMEOUT_MS / 1000, isolation_level=None)
+    dst = sqlite3.connect(dst_path)
+    try:
+        # читающая транзакция на всё время копирования: согласованный срез без перезапусков
+        src.execute("BEGIN")
+        src.execute("SELECT 1 FROM sqlite_master LIMIT 1").fetchone()
+        src.backup(dst, pages=step_pages, progress=lambda *_: time.sleep(sleep_ms / 1000))
+        src.execute("COMMIT")
+        # снимок — самостоятельный файл, без -wal рядом
+        dst.execute("PRAGMA journal_mode=DELETE")
+    finally:
+        dst.close()
+        src.close()
+
+
+def _open_ro(path: str) -> sqlite3.Connection:
+    if not os.path.exists(path):
+        raise FileNotFoundError(path)
+    return sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+
+
+def verify(path: str) -> list[str]:
+    """Ошибки integrity_check; пустой список — снимок цел."""
+    with closing(_open_ro(path)) as c:
+        return [r[0] for r in c.execute("PRAGMA integrity_check") if r[0] != "ok"]
+
+
+def counts(path: str) -> dict[str, int]:
+    with closing(_open_ro(path)) as c:
+        tables = {r[0] for r in c.execute("SELECT name FROM sqlite_master WHERE type='table'")}
+        return {t: c.execute(f"SELECT COUNT(*) FROM {t}").fetchone()[0] for t in _COUNT_TABLES if t in tables}
+
+
+def snapshots(directory: str = BACKUP_DIR) -> list[str]:
+    """Снимки от старых к новым (время — в имени)."""
+    if not os.path.isdir(directory):
+        return []
+    return [os.path.join(directory, n) for n in sorted(os.listdir(directory)) if _NAME.match(n)]
+
+
+def rotate(directory: str = BACKUP_DIR, keep: int = BACKUP_KEEP) -> int:
+    old = snapshots(directory)[:-keep] if keep > 0 else []
+    for path in old:
+        os.remove(path)
+    return len(old)
+
+
+def snapshot(directory: str = BACKUP_DIR, vacuum: bool = BACKUP_VACUUM, keep: int = BACKUP_KEEP) -> str:
+    """Снимает проверенный снимок DB_PATH в directory. Возвращает путь к нему."""
+    os.makedirs(directory, exist_ok=True)
+    # недописанные файлы прошлых запусков (упали посреди копирования)
+    for name in os.listdir(directory):
+        if name.endswith((".part", ".vacuum")):
+            os.remove(os.path.join(directory, name))
+
+    started = time.monotonic()
+    final = os.path.join(directory, f"users-{datetime.utcnow().strftime('%Y%m%dT%H%M%S')}.db")
+    part, compact = final + ".part", final + ".vacuum"
+    try:
+        _copy(DB_PATH, part)
+        copied = os.path.getsize(part)
+        if vacuum:
+            # пересобираем уже копию, а не живую базу
+            with closing(sqlite3.connect(part)) as c:
+                c.execute("VACUUM INTO ?", (compact,))
+            os.replace(compact, part)
+        problems = verify(part)
+        if problems:
+            raise RuntimeError(f"snapshot failed integrity_check: {problems[:5]}")
+        os.replace(part, final)
+    except BaseException:
+        for path in (part, compact):
+            if os.path.exists(path):
+                os.remove(path)
+        raise
+    removed = rotate(directory, keep)
+    log.info("backup %s: %.1f MB (copied %.1f MB) in %.1fs, %s old removed",
+             final, os.path.getsize(final) / 2**20, copied / 2**20, time.monotonic() - started, removed)
+    return final
+
+
+async def run():
+    """Задача планировщика: снимок в отдельном потоке."""
+    if not BACKUP_DIR:
+        return
+    try:
+        with metrics.timer("bot_backup_seconds"):
+            await asyncio.to_thread(snapshot)
+    except Exception:
+        metrics.inc("bot_backups_total", result="failed")
+        raise
+    metrics.inc("bot_backups_total", result="ok")
+
+
+def _bot_running(path: str) -> bool:
+    # живая аренда планировщика (lease.py) — значит, хотя бы одна копия бота работает
+    with closing(_open_ro(path)) as c:
+        if c.execute("SELECT 1 FROM sqlite_master WHERE name='leases'").fetchone() is None:
+            return False
+        return c.execute("SELECT 1 FROM leases WHERE expires_at > ?", (time.time(),)).fetchone() is not None
+
+
+def restore(path: str, target: str = DB_PATH, force: bool = False):
+    problems = verify(path)
+    if problems:
+        raise SystemExit(f"{path}: integrity_check failed: {problems[:5]}")
+    if os.path.exists(target):
+        if not force and _bot_running(target):
+            raise SystemExit("бот ещё работает (есть живая аренда) — остановите его или запустите с --force")
+        _copy(target, target + ".before-restore")
+    # через backup API, а не копированием файла: цель может быть в WAL с -wal/-shm рядом
+    with closing(_open_ro(path)) as src, closing(sqlite3.connect(target)) as dst:
+        src.backup(dst)
+    problems = verify(target)
+    if problems:
+        raise SystemExit(f"{target}: integrity_check failed after restore: {problems[:5]}")
+    log.info("restored %s from %s: %s", target, path, counts(target))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest="command", required=True)
+    run_cmd = sub.add_parser("run")
+    run_cmd.add_argument("--dir", default=BACKUP_DIR or "backups")
+    run_cmd.add_argument("--no-vacuum", action="store_true")
+    sub.add_parser("list").add_argument("--dir", default=BACKUP_DIR or "backups")
+    sub.add_parser("verify").add_argument("snapshot")
+    restore_cmd = sub.add_parser("restore")
+    restore_cmd.add_argument("snapshot")
+    restore_cmd.add_argument("--force", action="store_true")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    if args.command == "run":
+        print(snapshot(args.dir, vacuum=not args.no_vacuum))
+    elif args.command == "list":
+        for path in snapshots(args.dir):
+            print(f"{path}  {os.path.getsize(path) / 2**20:.1f} MB")
+    elif args.command == "verify":
+        problems = verify(args.snapshot)
+        print("ok" if not problems else "\n".join(problems))
+        print(counts(args.snapshot))
+        if problems:
+            raise SystemExit(1)
+    elif args.command == "restore":
+        restore(args.snapshot, force=args.force)
+
+
+if __name__ == "__main__":
+    main()
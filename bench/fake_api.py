@@ -0,0 +1,101 @@
+"""
+Заглушка Telegram Bot API для нагрузочных прогонов.
+
+    python -m bench.fake_api --port 8099 --latency-ms 30 --rate-429 0.01 --max-rps 30
+
+Отвечает на любые методы, для sendMessage возвращает правдоподобный Message.
+Умеет добавлять задержку, случайные 429 и «глобальный лимит» (429 при превышении max-rps).
+"""
+import argparse
+import asyncio
+import random
+import time
+from collections import Counter
+
+from aiohttp import web
+
+
+class FakeTelegram:
+    def __init__(self, latency_ms: float = 0, jitter_ms: float = 0, rate_429: float = 0,
+                 retry_after: int = 1, max_rps: float = 0):
+        self.latency = latency_ms / 1000
+        self.jitter = jitter_ms / 1000
+        self.rate_429 = rate_429
+        self.retry_after = retry_after
+        self.max_rps = max_rps
+        self.calls: Counter = Counter()
+        self.errors_429 = 0
+        self._message_id = 0
+        self._window = (0, 0)  # (секунда, запросов в ней)
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post("/bot{token}/{method}", self.handle)
+        app.router.add_get("/stats", self.stats)
+        return app
+
+    def _over_limit(self) -> bool:
+        if not self.max_rps:
+            return False
+        second = int(time.monotonic())
+        start, n = self._window
+        if start != second:
+            start, n = second, 0
+        self._window = (start, n + 1)
+        return n + 1 > self.max_rps
+
+    async def handle(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        data = await request.post()
+        self.calls[method] += 1
+        if self.latency or self.jitter:
+            await asyncio.sleep(self.latency + random.random() * self.jitter)
+
+        if method == "sendMessage" and (self._over_limit() or random.random() < self.rate_429):
+            self.errors_429 += 1
+            return web.json_response({
+                "ok": False,
+                "error_code": 429,
+                "description": f"Too Many Requests: retry after {self.retry_after}",
+                "parameters": {"retry_after": self.retry_after},
+            })
+
+        if method == "getMe":
+            result = {"id": 1, "is_bot": True, "first_name": "bench", "username": "bench_bot"}
+        elif method in ("sendMessage", "sendDocument"):
+            self._message_id += 1
+            chat_id = int(data.get("chat_id", 0))
+            result = {
+                "message_id": self._message_id,
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private"},
+                "text": data.get("text", ""),
+            }
+        elif method == "getUpdates":
+            await asyncio.sleep(1)
+            result = []
+        else:
+            result = True
+        return web.json_response({"ok": True, "result": result})
+
+    async def stats(self, request: web.Request) -> web.Response:
+        return web.json_response({"calls": dict(self.calls), "errors_429": self.errors_429})
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8099)
+    parser.add_argument("--latency-ms", type=float, default=0)
+    parser.add_argument("--jitter-ms", type=float, default=0)
+    parser.add_argument("--rate-429", type=float, default=0, help="доля sendMessage, на которые отвечаем 429")
+    parser.add_argument("--retry-after", type=int, default=1)
+    parser.add_argument("--max-rps", type=float, default=0, help="429 при превышении (0 — без лимита)")
+    args = parser.parse_args()
+
+    fake = FakeTelegram(args.latency_ms, args.jitter_ms, args.rate_429, args.retry_after, args.max_rps)
+    web.run_app(fake.app(), host=args.host, port=args.port, print=None)
+
+
+if __name__ == "__main__":
+    main()
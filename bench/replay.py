@@ -0,0 +1,263 @@
+"""
+Воспроизведение записанного трафика (RECORD_FILE, см. recorder.py) через bot.py.
+
+    python -m bench.replay capture.jsonl --speed 1        # в реальном темпе
+    python -m bench.replay capture.jsonl --speed 10       # в 10 раз быстрее
+    python -m bench.replay capture.jsonl --speed max      # без пауз
+    python -m bench.replay capture.jsonl --db snapshot.db --latency-ms 30 --out bench_output.txt
+
+Апдейты идут в dp.feed_update против bench.fake_api: апдейты одного
+пользователя — строго по порядку, разные пользователи — параллельно, каждый
+в момент (at - начало записи) / speed. По умолчанию база временная: каждому
+пользователю из записи заводится строка users. --db берёт копию готовой базы
+(например, снимка backup.py) — это имеет смысл для неанонимной записи.
+
+Воспроизводятся только входящие апдейты, задачи планировщика — нет (их
+нагрузку меряет bench.run). Состояние, в которое пользователя перевело
+что-то кроме апдейтов (вечерняя рассылка вопросов, сессия до начала записи),
+перед апдейтом берётся из state/fsm его строки; число таких подстановок
+есть в отчёте (state_synced).
+
+Кроме --speed 1, защита от флуда (throttle.py) на время прогона выключена:
+в ускоренном темпе обычный пользователь выглядел бы флудером.
+
+Результат — один JSON, как у bench.run: задержка хендлеров (p50/p95/p99)
+и время в БД на апдейт по типам апдейтов, отставание от расписания.
+"""
+import argparse
+import asyncio
+import json
+import os
+import shutil
+import tempfile
+import time
+from collections import defaultdict
+from datetime import datetime
+
+from bench.run import git_commit, peak_rss_mb, percentiles, start_fake_api
+
+# в этих состояниях текст — ответ на вопрос набора
+_ANSWER_STATES = ("Form:answering", "Form:q1", "Form:q2", "Form:q3", "Form:q4")
+
+
+def load(path: str) -> list[dict]:
+    with open(path, encoding="utf-8") as f:
+        records = [json.loads(line) for line in f if line.strip()]
+    records.sort(key=lambda r: r["at"])
+    return records
+
+
+def user_of(update: dict) -> int | None:
+    for kind in ("message", "callback_query", "edited_message", "my_chat_member"):
+        event = update.get(kind)
+        if event is not None and "from" in event:
+            return event["from"]["id"]
+    return None
+
+
+def kind_of(record: dict) -> str:
+    """Тип апдейта для отчёта: команда, кнопка callback'а, ответ на вопрос, текст в состоянии."""
+    update = record["update"]
+    if "callback_query" in update:
+        return "callback:" + (update["callback_query"].get("data") or "").split(":", 1)[0]
+    message = update.get("message")
+    if message is None:
+        return next((k for k in update if k != "update_id"), "unknown")
+    text = message.get("text")
+    if text is None:
+        return "message:other"
+    if text.startswith("/"):
+        return text.split(maxsplit=1)[0].split("@")[0]
+    state = record.get("state")
+    if state in _ANSWER_STATES:
+        return "answer"
+    if state:
+        return "text:" + state.split(":")[-1]
+    return "text"
+
+
+async def prime(user_ids):
+    """Строки users — до начала замеров."""
+    import adb
+
+    for user_id in user_ids:
+        if await adb.get_user(user_id) is None:
+            await adb.upsert_user(user_id, "20:00", "Москва", 1)
+
+
+async def sync_state(user_id: int, record: dict) -> bool:
+    """Подставляет записанное состояние, если replay пришёл к другому. True — подставили."""
+    import bot
+
+    state = record.get("state")
+    if await bot.get_state_outside(user_id) == state:
+        return False
+    if state is None:
+        await bot.clear_state_outside(user_id)
+    else:
+        await bot.set_state_outside(user_id, state)
+        await bot.set_data_outside(user_id, record.get("fsm") or {})
+    return True
+
+
+async def replay(args) -> dict:
+    import adb
+    import bot
+    from aiogram.types import Update
+    from config import ACTIVITY_FLUSH_SECONDS, FSM_FLUSH_SECONDS
+
+    records = load(args.capture)
+    by_user: dict[int, list[dict]] = defaultdict(list)
+    for r in records:
+        by_user[user_of(r["update"])].append(r)
+    anonymous = by_user.pop(None, [])
+
+    bot.scheduler.add_job(adb.flush_activity, trigger="interval", seconds=ACTIVITY_FLUSH_SECONDS)
+    bot.scheduler.add_job(bot.dp.storage.maintain, trigger="interval", seconds=FSM_FLUSH_SECONDS)
+    bot.scheduler.start()
+
+    latency: dict[str, list[float]] = defaultdict(list)
+    db_time: dict[str, list[float]] = defaultdict(list)
+    errors: dict[str, int] = defaultdict(int)
+    lag: list[float] = []
+    synced = 0
+    speed = None if args.speed == "max" else float(args.speed)
+    first_at = records[0]["at"] if records else 0
+
+    async def feed(record: dict, started: float):
+        if speed is not None:
+            due = started + (record["at"] - first_at) / speed
+            delay = due - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            lag.append(max(0.0, time.perf_counter() - due))
+        kind = kind_of(record)
+        update = Update.model_validate(record["update"], context={"bot": bot.bot})
+        acc = [0.0]
+        adb.db_time.set(acc)
+        t = time.perf_counter()
+        try:
+            await bot.dp.feed_update(bot.bot, update)
+        except Exception:
+            errors[kind] += 1
+        latency[kind].append(time.perf_counter() - t)
+        db_time[kind].append(acc[0])
+
+    async def one_user(user_id: int, user_records: list[dict], started: float):
+        nonlocal synced
+        for record in user_records:
+            # до замера: подстановка состояния — не часть нагрузки
+            synced += await sync_state(user_id, record)
+            await feed(record, started)
+
+    try:
+        await prime(by_user)
+        await bot.dp.storage.flush()
+        ops = sum(adb.op_counts.values())
+        started = time.perf_counter()
+        await asyncio.gather(
+            *(one_user(user_id, rs, started) for user_id, rs in by_user.items()),
+            *(feed(r, started) for r in anonymous),
+        )
+        await adb.flush_activity()
+        await adb.flush_answers()
+        await bot.dp.storage.flush()
+        elapsed = time.perf_counter() - started
+        ops = sum(adb.op_counts.values()) - ops
+    finally:
+        bot.scheduler.shutdown(wait=False)
+        await adb.flush_activity()
+        await adb.stop_answers()
+        await bot.dp.storage.close()
+        await bot.bot.session.close()
+        adb.shutdown()
+
+    total = sum(len(v) for v in latency.values())
+    types = {}
+    for kind in sorted(latency, key=lambda k: -len(latency[k])):
+        d = sorted(db_time[kind])
+        types[kind] = {
+            "updates": len(latency[kind]),
+            "errors": errors[kind],
+            **percentiles(latency[kind]),
+            "db_ms_mean": round(sum(d) / len(d) * 1000, 3),
+            "db_ms_p95": round(d[min(len(d) - 1, int(0.95 * len(d)))] * 1000, 3),
+        }
+    return {
+        "records": len(records),
+        "users": len(by_user),
+        "capture_s": round(records[-1]["at"] - first_at, 3) if records else 0,
+        "updates": total,
+        "errors": sum(errors.values()),
+        "elapsed_s": round(elapsed, 3),
+        "updates_per_s": round(total / elapsed, 1) if elapsed else None,
+        "schedule_lag_ms_p99": percentiles(lag)["p99_ms"],
+        "state_synced": synced,
+        "db_ops_per_update": round(ops / total, 2) if total else None,
+        "all": percentiles([x for v in latency.values() for x in v]),
+        "types": types,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("capture", help="JSONL от recorder.py (RECORD_FILE)")
+    parser.add_argument("--speed", default="1", help="множитель темпа или max")
+    parser.add_argument("--db", default="", help="копия этой базы вместо пустой")
+    parser.add_argument("--send-rate", type=float, default=1000, help="SEND_RATE бота на время прогона")
+    parser.add_argument("--latency-ms", type=float, default=20)
+    parser.add_argument("--jitter-ms", type=float, default=10)
+    parser.add_argument("--rate-429", type=float, default=0)
+    parser.add_argument("--retry-after", type=int, default=1)
+    parser.add_argument("--max-rps", type=float, default=0)
+    parser.add_argument("--api-url", default="", help="уже запущенная заглушка вместо своей")
+    parser.add_argument("--out", default="", help="дописать результат JSON-строкой в файл")
+    args = parser.parse_args()
+    if args.speed != "max":
+        try:
+            if float(args.speed) <= 0:
+                raise ValueError
+        except ValueError:
+            parser.error("--speed: положительное число или max")
+
+    workdir = tempfile.mkdtemp(prefix="goodlife-replay-")
+    db_path = os.path.join(workdir, "replay.db")
+    if args.db:
+        shutil.copyfile(args.db, db_path)
+    api = None
+    if not args.api_url:
+        api, args.api_url = start_fake_api(args)
+
+    # конфиг читается при импорте, поэтому окружение — до импорта bot/db
+    os.environ.setdefault("BOT_TOKEN", "123456:BENCHBENCHBENCHBENCHBENCHBENCHBENCH")
+    os.environ["DB_PATH"] = db_path
+    os.environ["TELEGRAM_API_URL"] = args.api_url
+    os.environ["SEND_RATE"] = str(args.send_rate)
+    os.environ.pop("RECORD_FILE", None)
+    if args.speed != "1":
+        os.environ["THROTTLE_BURST"] = str(10**9)
+        os.environ["DEDUP_SECONDS"] = "0"
+
+    try:
+        results = asyncio.run(replay(args))
+    finally:
+        if api is not None:
+            api.terminate()
+            api.wait()
+
+    report = {
+        "commit": git_commit(),
+        "at": datetime.utcnow().isoformat(),
+        "params": {k: v for k, v in vars(args).items() if k not in ("out", "api_url")},
+        "replay": results,
+        "peak_rss_mb": peak_rss_mb(),
+    }
+    line = json.dumps(report, ensure_ascii=False)
+    print(line)
+    if args.out:
+        with open(args.out, "a", encoding="utf-8") as f:
+            f.write(line + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,330 @@
+"""
+Сквозной бенчмарк бота против заглушки Bot API.
+
+    python -m bench.run --users 100000 --scenarios restore,answer_flow,daily_fanout,nudge \
+        --latency-ms 30 --rate-429 0.005 --out bench_output.txt
+
+Поднимает bench.fake_api отдельным процессом (или берёт --api-url), создаёт
+временную БД с синтетическими пользователями и гоняет через bot.py:
+- restore      — restore_jobs_from_db;
+- answer_flow  — send_daily_questions + ответы q1..q4 через dp.feed_update;
+- daily_fanout — deliver_slot по всем слотам;
+- nudge        — check_inactive_users.
+Результат — один JSON (пропускная способность, p50/p95/p99, обращений к БД
+на сообщение, пиковый RSS), чтобы сравнивать между коммитами.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import resource
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+SCENARIOS = ("restore", "answer_flow", "daily_fanout", "nudge")
+
+
+def percentiles(values: list[float]) -> dict:
+    if not values:
+        return {"p50_ms": None, "p95_ms": None, "p99_ms": None}
+    v = sorted(values)
+
+    def pick(p):
+        return round(v[min(len(v) - 1, int(p * len(v)))] * 1000, 3)
+
+    return {"p50_ms": pick(0.50), "p95_ms": pick(0.95), "p99_ms": pick(0.99)}
+
+
+def peak_rss_mb() -> float:
+    # ru_maxrss в Linux — в килобайтах
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+
+def git_commit() -> str | None:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def wait_port(port: int, timeout: float = 10):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=0.2):
+                return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError(f"fake api did not start on port {port}")
+
+
+def start_fake_api(args) -> tuple[subprocess.Popen, str]:
+    """bench.fake_api отдельным процессом с задержками/429 из args; возвращает (процесс, url)."""
+    port = free_port()
+    api = subprocess.Popen([
+        sys.executable, "-m", "bench.fake_api", "--port", str(port),
+        "--latency-ms", str(args.latency_ms), "--jitter-ms", str(args.jitter_ms),
+        "--rate-429", str(args.rate_429), "--retry-after", str(args.retry_after),
+        "--max-rps", str(args.max_rps),
+    ])
+    wait_port(port)
+    return api, f"http://127.0.0.1:{port}"
+
+
+def populate(n_users: int, inactive_share: float, seed: int):
+    """Синтетические пользователи одной транзакцией (до bot.py, чтобы не мешать замерам)."""
+    import db
+    from config import INACTIVE_DAYS
+
+    rnd = random.Random(seed)
+    times = ["20:00", "21:00", "22:00"]
+    groups = ["Москва", "Европа", "Азия", "Америка"]
+    now = datetime.utcnow()
+    old = (now - timedelta(days=INACTIVE_DAYS + 1)).isoformat()
+    fresh = now.isoformat()
+
+    conn = db._conn()
+    conn.execute("BEGIN")
+    conn.executemany(
+        """
+        INSERT INTO users (user_id, notify_time, timezone_group, is_active, updated_at, last_activity_at)
+        VALUES (?, ?, ?, 1, ?, ?)
+        """,
+        (
+            (user_id, times[user_id % 3], groups[user_id % 4], fresh,
+             old if rnd.random() < inactive_share else fresh)
+            for user_id in range(1, n_users + 1)
+        ),
+    )
+    conn.commit()
+
+
+async def fake_stats(api_url: str) -> dict:
+    from aiohttp import ClientSession
+
+    async with ClientSession() as s:
+        async with s.get(f"{api_url}/stats") as r:
+            return await r.json()
+
+
+def db_ops() -> int:
+    import adb
+
+    return sum(adb.op_counts.values())
+
+
+async def scenario_restore(args) -> dict:
+    import bot
+
+    ops = db_ops()
+    started = time.perf_counter()
+    users = await bot.restore_jobs_from_db()
+    elapsed = time.perf_counter() - started
+    return {
+        "users": users,
+        "elapsed_s": round(elapsed, 3),
+        "users_per_s": round(users / elapsed, 1) if elapsed else None,
+        "db_ops": db_ops() - ops,
+        "scheduler_jobs": len(bot.scheduler.get_jobs()),
+    }
+
+
+async def scenario_answer_flow(args) -> dict:
+    import adb
+    import bot
+    from aiogram.types import Update
+
+    rnd = random.Random(args.seed)
+    users = rnd.sample(range(1, args.users + 1), min(args.flow_users, args.users))
+    latencies: list[float] = []
+    update_id = 0
+    errors = 0
+    sem = asyncio.Semaphore(args.concurrency)
+
+    def message(user_id: int, text: str) -> Update:
+        nonlocal update_id
+        update_id += 1
+        return Update.model_validate({
+            "update_id": update_id,
+            "message": {
+                "message_id": update_id,
+                "date": int(time.time()),
+                "chat": {"id": user_id, "type": "private"},
+                "from": {"id": user_id, "is_bot": False, "first_name": "u"},
+                "text": text,
+            },
+        }, context={"bot": bot.bot})
+
+    async def one_user(user_id: int):
+        nonlocal errors
+        async with sem:
+            await bot.send_daily_questions(user_id)
+            for i in range(args.answers):
+                upd = message(user_id, f"ответ {i + 1} пользователя {user_id}: " + "хорошо " * rnd.randint(1, 20))
+                t = time.perf_counter()
+                try:
+                    await bot.dp.feed_update(bot.bot, upd)
+                except Exception:
+                    # ответы хендлеров идут мимо sender'а: 429 здесь — ошибка апдейта, как в проде
+                    errors += 1
+                latencies.append(time.perf_counter() - t)
+
+    ops = db_ops()
+    started = time.perf_counter()
+    await asyncio.gather(*(one_user(u) for u in users))
+    # отложенные записи тоже считаются
+    await adb.flush_activity()
+    await bot.dp.storage.flush()
+    elapsed = time.perf_counter() - started
+    return {
+        "users": len(users),
+        "updates": len(latencies),
+        "errors": errors,
+        "elapsed_s": round(elapsed, 3),
+        "updates_per_s": round(len(latencies) / elapsed, 1) if elapsed else None,
+        **percentiles(latencies),
+        "db_ops_per_message": round((db_ops() - ops) / len(latencies), 2) if latencies else None,
+    }
+
+
+async def scenario_daily_fanout(args) -> dict:
+    import adb
+    import bot
+
+    before = await fake_stats(args.api_url)
+    ops = db_ops()
+    slot_lat: list[float] = []
+    started = time.perf_counter()
+    for hhmm, tz_group in await adb.get_slot_sizes():
+        t = time.perf_counter()
+        await bot.deliver_slot(hhmm, tz_group)
+        slot_lat.append(time.perf_counter() - t)
+    elapsed = time.perf_counter() - started
+    after = await fake_stats(args.api_url)
+    sent = after["calls"].get("sendMessage", 0) - before["calls"].get("sendMessage", 0)
+    return {
+        "slots": len(slot_lat),
+        "send_calls": sent,
+        "errors_429": after["errors_429"] - before["errors_429"],
+        "elapsed_s": round(elapsed, 3),
+        "sends_per_s": round(sent / elapsed, 1) if elapsed else None,
+        "slowest_slot_s": round(max(slot_lat), 3) if slot_lat else None,
+        "db_ops_per_message": round((db_ops() - ops) / sent, 2) if sent else None,
+    }
+
+
+async def scenario_nudge(args) -> dict:
+    import bot
+
+    before = await fake_stats(args.api_url)
+    ops = db_ops()
+    started = time.perf_counter()
+    await bot.check_inactive_users()
+    elapsed = time.perf_counter() - started
+    after = await fake_stats(args.api_url)
+    sent = after["calls"].get("sendMessage", 0) - before["calls"].get("sendMessage", 0)
+    return {
+        "send_calls": sent,
+        "elapsed_s": round(elapsed, 3),
+        "sends_per_s": round(sent / elapsed, 1) if elapsed else None,
+        "db_ops": db_ops() - ops,
+    }
+
+
+async def run(args) -> dict:
+    import adb
+    import bot
+    from config import ACTIVITY_FLUSH_SECONDS, FSM_FLUSH_SECONDS
+
+    # фоновые сбросы как в main(), без cron-задач слотов и пингов
+    bot.scheduler.add_job(adb.flush_activity, trigger="interval", seconds=ACTIVITY_FLUSH_SECONDS)
+    bot.scheduler.add_job(bot.dp.storage.maintain, trigger="interval", seconds=FSM_FLUSH_SECONDS)
+    bot.scheduler.start()
+
+    results = {}
+    try:
+        for name in args.scenarios:
+            results[name] = await globals()[f"scenario_{name}"](args)
+            results[name]["peak_rss_mb"] = peak_rss_mb()
+    finally:
+        bot.scheduler.shutdown(wait=False)
+        await adb.flush_activity()
+        await adb.stop_answers()
+        await bot.dp.storage.close()
+        await bot.bot.session.close()
+        adb.shutdown()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=10_000)
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS))
+    parser.add_argument("--flow-users", type=int, default=2000, help="сколько пользователей проходят q1..q4")
+    parser.add_argument("--answers", type=int, default=4, help="ответов на пользователя в answer_flow")
+    parser.add_argument("--concurrency", type=int, default=200, help="одновременно отвечающих пользователей")
+    parser.add_argument("--inactive-share", type=float, default=0.1, help="доля давно молчащих (для nudge)")
+    parser.add_argument("--send-rate", type=float, default=1000, help="SEND_RATE бота на время прогона")
+    parser.add_argument("--latency-ms", type=float, default=20)
+    parser.add_argument("--jitter-ms", type=float, default=10)
+    parser.add_argument("--rate-429", type=float, default=0)
+    parser.add_argument("--retry-after", type=int, default=1)
+    parser.add_argument("--max-rps", type=float, default=0)
+    parser.add_argument("--api-url", default="", help="уже запущенная заглушка вместо своей")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--out", default="", help="дописать результат JSON-строкой в файл")
+    args = parser.parse_args()
+    args.scenarios = [s for s in args.scenarios.split(",") if s]
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"unknown scenarios: {', '.join(sorted(unknown))}")
+
+    workdir = tempfile.mkdtemp(prefix="goodlife-bench-")
+    api = None
+    if not args.api_url:
+        api, args.api_url = start_fake_api(args)
+
+    # конфиг читается при импорте, поэтому окружение — до импорта bot/db
+    os.environ.setdefault("BOT_TOKEN", "123456:BENCHBENCHBENCHBENCHBENCHBENCHBENCH")
+    os.environ["DB_PATH"] = os.path.join(workdir, "bench.db")
+    os.environ["TELEGRAM_API_URL"] = args.api_url
+    os.environ["SEND_RATE"] = str(args.send_rate)
+
+    try:
+        started = time.perf_counter()
+        populate(args.users, args.inactive_share, args.seed)
+        populate_s = time.perf_counter() - started
+        results = asyncio.run(run(args))
+    finally:
+        if api is not None:
+            api.terminate()
+            api.wait()
+
+    report = {
+        "commit": git_commit(),
+        "at": datetime.utcnow().isoformat(),
+        "params": {k: v for k, v in vars(args).items() if k not in ("out", "api_url")},
+        "populate_s": round(populate_s, 3),
+        "scenarios": results,
+        "peak_rss_mb": peak_rss_mb(),
+    }
+    line = json.dumps(report, ensure_ascii=False)
+    print(line)
+    if args.out:
+        with open(args.out, "a", encoding="utf-8") as f:
+            f.write(line + "\n")
+
+
+if __name__ == "__main__":
+    main()
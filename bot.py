@@ -1,37 +1,58 @@
 import asyncio
-from datetime import datetime, timedelta
+import logging
+import os
+import signal
+import time
+from datetime import date, datetime, timedelta, timezone
 from zoneinfo import ZoneInfo
 
 from aiogram import Bot, Dispatcher, F
-from aiogram.types import Message, ReplyKeyboardMarkup, KeyboardButton
-from aiogram.filters import Command
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.types import (
+    CallbackQuery, FSInputFile, InlineKeyboardButton, InlineKeyboardMarkup, KeyboardButton, Message,
+    ReplyKeyboardMarkup,
+)
+from aiogram.filters import Command, CommandObject, StateFilter
 from aiogram.fsm.context import FSMContext
-from aiogram.fsm.storage.memory import MemoryStorage
 from aiogram.fsm.storage.base import StorageKey
 
+from apscheduler.events import EVENT_JOB_ERROR, EVENT_JOB_EXECUTED, EVENT_JOB_MISSED, EVENT_JOB_SUBMITTED
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 
+import adb
+import backup
 import db
-from config import BOT_TOKEN, DEFAULT_TZ, INACTIVE_DAYS, NUDGE_COOLDOWN_DAYS
+import export
+import flows
+import maintenance
+import metrics
+from broadcast import Broadcaster
+from sender import Sender
+from lease import Lease
+from profiler import Profiler
+from recorder import Recorder
+from storage import SQLiteStorage
+from throttle import Throttle
+from webhook import run_webhook
+from config import (
+    BOT_TOKEN, DEFAULT_TZ, TZ_GROUPS, INACTIVE_DAYS, NUDGE_COOLDOWN_DAYS, NUDGE_CHUNK_SIZE, ACTIVITY_FLUSH_SECONDS,
+    FSM_FLUSH_SECONDS, BOT_MODE, TELEGRAM_API_URL,
+    METRICS_HOST, METRICS_PORT, METRICS_FILE, METRICS_DUMP_SECONDS, PROFILE_ENABLED,
+    DIGEST_WEEKDAY, DIGEST_TIME, DIGEST_CHUNK_SIZE, HISTORY_PAGE_SIZE, EXPORT_CONCURRENCY,
+    SEARCH_PAGE_SIZE, INSTANCE_ID, LEASE_TTL_SECONDS, CATCHUP_HOURS, SLOT_CHUNK_SIZE, BACKUP_DIR, BACKUP_TIME,
+    RECORD_FILE, ADMIN_IDS, BROADCAST_SLOT_GUARD_SECONDS,
+)
 from states import Form
 
-
-QUESTIONS = [
-    "1) Что за сегодняшний день Вы сделали хорошо?",
-    "2) Что люди вокруг Вас сделали такого, за что Вы им благодарны (неважно, сделали они это по отношению к Вам или нет)? Кому Вы за это благодарны?",
-    "3) Что Вы в течение сегодняшнего дня видели, слышали, пробовали на вкус, осязали, обоняли, что наполняет Вас благодарностью к миру / что принесло Вам удовлетворение?",
-    "4) Какие мелочи порадовали / повеселили Вас сегодня?",
-]
+STARTED_AT = time.monotonic()
+log = logging.getLogger(__name__)
 
 ALLOWED_TIMES = ["20:00", "21:00", "22:00"]
 
-# Грубые регионы -> timezone
-TZ_GROUPS = {
-    "Москва": "Europe/Moscow",
-    "Европа": "Europe/Berlin",
-    "Азия": "Asia/Almaty",
-    "Америка": "America/New_York",
-}
+# ZoneInfo строим один раз на группу, а не на каждый вызов
+TZ_ZONES = {group: ZoneInfo(tz_name) for group, tz_name in TZ_GROUPS.items()}
+DEFAULT_ZONE = ZoneInfo(DEFAULT_TZ)
 
 # ---------- keyboards ----------
 
@@ -61,8 +82,11 @@ main_keyboard = ReplyKeyboardMarkup(
     resize_keyboard=True,
 )
 
-bot = Bot(token=BOT_TOKEN)
-dp = Dispatcher(storage=MemoryStorage())
+if TELEGRAM_API_URL:
+    bot = Bot(token=BOT_TOKEN, session=AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_URL)))
+else:
+    bot = Bot(token=BOT_TOKEN)
+dp = Dispatcher(storage=SQLiteStorage())
 
 # scheduler можно держать в UTC — timezone задаём на уровне job
 scheduler = AsyncIOScheduler()
@@ -70,35 +94,34 @@ scheduler = AsyncIOScheduler()
 
 # ---------- helpers ----------
 
-def tz_for_user(user_id: int) -> ZoneInfo:
-    u = db.get_user(user_id) or {}
+async def tz_for_user(user_id: int) -> ZoneInfo:
+    u = await adb.get_user(user_id) or {}
     group = u.get("timezone_group") or "Москва"
-    tz_name = TZ_GROUPS.get(group, DEFAULT_TZ)
-    return ZoneInfo(tz_name)
+    return TZ_ZONES.get(group, DEFAULT_ZONE)
 
-def today_str_for_user(user_id: int) -> str:
-    tz = tz_for_user(user_id)
+async def today_str_for_user(user_id: int) -> str:
+    tz = await tz_for_user(user_id)
     return datetime.now(tz).date().isoformat()
 
-def schedule_user(user_id: int, hhmm: str):
+def add_slot_job(hhmm: str, tz_group: str):
+    # задача в планировщике — одна на слот; кто в него попадает, решает строка users (см. deliver_slot)
     hour, minute = map(int, hhmm.split(":"))
-    tz = tz_for_user(user_id)
-
     scheduler.add_job(
-        send_daily_questions,
+        lease.only_leader(deliver_slot),
         trigger="cron",
         hour=hour,
         minute=minute,
-        timezone=tz,
-        args=[user_id],
-        id=str(user_id),
+        timezone=TZ_ZONES.get(tz_group, DEFAULT_ZONE),
+        args=[hhmm, tz_group],
+        id=f"slot:{tz_group}:{hhmm}",
         replace_existing=True,
     )
 
-def unschedule_user(user_id: int):
-    job = scheduler.get_job(str(user_id))
-    if job:
-        scheduler.remove_job(str(user_id))
+async def deactivate_user(user_id: int):
+    # бот заблокирован / чат удалён — больше не пишем
+    await adb.set_active(user_id, 0)
+
+sender = Sender(bot, on_permanent_failure=deactivate_user)
 
 async def fsm_ctx_outside(user_id: int) -> FSMContext:
     key = StorageKey(bot_id=bot.id, chat_id=user_id, user_id=user_id)
@@ -129,8 +152,8 @@ async def clear_state_outside(user_id: int):
 
 async def start_flow(message: Message, state: FSMContext):
     # создаём/активируем пользователя и фиксируем активность
-    db.upsert_user(message.from_user.id, notify_time=None, timezone_group="Москва", is_active=1)
-    db.touch_activity(message.from_user.id)
+    await adb.upsert_user(message.from_user.id, notify_time=None, timezone_group="Москва", is_active=1)
+    await adb.touch_activity(message.from_user.id)
 
     await message.answer(
         "Это бот «Вопросы для хорошей жизни».\n\n"
@@ -151,7 +174,7 @@ async def btn_start(message: Message, state: FSMContext):
 
 @dp.message(F.text == "🌍 Регион")
 async def btn_region(message: Message, state: FSMContext):
-    db.touch_activity(message.from_user.id)
+    await adb.touch_activity(message.from_user.id)
     await message.answer(
         "Выберите регион (грубо):\n"
         "• Москва = Europe/Moscow\n"
@@ -165,7 +188,7 @@ async def btn_region(message: Message, state: FSMContext):
 @dp.message(F.text == "⏰ Время")
 @dp.message(Command("change_time"))
 async def btn_time(message: Message, state: FSMContext):
-    db.touch_activity(message.from_user.id)
+    await adb.touch_activity(message.from_user.id)
     await message.answer("Выберите время отправки ежедневных вопросов:", reply_markup=time_keyboard)
     await state.set_state(Form.wait_time)
 
@@ -173,9 +196,8 @@ async def btn_time(message: Message, state: FSMContext):
 @dp.message(Command("stop"))
 async def stop_flow(message: Message, state: FSMContext):
     user_id = message.from_user.id
-    db.touch_activity(user_id)
-    unschedule_user(user_id)
-    db.set_active(user_id, 0)
+    await adb.touch_activity(user_id)
+    await adb.set_active(user_id, 0)
     await state.clear()
     await message.answer("Остановлено ✅", reply_markup=main_keyboard)
 
@@ -185,10 +207,11 @@ async def stop_flow(message: Message, state: FSMContext):
 @dp.message(F.text == "⏭️ Пропустить сегодня")
 async def skip_today(message: Message, state: FSMContext):
     user_id = message.from_user.id
-    db.touch_activity(user_id)
+    await adb.touch_activity(user_id)
 
-    today = today_str_for_user(user_id)
-    db.set_skip_date(user_id, today)
+    today = await today_str_for_user(user_id)
+    await adb.set_skip_date(user_id, today)
+    await adb.record_skipped(user_id, today)
 
     # если в FSM стояло ожидание "сегодняшних" вопросов — уберём
     data = await state.get_data()
@@ -206,7 +229,7 @@ async def skip_today(message: Message, state: FSMContext):
 
 @dp.message(Form.wait_region)
 async def choose_region(message: Message, state: FSMContext):
-    db.touch_activity(message.from_user.id)
+    await adb.touch_activity(message.from_user.id)
 
     if message.text == "↩️ Назад":
         await state.clear()
@@ -217,7 +240,8 @@ async def choose_region(message: Message, state: FSMContext):
         await message.answer("Пожалуйста, выберите регион кнопкой 🌍", reply_markup=region_keyboard)
         return
 
-    db.update_timezone_group(message.from_user.id, message.text)
+    # уже подписан -> со следующей рассылки он в слоте нового региона: слот берётся из строки users
+    await adb.update_timezone_group(message.from_user.id, message.text)
 
     await message.answer(
         f"Принято. Регион: {message.text}.\n"
@@ -231,7 +255,7 @@ async def choose_region(message: Message, state: FSMContext):
 
 @dp.message(Form.wait_time)
 async def choose_time(message: Message, state: FSMContext):
-    db.touch_activity(message.from_user.id)
+    await adb.touch_activity(message.from_user.id)
 
     if message.text == "↩️ Назад":
         await message.answer("Хорошо. Тогда сначала выберите регион:", reply_markup=region_keyboard)
@@ -245,8 +269,7 @@ async def choose_time(message: Message, state: FSMContext):
     user_id = message.from_user.id
     hhmm = message.text
 
-    db.update_notify_time(user_id, hhmm)
-    schedule_user(user_id, hhmm)
+    await adb.update_notify_time(user_id, hhmm)
 
     # ✅ ВАЖНО: сразу отвечаем и показываем меню-кнопки
     await state.clear()
@@ -259,104 +282,355 @@ async def choose_time(message: Message, state: FSMContext):
 
 # ---------- daily flow (pending + skip) ----------
 
-async def send_daily_questions(user_id: int):
+async def send_daily_questions(user_id: int) -> bool:
     """
     В выбранное время каждый день:
     - если skip_date == today -> не начинаем новый набор
     - если пользователь НЕ в процессе ответов -> начинаем новый дневной набор
     - если пользователь ещё отвечает -> не прерываем, ставим pending_date=today
       и начнём сегодняшние сразу после завершения q4 (если не нажали "пропустить сегодня")
+    False — сообщение не ушло (доставку можно повторить).
     """
-    today = today_str_for_user(user_id)
-    u = db.get_user(user_id) or {}
+    today = await today_str_for_user(user_id)
+    u = await adb.get_user(user_id) or {}
 
     if u.get("skip_date") == today:
-        return
+        return True
 
     current_state = await get_state_outside(user_id)
 
     if current_state is None:
+        flow = flows.for_user(u)
         await clear_state_outside(user_id)
-        await set_data_outside(user_id, {"session_date": today, "pending_date": None})
-        await bot.send_message(user_id, QUESTIONS[0], reply_markup=main_keyboard)
-        await set_state_outside(user_id, Form.q1)
-        return
+        await set_data_outside(user_id, flows.start_data(flow, today))
+        if await sender.send_message(user_id, flow.questions[0], reply_markup=main_keyboard) is None:
+            return False
+        await set_state_outside(user_id, Form.answering)
+        return True
 
     data = await get_data_outside(user_id)
     pending = data.get("pending_date")
 
     if pending != today:
         await set_data_outside(user_id, {"pending_date": today})
-        await bot.send_message(
+        msg = await sender.send_message(
             user_id,
             "⏳ Пора на новые вопросы, но вы ещё отвечаете на предыдущие.\n"
             "Закончите текущий набор — и я начну сегодняшний.",
             reply_markup=main_keyboard,
         )
+        return msg is not None
+    return True
 
 
-# ---------- answers (с запуском pending дня после q4) ----------
+# сколько рассылок слотов идёт прямо сейчас (пока не ноль, объявления ждут)
+_slots_running = 0
 
-@dp.message(Form.q1)
-async def q1(message: Message, state: FSMContext):
-    user_id = message.from_user.id
-    db.touch_activity(user_id)
+async def deliver_slot(hhmm: str, tz_group: str):
+    """
+    Рассылка слота. Получатели читаются из БД (notify_time и timezone_group строки users —
+    единственный источник, так видны и изменения через другие реплики), каждая пачка
+    сначала отмечается в deliveries — уже отмеченных сегодня (другой репликой, до
+    перезапуска) пропускаем.
+    """
+    global _slots_running
+    today = datetime.now(TZ_ZONES.get(tz_group, DEFAULT_ZONE)).date().isoformat()
+    failed: list[int] = []
 
-    d = await state.get_data()
-    session_date = d.get("session_date", today_str_for_user(user_id))
-    db.save_answer(user_id, session_date, 1, QUESTIONS[0], message.text)
+    async def recipients():
+        async for chunk in adb.iter_slot_users(hhmm, tz_group, SLOT_CHUNK_SIZE):
+            for user_id in await adb.claim_deliveries(chunk, today, "daily"):
+                yield user_id
 
-    await message.answer(QUESTIONS[1], reply_markup=main_keyboard)
-    await state.set_state(Form.q2)
+    async def deliver(user_id: int):
+        if not await send_daily_questions(user_id):
+            failed.append(user_id)
 
-@dp.message(Form.q2)
-async def q2(message: Message, state: FSMContext):
-    user_id = message.from_user.id
-    db.touch_activity(user_id)
-
-    d = await state.get_data()
-    session_date = d.get("session_date", today_str_for_user(user_id))
-    db.save_answer(user_id, session_date, 2, QUESTIONS[1], message.text)
+    _slots_running += 1
+    try:
+        await sender.run(recipients(), deliver, name=f"slot {tz_group} {hhmm}")
+    finally:
+        _slots_running -= 1
+        await adb.release_deliveries(failed, today, "daily")
+
+
+def slots_busy() -> bool:
+    """Идёт рассылка слота или до ближайшего меньше BROADCAST_SLOT_GUARD_SECONDS."""
+    if _slots_running:
+        return True
+    soon = datetime.now(timezone.utc) + timedelta(seconds=BROADCAST_SLOT_GUARD_SECONDS)
+    return any(
+        job.id.startswith("slot:") and job.next_run_time is not None and job.next_run_time <= soon
+        for job in scheduler.get_jobs()
+    )
 
-    await message.answer(QUESTIONS[2], reply_markup=main_keyboard)
-    await state.set_state(Form.q3)
 
-@dp.message(Form.q3)
-async def q3(message: Message, state: FSMContext):
+async def catch_up_slots():
+    """После простоя/смены лидера: досылаем сегодняшние слоты, опоздавшие не больше CATCHUP_HOURS."""
+    if CATCHUP_HOURS <= 0:
+        return
+    since = await adb.meta_get("deliveries_since")
+    since = datetime.fromisoformat(since).replace(tzinfo=timezone.utc) if since else None
+    for tz_group, zone in TZ_ZONES.items():
+        now = datetime.now(zone)
+        for hhmm in ALLOWED_TIMES:
+            hour, minute = map(int, hhmm.split(":"))
+            slot_at = now.replace(hour=hour, minute=minute, second=0, microsecond=0)
+            if not (slot_at <= now <= slot_at + timedelta(hours=CATCHUP_HOURS)):
+                continue
+            if since is not None and slot_at < since:
+                continue
+            log.info("catching up slot %s %s", tz_group, hhmm)
+            await deliver_slot(hhmm, tz_group)
+
+
+async def on_lease_acquired(changed_hands: bool):
+    # пока активной была другая реплика, сессии и строки users меняла она — кэши устарели;
+    # аренда вернулась к нам же (продление не успело) — никто их не трогал
+    if changed_hands:
+        await dp.storage.reset()
+        db.reset_user_cache()
+    await catch_up_slots()
+
+
+async def on_lease_lost():
+    # апдейты теперь принимает другая реплика: всё накопленное — в БД
+    await dp.storage.flush()
+    await adb.flush_activity()
+    await adb.flush_answers()
+
+
+# одна аренда на задачи планировщика и приём апдейтов (активная реплика, см. lease.py)
+lease = Lease("scheduler", INSTANCE_ID, LEASE_TTL_SECONDS, on_acquired=on_lease_acquired, on_lost=on_lease_lost)
+
+
+# ---------- answers (с запуском pending дня после последнего вопроса) ----------
+
+# команды посреди набора (/stats и т. п.) ответом не считаются — их разбирают свои хендлеры
+@dp.message(StateFilter(Form.answering, Form.q1, Form.q2, Form.q3, Form.q4), F.text, ~F.text.startswith("/"))
+async def answer_step(message: Message, state: FSMContext, raw_state: str | None):
+    """
+    Один шаг любого набора (flows.py): ответ сохраняется одной записью в БД
+    (на последнем шаге — вместе со статистикой дня), дальше — следующий вопрос
+    или завершение набора.
+    """
     user_id = message.from_user.id
-    db.touch_activity(user_id)
+    await adb.touch_activity(user_id)
 
     d = await state.get_data()
-    session_date = d.get("session_date", today_str_for_user(user_id))
-    db.save_answer(user_id, session_date, 3, QUESTIONS[2], message.text)
-
-    await message.answer(QUESTIONS[3], reply_markup=main_keyboard)
-    await state.set_state(Form.q4)
-
-@dp.message(Form.q4)
-async def q4(message: Message, state: FSMContext):
-    user_id = message.from_user.id
-    db.touch_activity(user_id)
+    flow, step = flows.position(raw_state, d)
+    session_date = d.get("session_date") or await today_str_for_user(user_id)
+    last = step == len(flow.questions) - 1
+    await adb.save_answer(
+        user_id, session_date, step + 1, flow.questions[step], message.text,
+        question_set=flow.id, completes=last,
+    )
 
-    d = await state.get_data()
-    session_date = d.get("session_date", today_str_for_user(user_id))
-    db.save_answer(user_id, session_date, 4, QUESTIONS[3], message.text)
+    if not last:
+        await message.answer(flow.questions[step + 1], reply_markup=main_keyboard)
+        await state.set_state(Form.answering)
+        await state.update_data(flow=flow.id, step=step + 1, session_date=session_date)
+        return
 
     pending_date = d.get("pending_date")
     await state.clear()
 
-    today = today_str_for_user(user_id)
-    u = db.get_user(user_id) or {}
+    today = await today_str_for_user(user_id)
+    u = await adb.get_user(user_id) or {}
     skip_today_flag = (u.get("skip_date") == today)
 
     if pending_date == today and not skip_today_flag:
         await message.answer("Спасибо! 🌿 Теперь начнём сегодняшний набор.", reply_markup=main_keyboard)
-        await set_data_outside(user_id, {"session_date": today, "pending_date": None})
-        await bot.send_message(user_id, QUESTIONS[0], reply_markup=main_keyboard)
-        await set_state_outside(user_id, Form.q1)
+        next_flow = flows.for_user(u)
+        await set_data_outside(user_id, flows.start_data(next_flow, today))
+        await bot.send_message(user_id, next_flow.questions[0], reply_markup=main_keyboard)
+        await set_state_outside(user_id, Form.answering)
+        return
+
+    await message.answer(flow.done, reply_markup=main_keyboard)
+
+
+# ---------- статистика ----------
+
+def streak_now(s: dict, today: str) -> int:
+    # серия жива, пока последний её день — сегодня или вчера
+    yesterday = (date.fromisoformat(today) - timedelta(days=1)).isoformat()
+    return s["current_streak"] if (s["streak_date"] or "") >= yesterday else 0
+
+@dp.message(Command("stats"))
+async def cmd_stats(message: Message):
+    user_id = message.from_user.id
+    await adb.touch_activity(user_id)
+
+    s = await adb.get_user_stats(user_id)
+    if s is None or not (s["completed_days"] or s["skipped_days"]):
+        await message.answer("Пока нет ни одного завершённого дня — всё впереди 🌱", reply_markup=main_keyboard)
+        return
+
+    today = await today_str_for_user(user_id)
+    partial = max(0, s["sessions_started"] - s["completed_days"])
+    await message.answer(
+        "📊 Ваша статистика\n\n"
+        f"🔥 Текущая серия: {streak_now(s, today)}\n"
+        f"🏆 Самая длинная серия: {s['longest_streak']}\n"
+        f"✅ Дней с ответами: {s['completed_days']}\n"
+        f"⏸️ Незавершённых наборов: {partial}\n"
+        f"⏭️ Пропущено дней: {s['skipped_days']}\n"
+        f"📅 Последний завершённый день: {s['last_completed_date'] or '—'}",
+        reply_markup=main_keyboard,
+    )
+
+
+async def send_weekly_digest(tz_group: str):
+    # всегда прошедшая полная неделя (пн–вс): вечерние слоты воскресенья в неё уже попали
+    day = datetime.now(TZ_ZONES.get(tz_group, DEFAULT_ZONE)).date()
+    today = day.isoformat()
+    week_start = (day - timedelta(days=day.weekday() + 7)).isoformat()
+
+    async for chunk in adb.iter_digest(tz_group, week_start, DIGEST_CHUNK_SIZE):
+        by_user = {s["user_id"]: s for s in chunk}
+
+        async def digest(user_id: int):
+            s = by_user[user_id]
+            await sender.send_message(
+                user_id,
+                "🌿 Ваша неделя благодарностей\n\n"
+                f"✅ Дней с ответами: {s['week_completed']} из 7\n"
+                f"🔥 Серия: {streak_now(s, today)} (рекорд — {s['longest_streak']})\n"
+                f"Всего дней с ответами: {s['completed_days']}",
+                reply_markup=main_keyboard,
+            )
+
+        # повторный запуск (другая реплика, перезапуск) не шлёт сводку второй раз
+        claimed = await adb.claim_deliveries(list(by_user), week_start, "digest")
+        await sender.run(claimed, digest, name=f"digest {tz_group}")
+
+
+# ---------- история, поиск и выгрузка ----------
+
+# чтобы страница влезла в одно сообщение (лимит Telegram — 4096 символов)
+HISTORY_ANSWER_CHARS = max(100, 3600 // HISTORY_PAGE_SIZE)
+
+async def history_page(user_id: int, before: tuple[str, int, int] | None):
+    # от новых к старым; кнопка «Раньше» несёт ключ последней показанной строки
+    rows = await adb.get_answers_page(user_id, before, HISTORY_PAGE_SIZE, desc=True)
+    if not rows:
+        return None, None
+
+    # дни — от новых к старым, ответы внутри дня — по порядку вопросов
+    days: dict[str, list[dict]] = {}
+    for r in rows:
+        days.setdefault(r["session_date"], []).append(r)
+    lines = []
+    for day, day_rows in days.items():
+        lines.append(f"\n📅 {day}")
+        for r in reversed(day_rows):
+            answer = r["answer"]
+            if len(answer) > HISTORY_ANSWER_CHARS:
+                answer = answer[:HISTORY_ANSWER_CHARS] + "…"
+            lines.append(f"{r['q_index']}) {answer}")
+
+    keyboard = None
+    if len(rows) == HISTORY_PAGE_SIZE:
+        last = rows[-1]
+        keyboard = InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(
+            text="⬅️ Раньше", callback_data=f"hist:{last['session_date']}:{last['q_index']}:{last['id']}",
+        )]])
+    return "\n".join(lines).strip(), keyboard
+
+@dp.message(Command("history"))
+async def cmd_history(message: Message):
+    await adb.touch_activity(message.from_user.id)
+    text, keyboard = await history_page(message.from_user.id, None)
+    if text is None:
+        await message.answer("Здесь появятся ваши ответы 🌱", reply_markup=main_keyboard)
         return
+    await message.answer(text, reply_markup=keyboard)
+
+@dp.callback_query(F.data.startswith("hist:"))
+async def history_more(callback: CallbackQuery):
+    await adb.touch_activity(callback.from_user.id)
+    _, session_date, q_index, answer_id = callback.data.split(":")
+    text, keyboard = await history_page(callback.from_user.id, (session_date, int(q_index), int(answer_id)))
+    await callback.answer()
+    if text is None:
+        await callback.message.edit_reply_markup(reply_markup=None)
+        return
+    await callback.message.edit_text(text, reply_markup=keyboard)
+
+
+async def search_page(user_id: int, query: str, offset: int):
+    rows = await adb.search_answers(user_id, query, SEARCH_PAGE_SIZE, offset)
+    if not rows:
+        return None, None
+    text = "\n\n".join(f"📅 {r['session_date']}, вопрос {r['q_index']}\n{r['snippet']}" for r in rows)
+    keyboard = None
+    if len(rows) == SEARCH_PAGE_SIZE:
+        keyboard = InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(
+            text="Ещё ➡️", callback_data=f"srch:{offset + SEARCH_PAGE_SIZE}",
+        )]])
+    return text, keyboard
+
+@dp.message(Command("search"))
+async def cmd_search(message: Message, command: CommandObject, state: FSMContext):
+    user_id = message.from_user.id
+    await adb.touch_activity(user_id)
 
-    await message.answer("Спасибо за ответы. До завтра!", reply_markup=main_keyboard)
+    query = (command.args or "").strip()
+    if not query:
+        await message.answer("Что ищем? Например: /search море", reply_markup=main_keyboard)
+        return
+    # запрос не влезает в callback_data — держим его в данных FSM
+    await state.update_data(search_query=query)
+    text, keyboard = await search_page(user_id, query, 0)
+    if text is None:
+        await message.answer("Ничего не нашлось 🔍", reply_markup=main_keyboard)
+        return
+    await message.answer(text, reply_markup=keyboard)
+
+@dp.callback_query(F.data.startswith("srch:"))
+async def search_more(callback: CallbackQuery, state: FSMContext):
+    await adb.touch_activity(callback.from_user.id)
+    query = (await state.get_data()).get("search_query")
+    await callback.answer()
+    text, keyboard = (None, None) if not query else await search_page(
+        callback.from_user.id, query, int(callback.data.split(":")[1])
+    )
+    if text is None:
+        await callback.message.edit_reply_markup(reply_markup=None)
+        return
+    await callback.message.edit_text(text, reply_markup=keyboard)
+
+
+# выгрузка читает всю историю — одновременно их немного, остальные ждут
+_export_slots = asyncio.Semaphore(EXPORT_CONCURRENCY)
+# лимит Bot API на отправку файла
+EXPORT_MAX_BYTES = 50 * 1024 * 1024
+
+@dp.message(Command("export"))
+async def cmd_export(message: Message, command: CommandObject):
+    user_id = message.from_user.id
+    await adb.touch_activity(user_id)
+
+    fmt = (command.args or "md").strip().lower()
+    if fmt not in export.FORMATS:
+        await message.answer(f"Формат: /export {' | '.join(export.FORMATS)}", reply_markup=main_keyboard)
+        return
+
+    async with _export_slots:
+        path, size = await export.export_answers(user_id, fmt)
+    try:
+        if size > EXPORT_MAX_BYTES:
+            await message.answer("История слишком большая для одного файла 😔", reply_markup=main_keyboard)
+            return
+        today = await today_str_for_user(user_id)
+        await message.answer_document(
+            FSInputFile(path, filename=f"good-life-{today}.{fmt}"),
+            caption="Ваши ответы 🌿",
+            reply_markup=main_keyboard,
+        )
+    finally:
+        os.remove(path)
 
 
 # ---------- тихое правило ----------
@@ -368,74 +642,323 @@ async def check_inactive_users():
     - и last_nudge_at пустой/старше NUDGE_COOLDOWN_DAYS
     -> мягкий пинг
     """
+    # буфер активности должен попасть в БД до выборки, иначе пнём только что писавших
+    await adb.flush_activity()
+
     now = datetime.utcnow()
-    users = db.get_users_for_nudge()
+    activity_before = (now - timedelta(days=INACTIVE_DAYS)).isoformat()
+    nudge_before = (now - timedelta(days=NUDGE_COOLDOWN_DAYS)).isoformat()
 
-    for u in users:
-        user_id = u["user_id"]
+    async for chunk in adb.iter_users_for_nudge(activity_before, nudge_before, NUDGE_CHUNK_SIZE):
+        sent = []
 
-        last_activity = u.get("last_activity_at")
-        if not last_activity:
-            continue
+        async def nudge(user_id: int):
+            if await send_nudge(user_id):
+                sent.append(user_id)
 
-        try:
-            last_activity_dt = datetime.fromisoformat(last_activity)
-        except:
-            continue
+        await sender.run(chunk, nudge, name="nudge")
+        await adb.save_nudge_sent_many(sent)
 
-        if now - last_activity_dt < timedelta(days=INACTIVE_DAYS):
-            continue
 
-        last_nudge = u.get("last_nudge_at")
-        if last_nudge:
-            try:
-                last_nudge_dt = datetime.fromisoformat(last_nudge)
-                if now - last_nudge_dt < timedelta(days=NUDGE_COOLDOWN_DAYS):
-                    continue
-            except:
-                pass
+async def send_nudge(user_id: int) -> bool:
+    msg = await sender.send_message(
+        user_id,
+        "Я рядом 🌿\n"
+        "Если хотите продолжить практику — нажмите «▶️ Запустить».",
+        reply_markup=main_keyboard,
+    )
+    return msg is not None
 
-        try:
-            await bot.send_message(
-                user_id,
-                "Я рядом 🌿\n"
-                "Если хотите продолжить практику — нажмите «▶️ Запустить».",
-                reply_markup=main_keyboard,
-            )
-            db.save_nudge_sent(user_id)
-        except:
-            pass
+
+# ---------- объявления ----------
+
+# идут в паузах между слотами, курсор и итоги — в БД (см. broadcast.py)
+broadcaster = Broadcaster(sender, busy=slots_busy, active=lambda: lease.held, reply_markup=main_keyboard)
+
+@dp.message(Command("broadcast"), F.from_user.id.in_(ADMIN_IDS))
+async def cmd_broadcast(message: Message, command: CommandObject):
+    text = (command.args or "").strip()
+    if not text:
+        lines = [
+            f"#{b['id']} {b['status']}: отправлено {b['sent']}, не доставлено {b['failed']}"
+            for b in await adb.list_broadcasts(5)
+        ]
+        await message.answer("Использование: /broadcast ТЕКСТ\n\n" + ("\n".join(lines) or "Рассылок ещё не было."))
+        return
+    broadcast_id = await adb.create_broadcast(text, message.from_user.id)
+    log.info("broadcast #%s created by %s", broadcast_id, message.from_user.id)
+    await message.answer(
+        f"Рассылка #{broadcast_id} поставлена в очередь ✅\n"
+        "Она пойдёт в перерывах между вечерними вопросами; ход — /broadcast без текста."
+    )
 
 
 # ---------- restore ----------
 
-async def restore_jobs_from_db():
-    for row in db.get_active_users_for_schedule():
-        user_id = row["user_id"]
-        hhmm = row["notify_time"]
-        tz_group = row.get("timezone_group")
-        if not tz_group:
-            db.update_timezone_group(user_id, "Москва")
-        schedule_user(user_id, hhmm)
+# подписанных (активны, время выбрано) считает БД; gauge отдаёт последний подсчёт
+scheduled_users = 0
+
+async def count_scheduled_users() -> dict[tuple[str, str], int]:
+    global scheduled_users
+    sizes = await adb.get_slot_sizes()
+    scheduled_users = sum(sizes.values())
+    return sizes
+
+async def restore_jobs_from_db() -> int:
+    """
+    Задачи штатных слотов заводятся в main(); здесь — задачи нештатных слотов,
+    которые остались в users от старых версий (время не из ALLOWED_TIMES и т. п.).
+    Возвращает число подписанных.
+    """
+    started = time.monotonic()
+    await adb.backfill_timezone_groups("Москва")
+    sizes = await count_scheduled_users()
+    for hhmm, tz_group in sizes:
+        if not scheduler.get_job(f"slot:{tz_group}:{hhmm}"):
+            add_slot_job(hhmm, tz_group)
+    log.info("%s users in %s slots, restored in %.2fs", scheduled_users, len(sizes), time.monotonic() - started)
+    return scheduled_users
 
 
 # ---------- main ----------
 
-async def main():
-    await bot.delete_webhook(drop_pending_updates=True)
+async def log_first_update(handler, event, data):
+    # время от старта процесса до первого обработанного апдейта (для оценки простоя при деплое)
+    if not first_update_seen.is_set():
+        first_update_seen.set()
+        log.info("first update %.2fs after start", time.monotonic() - STARTED_AT)
+    return await handler(event, data)
+
+first_update_seen = asyncio.Event()
+dp.update.outer_middleware(log_first_update)
+
+# запись апдейтов для bench/replay.py — всех, в том числе тех, что отсечёт throttle
+recorder = None
+if RECORD_FILE:
+    recorder = Recorder(RECORD_FILE, keep_texts={
+        b.text for kb in (main_keyboard, region_keyboard, time_keyboard) for row in kb.keyboard for b in row
+    })
+    dp.update.outer_middleware(recorder)
+
+# флуд и перегрузка отсекаются до хендлеров (после FSM-middleware: нужно состояние)
+throttle = Throttle()
+dp.update.outer_middleware(throttle)
+
 
+# ---------- metrics ----------
+
+async def track_handler(handler, event, data):
+    # inner middleware: сюда попадаем, только когда хендлер найден
+    name = data["handler"].callback.__name__
+    started = time.perf_counter()
+    try:
+        return await handler(event, data)
+    except Exception:
+        metrics.inc("bot_handler_errors_total", handler=name)
+        raise
+    finally:
+        metrics.observe("bot_handler_seconds", time.perf_counter() - started, handler=name)
+
+dp.message.middleware(track_handler)
+dp.callback_query.middleware(track_handler)
+
+profiler = Profiler() if PROFILE_ENABLED else None
+if profiler is not None:
+    dp.message.middleware(profiler.middleware)
+    dp.callback_query.middleware(profiler.middleware)
+
+
+async def track_api_request(make_request, bot, method):
+    # все запросы к Bot API: и ответы хендлеров, и рассылки
+    name = type(method).__name__
+    started = time.perf_counter()
+    try:
+        return await make_request(bot, method)
+    except Exception as e:
+        metrics.inc("bot_api_errors_total", method=name, error=type(e).__name__)
+        raise
+    finally:
+        metrics.observe("bot_api_request_seconds", time.perf_counter() - started, method=name)
+
+bot.session.middleware(track_api_request)
+
+
+def _job_label(job_id: str) -> str:
+    # у слотов осмысленный id, у интервальных задач — имя функции
+    if job_id.startswith("slot:"):
+        return job_id
+    job = scheduler.get_job(job_id)
+    return job.name if job else job_id
+
+_job_submitted: dict[tuple[str, datetime], float] = {}
+
+def track_job(event):
+    if event.code == EVENT_JOB_SUBMITTED:
+        now = datetime.now(timezone.utc)
+        label = _job_label(event.job_id)
+        for run_time in event.scheduled_run_times:
+            # опоздание относительно запланированного момента (для слотов 20:00/21:00/22:00)
+            metrics.observe("bot_job_lag_seconds", (now - run_time).total_seconds(), job=label)
+            _job_submitted[(event.job_id, run_time)] = time.monotonic()
+        return
+    started = _job_submitted.pop((event.job_id, event.scheduled_run_time), None)
+    label = _job_label(event.job_id)
+    if started is not None:
+        ended = time.monotonic()
+        metrics.observe("bot_job_seconds", ended - started, job=label)
+        if profiler is not None:
+            profiler.job_done(label, started, ended)
+    if event.code == EVENT_JOB_ERROR:
+        metrics.inc("bot_job_errors_total", job=label)
+    elif event.code == EVENT_JOB_MISSED:
+        metrics.inc("bot_job_missed_total", job=label)
+
+scheduler.add_listener(track_job, EVENT_JOB_SUBMITTED | EVENT_JOB_EXECUTED | EVENT_JOB_ERROR | EVENT_JOB_MISSED)
+
+metrics.describe("bot_handler_seconds", "Handler latency")
+metrics.describe("bot_api_request_seconds", "Bot API request latency")
+metrics.describe("bot_db_call_seconds", "db.* call latency including executor queue wait")
+metrics.describe("bot_db_commit_seconds", "SQLite commit latency")
+metrics.describe("bot_job_lag_seconds", "Scheduler job start delay vs scheduled time")
+metrics.describe("bot_job_seconds", "Scheduler job run time")
+metrics.describe("bot_sends_total", "Outgoing bulk messages by result")
+metrics.describe("bot_send_retry_after_total", "TelegramRetryAfter responses in bulk sends")
+metrics.describe("bot_backup_seconds", "Database snapshot time", buckets=(1, 5, 15, 60, 300, 900, 3600))
+metrics.gauge(
+    "bot_fsm_sessions",
+    lambda: {(("state", state),): n for state, n in dp.storage.state_counts().items()},
+    "Active (in-memory) FSM sessions per state",
+)
+metrics.gauge("bot_user_cache_hits", lambda: db.user_cache_stats["hits"], "User cache hits")
+metrics.gauge("bot_user_cache_misses", lambda: db.user_cache_stats["misses"], "User cache misses")
+metrics.gauge("bot_activity_buffer", lambda: len(adb._activity), "Activity touches waiting for flush")
+metrics.gauge("bot_scheduled_users", lambda: scheduled_users, "Users in delivery slots")
+metrics.gauge("bot_throttle_users", throttle.size, "Users with a live flood-control bucket")
+metrics.gauge("bot_db_write_queue", adb.write_queue_depth, "Calls waiting for the DB writer thread")
+metrics.gauge("bot_overloaded", lambda: int(adb.overloaded), "1 while in overload mode")
+metrics.describe("bot_updates_throttled_total", "Updates dropped by flood control (rate, duplicate)")
+metrics.describe("bot_updates_shed_total", "Optional updates refused in overload mode")
+
+
+async def run_polling():
+    """
+    getUpdates отдаёт апдейт одному получателю, поэтому опрашивает только держатель
+    аренды (как с webhook апдейты принимает только он): резерв ждёт аренду, потеряв
+    её — опрос останавливается до следующего получения. Очередь апдейтов не
+    сбрасываем: в ней может быть то, что не успела забрать прошлая активная реплика.
+    """
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    signals = (signal.SIGTERM, signal.SIGINT)
+    for sig in signals:
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except NotImplementedError:  # Windows: остаётся Ctrl+C через KeyboardInterrupt
+            pass
+
+    try:
+        await bot.delete_webhook()
+        while not stop.is_set():
+            if not lease.held:
+                await asyncio.sleep(1)
+                continue
+            log.info("polling started")
+            polling = asyncio.create_task(dp.start_polling(bot, handle_signals=False, close_bot_session=False))
+            while lease.held and not stop.is_set() and not polling.done():
+                await asyncio.wait([polling], timeout=1)
+            if not polling.done():
+                await dp.stop_polling()
+            await polling
+            if not stop.is_set():
+                log.warning("polling paused: lease %s is not held", lease.name)
+    finally:
+        for sig in signals:
+            try:
+                loop.remove_signal_handler(sig)
+            except NotImplementedError:
+                pass
+
+
+async def main():
     scheduler.start()
 
     # ежедневная проверка "тихого правила" (в 10:00 UTC)
-    scheduler.add_job(check_inactive_users, trigger="cron", hour=10, minute=0)
+    scheduler.add_job(lease.only_leader(check_inactive_users), trigger="cron", hour=10, minute=0)
+
+    # write-behind для last_activity_at
+    # (при перегрузке плановый сброс пропускается, см. throttle.py)
+    scheduler.add_job(adb.flush_activity, trigger="interval", seconds=ACTIVITY_FLUSH_SECONDS, kwargs={"force": False})
+    # FSM: пачкой сохраняем изменённые сессии и выгружаем простаивающие
+    scheduler.add_job(dp.storage.maintain, trigger="interval", seconds=FSM_FLUSH_SECONDS)
+
+    # недельная сводка — в местное время каждой группы
+    if DIGEST_TIME:
+        hour, minute = map(int, DIGEST_TIME.split(":"))
+        for tz_group, zone in TZ_ZONES.items():
+            scheduler.add_job(
+                lease.only_leader(send_weekly_digest), trigger="cron", day_of_week=DIGEST_WEEKDAY, hour=hour, minute=minute,
+                timezone=zone, args=[tz_group], id=f"digest:{tz_group}",
+            )
 
-    await restore_jobs_from_db()
+    # ночью: старые ответы — в сжатый помесячный архив, старые строки журнала доставок — прочь
+    scheduler.add_job(lease.only_leader(maintenance.nightly), trigger="cron", hour=3, minute=30)
+    # снимок базы (backup API в отдельном потоке, см. backup.py)
+    if BACKUP_DIR and BACKUP_TIME:
+        hour, minute = map(int, BACKUP_TIME.split(":"))
+        scheduler.add_job(lease.only_leader(backup.run), trigger="cron", hour=hour, minute=minute)
+
+    # задачи на все штатные слоты заводим сразу, нештатные из старых строк users — restore_jobs_from_db
+    for tz_group in TZ_GROUPS:
+        for hhmm in ALLOWED_TIMES:
+            add_slot_job(hhmm, tz_group)
+
+    if profiler is not None:
+        profiler.start()
+    throttle.start()
+    if recorder is not None:
+        recorder.start()
+    # объявления (/broadcast, broadcast.py): подхватываем очередь и продолжаем после перезапуска;
+    # заходы идут один за другим в своей задаче, на резервной реплике — вхолостую
+    broadcaster.start()
+
+    metrics_runner = await metrics.serve(METRICS_HOST, METRICS_PORT) if METRICS_PORT else None
+    if METRICS_FILE:
+        scheduler.add_job(metrics.dump, trigger="interval", seconds=METRICS_DUMP_SECONDS, args=[METRICS_FILE])
+    if metrics_runner is not None or METRICS_FILE:
+        scheduler.add_job(count_scheduled_users, trigger="interval", seconds=METRICS_DUMP_SECONDS)
+
+    # polling стартует сразу, нештатные слоты добавляются в фоне
+    restore_task = asyncio.create_task(restore_jobs_from_db())
+    # старые ответы переводятся на questions.id и индексируются для поиска в фоне, кусками
+    maintenance_task = asyncio.create_task(maintenance.background())
+    # задачи планировщика выполняет только держатель аренды; получив её — досылаем пропущенное
+    lease.start()
 
     try:
-        await dp.start_polling(bot)
+        if BOT_MODE == "webhook":
+            await run_webhook(dp, bot, active=lambda: lease.held)
+        else:
+            await run_polling()
     finally:
+        scheduler.shutdown(wait=False)
+        restore_task.cancel()
+        maintenance_task.cancel()
+        # начатая пачка объявлений досылается и сохраняет курсор, пока аренда ещё наша
+        await broadcaster.stop()
+        await lease.stop()
+        throttle.stop()
+        if recorder is not None:
+            await recorder.stop()
+        if profiler is not None:
+            profiler.stop()
+        await adb.flush_activity()
+        await adb.stop_answers()
         await bot.session.close()
+        if metrics_runner is not None:
+            await metrics_runner.cleanup()
+        adb.shutdown()
 
 
 if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
     asyncio.run(main())
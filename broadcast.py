@@ -0,0 +1,156 @@
+"""
+Объявления всем активным пользователям.
+
+Рассылка — строка broadcasts: текст, статус и курсор по user_id. Долгоживущая
+задача (Broadcaster.start) раз в BROADCAST_POLL_SECONDS, пока реплика — лидер,
+берёт самую старую незавершённую и идёт по users
+пачками по BROADCAST_BATCH_SIZE (keyset по user_id). Перед отправкой пачка
+отмечается в broadcast_results ('sending'), после — итог по каждому
+получателю и новый курсор пишутся одной транзакцией. После перезапуска
+рассылка продолжается с курсора; у кого отметка уже есть, тому повторно
+не пишем (если процесс упал посреди отправки, такие остаются 'sending').
+
+Темп — BROADCAST_RATE поверх общего bucket'а Sender. Рассылки вопросов важнее:
+пока идёт слот или до ближайшего осталось меньше BROADCAST_SLOT_GUARD_SECONDS,
+объявления не отправляются (недошедшая часть пачки просто ждёт следующего захода).
+
+Запуск — /broadcast ТЕКСТ от пользователя из ADMIN_IDS или отсюда:
+
+    python broadcast.py create "Текст объявления"
+    python broadcast.py create --file announce.txt
+    python broadcast.py list
+    python broadcast.py show ID
+    python broadcast.py cancel ID
+"""
+import argparse
+import asyncio
+import logging
+from typing import Callable
+
+import adb
+import db
+from config import BROADCAST_BATCH_SIZE, BROADCAST_POLL_SECONDS, BROADCAST_RATE
+from sender import Sender, TokenBucket
+
+log = logging.getLogger(__name__)
+
+
+class Broadcaster:
+    def __init__(self, sender: Sender, busy: Callable[[], bool], active: Callable[[], bool] = lambda: True,
+                 rate: float = BROADCAST_RATE, batch_size: int = BROADCAST_BATCH_SIZE, **send_kwargs):
+        self.sender = sender
+        self.busy = busy          # True — сейчас уступаем (идёт или вот-вот начнётся слот)
+        self.active = active      # False — продолжать нельзя (потеряли аренду)
+        self.bucket = TokenBucket(rate)
+        self.batch_size = batch_size
+        self.send_kwargs = send_kwargs
+        self._stop = asyncio.Event()
+        self._task: asyncio.Task | None = None
+        self._loop: asyncio.Task | None = None
+
+    def _paused(self) -> bool:
+        return self._stop.is_set() or self.busy() or not self.active()
+
+    def start(self, poll_seconds: float = BROADCAST_POLL_SECONDS):
+        # не задача планировщика: длинная рассылка пересекала бы следующие запуски по интервалу
+        self._loop = asyncio.create_task(self._poll(poll_seconds))
+
+    async def _poll(self, poll_seconds: float):
+        while not self._stop.is_set():
+            try:
+                await self.run()
+            except Exception:
+                log.exception("broadcast run failed")
+            try:
+                await asyncio.wait_for(self._stop.wait(), poll_seconds)
+            except asyncio.TimeoutError:
+                pass
+
+    async def run(self):
+        """Один заход: продвигает рассылки, пока есть что слать и никому не мешаем."""
+        if self._task is not None:
+            return  # прошлый заход ещё идёт
+        self._task = asyncio.current_task()
+        try:
+            while not self._paused():
+                job = await adb.next_broadcast()
+                if job is None:
+                    return
+                batch = await adb.get_broadcast_recipients(job["cursor"], self.batch_size)
+                if not batch:
+                    await adb.finish_broadcast(job["id"])
+                    job = await adb.get_broadcast(job["id"])
+                    log.info("broadcast #%s done: sent=%s failed=%s", job["id"], job["sent"], job["failed"])
+                    continue
+                await self._batch(job, batch)
+        finally:
+            self._task = None
+
+    async def _batch(self, job: dict, batch: list[int]):
+        claimed = await adb.claim_broadcast(job["id"], batch)
+        attempted: set[int] = set()
+        outcomes: dict[int, str] = {}
+
+        async def deliver(user_id: int):
+            if self._paused():
+                return  # отметку снимем ниже, курсор встанет перед ним
+            await self.bucket.acquire()
+            attempted.add(user_id)
+            msg = await self.sender.send_message(user_id, job["text"], **self.send_kwargs)
+            outcomes[user_id] = "sent" if msg is not None else "failed"
+
+        try:
+            await self.sender.run(claimed, deliver, name=f"broadcast #{job['id']}")
+        finally:
+            released = [u for u in claimed if u not in attempted]
+            cursor = min(released) - 1 if released else batch[-1]
+            await adb.save_broadcast_batch(job["id"], cursor, outcomes, released)
+
+    async def stop(self, timeout: float = 10):
+        """При остановке бота: дослать начатые сообщения и сохранить курсор."""
+        self._stop.set()
+        task = self._loop or self._task
+        if task is not None:
+            await asyncio.wait({task}, timeout=timeout)
+        if self._loop is not None:
+            self._loop.cancel()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest="command", required=True)
+    create = sub.add_parser("create")
+    create.add_argument("text", nargs="?")
+    create.add_argument("--file")
+    sub.add_parser("list")
+    sub.add_parser("show").add_argument("id", type=int)
+    sub.add_parser("cancel").add_argument("id", type=int)
+    args = parser.parse_args()
+
+    if args.command == "create":
+        if args.file:
+            with open(args.file, encoding="utf-8") as f:
+                text = f.read().strip()
+        else:
+            text = (args.text or "").strip()
+        if not text:
+            parser.error("create: нужен текст или --file")
+        print(db.create_broadcast(text))
+    elif args.command == "list":
+        for b in db.list_broadcasts():
+            print(f"#{b['id']} {b['status']:<9} {b['created_at'][:16]} sent={b['sent']} failed={b['failed']} "
+                  f"cursor={b['cursor']}  {b['text'][:40]!r}")
+    elif args.command == "show":
+        b = db.get_broadcast(args.id)
+        if b is None:
+            parser.error(f"no broadcast #{args.id}")
+        for k, v in b.items():
+            print(f"{k}: {v}")
+        print(f"outcomes: {db.broadcast_outcomes(args.id)}")
+    elif args.command == "cancel":
+        if not db.finish_broadcast(args.id, "cancelled"):
+            parser.error(f"broadcast #{args.id} is not pending/running")
+
+
+if __name__ == "__main__":
+    main()
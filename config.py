@@ -1,7 +1,151 @@
 import os
+import socket
 
-BOT_TOKEN = os.environ["BOT_TOKEN"]
+# для CLI-утилит, работающих только с БД, токен не нужен; Bot() сам проверит его при старте бота
+BOT_TOKEN = os.environ.get("BOT_TOKEN", "")
 
 DEFAULT_TZ = os.environ.get("DEFAULT_TZ", "Europe/Moscow")
+
+# Грубые регионы -> timezone
+TZ_GROUPS = {
+    "Москва": "Europe/Moscow",
+    "Европа": "Europe/Berlin",
+    "Азия": "Asia/Almaty",
+    "Америка": "America/New_York",
+}
+
 INACTIVE_DAYS = int(os.environ.get("INACTIVE_DAYS", "7"))
 NUDGE_COOLDOWN_DAYS = int(os.environ.get("NUDGE_COOLDOWN_DAYS", "7"))
+# сколько кандидатов на пинг выбирать и отправлять за один заход
+NUDGE_CHUNK_SIZE = int(os.environ.get("NUDGE_CHUNK_SIZE", "1000"))
+
+DB_PATH = os.environ.get("DB_PATH", "users.db")
+# потоки только для чтения; запись всегда идёт через один поток-писатель
+DB_READ_THREADS = int(os.environ.get("DB_READ_THREADS", "4"))
+# group commit ответов: сколько ждать попутчиков и максимум строк в одной транзакции
+GROUP_COMMIT_MS = float(os.environ.get("GROUP_COMMIT_MS", "2"))
+GROUP_COMMIT_MAX_ROWS = int(os.environ.get("GROUP_COMMIT_MAX_ROWS", "256"))
+# как часто буфер last_activity_at сбрасывается в БД
+ACTIVITY_FLUSH_SECONDS = int(os.environ.get("ACTIVITY_FLUSH_SECONDS", "5"))
+# сколько строк users держать в LRU-кэше перед db.get_user
+USER_CACHE_SIZE = int(os.environ.get("USER_CACHE_SIZE", "50000"))
+# рассылки: общий лимит сообщений в секунду (запас под ответы хендлеров),
+# число одновременных воркеров и повторы при сетевых ошибках
+SEND_RATE = float(os.environ.get("SEND_RATE", "25"))
+SEND_WORKERS = int(os.environ.get("SEND_WORKERS", "50"))
+SEND_MAX_RETRIES = int(os.environ.get("SEND_MAX_RETRIES", "3"))
+# FSM: сколько сессий держать в памяти, через сколько секунд простоя выгружать,
+# как часто сбрасывать изменения в БД
+FSM_CACHE_SIZE = int(os.environ.get("FSM_CACHE_SIZE", "20000"))
+FSM_IDLE_SECONDS = int(os.environ.get("FSM_IDLE_SECONDS", "1800"))
+FSM_FLUSH_SECONDS = float(os.environ.get("FSM_FLUSH_SECONDS", "1"))
+# SQLite: ожидание блокировки, кэш страниц на соединение, mmap, режим synchronous
+DB_BUSY_TIMEOUT_MS = int(os.environ.get("DB_BUSY_TIMEOUT_MS", "5000"))
+DB_CACHE_SIZE_KB = int(os.environ.get("DB_CACHE_SIZE_KB", "16384"))
+DB_MMAP_SIZE = int(os.environ.get("DB_MMAP_SIZE", str(256 * 1024 * 1024)))
+DB_SYNCHRONOUS = os.environ.get("DB_SYNCHRONOUS", "NORMAL")
+
+# приём апдейтов: "polling" (по умолчанию) или "webhook"
+BOT_MODE = os.environ.get("BOT_MODE", "polling")
+WEBHOOK_HOST = os.environ.get("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.environ.get("WEBHOOK_PORT", "8080"))
+WEBHOOK_PATH = os.environ.get("WEBHOOK_PATH", "/webhook")
+# публичный адрес для setWebhook; пусто — webhook настраивается снаружи.
+# С WEBHOOK_URL обязателен и WEBHOOK_SECRET (1–256 символов A-Z a-z 0-9 _ -): без него
+# поддельные апдейты примет любой, кто узнал адрес. Один на все реплики
+WEBHOOK_URL = os.environ.get("WEBHOOK_URL", "")
+WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET", "")
+# число партиций (= параллельно обрабатываемых пользователей) и общий размер очереди
+WEBHOOK_WORKERS = int(os.environ.get("WEBHOOK_WORKERS", "64"))
+WEBHOOK_QUEUE_SIZE = int(os.environ.get("WEBHOOK_QUEUE_SIZE", "4096"))
+# другой адрес Bot API (локальный сервер или заглушка для тестов)
+TELEGRAM_API_URL = os.environ.get("TELEGRAM_API_URL", "")
+
+# метрики Prometheus: HTTP /metrics (0 — выключено) и/или периодический дамп в файл
+METRICS_HOST = os.environ.get("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.environ.get("METRICS_PORT", "0"))
+METRICS_FILE = os.environ.get("METRICS_FILE", "")
+METRICS_DUMP_SECONDS = int(os.environ.get("METRICS_DUMP_SECONDS", "15"))
+
+# профилирование медленных путей (см. profiler.py)
+PROFILE_ENABLED = os.environ.get("PROFILE_ENABLED", "0") == "1"
+PROFILE_SAMPLE_RATE = float(os.environ.get("PROFILE_SAMPLE_RATE", "0.001"))
+PROFILE_SLOW_MS = int(os.environ.get("PROFILE_SLOW_MS", "500"))
+PROFILE_INTERVAL_MS = int(os.environ.get("PROFILE_INTERVAL_MS", "10"))
+LOOP_BLOCK_MS = int(os.environ.get("LOOP_BLOCK_MS", "100"))
+PROFILE_DIR = os.environ.get("PROFILE_DIR", "profiles")
+PROFILE_KEEP = int(os.environ.get("PROFILE_KEEP", "200"))
+
+# история ответов: ответы старше ARCHIVE_AFTER_DAYS (0 — не архивировать) раз в сутки
+# сжимаются в помесячные блоки answers_archive; перенос старых строк на questions.id —
+# кусками по MAINTENANCE_CHUNK_SIZE, чтобы не держать блокировку записи
+ARCHIVE_AFTER_DAYS = int(os.environ.get("ARCHIVE_AFTER_DAYS", "180"))
+MAINTENANCE_CHUNK_SIZE = int(os.environ.get("MAINTENANCE_CHUNK_SIZE", "2000"))
+
+# недельная сводка за прошедшую неделю (пн–вс): день недели (mon..sun) и местное время отправки;
+# пустое время — выключено. По умолчанию утро понедельника — после всех слотов воскресенья
+# и до того, как неделя в user_stats начнётся заново
+DIGEST_WEEKDAY = os.environ.get("DIGEST_WEEKDAY", "mon")
+DIGEST_TIME = os.environ.get("DIGEST_TIME", "09:00")
+DIGEST_CHUNK_SIZE = int(os.environ.get("DIGEST_CHUNK_SIZE", "5000"))
+
+# /history: ответов на страницу; /export: одновременных выгрузок на весь бот
+HISTORY_PAGE_SIZE = int(os.environ.get("HISTORY_PAGE_SIZE", "8"))
+EXPORT_CONCURRENCY = int(os.environ.get("EXPORT_CONCURRENCY", "2"))
+# /search: результатов на страницу
+SEARCH_PAGE_SIZE = int(os.environ.get("SEARCH_PAGE_SIZE", "5"))
+
+# несколько реплик: задачи планировщика выполняет держатель аренды (см. lease.py)
+INSTANCE_ID = os.environ.get("INSTANCE_ID", f"{socket.gethostname()}:{os.getpid()}")
+LEASE_TTL_SECONDS = float(os.environ.get("LEASE_TTL_SECONDS", "15"))
+# после простоя пропущенные сегодня слоты досылаются, если опоздание не больше стольких часов (0 — не досылать)
+CATCHUP_HOURS = float(os.environ.get("CATCHUP_HOURS", "3"))
+# сколько дней хранить журнал доставок
+DELIVERIES_KEEP_DAYS = int(os.environ.get("DELIVERIES_KEEP_DAYS", "14"))
+SLOT_CHUNK_SIZE = int(os.environ.get("SLOT_CHUNK_SIZE", "5000"))
+
+# дополнительные наборы вопросов (JSON, см. flows.py); пусто — только встроенный
+FLOWS_FILE = os.environ.get("FLOWS_FILE", "")
+
+# защита от флуда (см. throttle.py): на пользователя THROTTLE_BURST апдейтов подряд,
+# дальше — THROTTLE_RATE в секунду; одинаковый ответ, повторённый в течение
+# DEDUP_SECONDS, не сохраняется второй раз (0 — не проверять)
+THROTTLE_RATE = float(os.environ.get("THROTTLE_RATE", "1"))
+THROTTLE_BURST = int(os.environ.get("THROTTLE_BURST", "10"))
+THROTTLE_IDLE_SECONDS = int(os.environ.get("THROTTLE_IDLE_SECONDS", "600"))
+DEDUP_SECONDS = float(os.environ.get("DEDUP_SECONDS", "10"))
+# режим перегрузки: отставание event loop или очередь к потоку-писателю больше порога
+OVERLOAD_LAG_MS = int(os.environ.get("OVERLOAD_LAG_MS", "250"))
+OVERLOAD_DB_QUEUE = int(os.environ.get("OVERLOAD_DB_QUEUE", "500"))
+
+# резервные копии (см. backup.py): каталог (пусто — выключено), время запуска (UTC),
+# сколько последних снимков хранить; копирование — по BACKUP_STEP_PAGES страниц
+# с паузой BACKUP_STEP_SLEEP_MS, BACKUP_VACUUM=1 — сжимать снимок через VACUUM INTO
+BACKUP_DIR = os.environ.get("BACKUP_DIR", "backups")
+BACKUP_TIME = os.environ.get("BACKUP_TIME", "04:00")
+BACKUP_KEEP = int(os.environ.get("BACKUP_KEEP", "7"))
+BACKUP_STEP_PAGES = int(os.environ.get("BACKUP_STEP_PAGES", "1024"))
+BACKUP_STEP_SLEEP_MS = int(os.environ.get("BACKUP_STEP_SLEEP_MS", "5"))
+BACKUP_VACUUM = os.environ.get("BACKUP_VACUUM", "1") == "1"
+
+# запись входящих апдейтов для bench/replay.py (см. recorder.py): файл JSONL (пусто — выключено);
+# RECORD_ANONYMIZE=1 — id пользователей и свободный текст заменяются; RECORD_SALT — ключ замены
+# (одинаковый ключ даёт одинаковые подмены между перезапусками)
+RECORD_FILE = os.environ.get("RECORD_FILE", "")
+RECORD_ANONYMIZE = os.environ.get("RECORD_ANONYMIZE", "1") == "1"
+RECORD_SALT = os.environ.get("RECORD_SALT", "")
+RECORD_FLUSH_SECONDS = float(os.environ.get("RECORD_FLUSH_SECONDS", "1"))
+
+# аналитика (см. analytics.py): каталог отчётов, размер куска и пауза между кусками
+ANALYTICS_DIR = os.environ.get("ANALYTICS_DIR", "reports")
+ANALYTICS_CHUNK_SIZE = int(os.environ.get("ANALYTICS_CHUNK_SIZE", "5000"))
+ANALYTICS_PAUSE_MS = int(os.environ.get("ANALYTICS_PAUSE_MS", "5"))
+
+# объявления всем активным (см. broadcast.py): кто может запускать /broadcast (id через запятую),
+# темп (поверх общего SEND_RATE), размер пачки, как часто лидер проверяет очередь и за сколько
+# секунд до слота объявления останавливаются
+ADMIN_IDS = {int(x) for x in os.environ.get("ADMIN_IDS", "").replace(" ", "").split(",") if x}
+BROADCAST_RATE = float(os.environ.get("BROADCAST_RATE", "10"))
+BROADCAST_BATCH_SIZE = int(os.environ.get("BROADCAST_BATCH_SIZE", "200"))
+BROADCAST_POLL_SECONDS = int(os.environ.get("BROADCAST_POLL_SECONDS", "30"))
+BROADCAST_SLOT_GUARD_SECONDS = int(os.environ.get("BROADCAST_SLOT_GUARD_SECONDS", "120"))
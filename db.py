@@ -1,17 +1,67 @@
+import json
+import re
 import sqlite3
-from datetime import datetime
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from contextlib import contextmanager
+from datetime import date, datetime, timedelta
 
-conn = sqlite3.connect("users.db")
-conn.row_factory = sqlite3.Row
-cur = conn.cursor()
+import metrics
+from config import (
+    DB_PATH, USER_CACHE_SIZE, DB_BUSY_TIMEOUT_MS, DB_CACHE_SIZE_KB, DB_MMAP_SIZE, DB_SYNCHRONOUS,
+)
+
+# Функции модуля синхронные и вызываются из потоков adb.py:
+# у каждого потока своё соединение (sqlite3 не любит общий курсор между потоками).
+_local = threading.local()
+_conns: list[sqlite3.Connection] = []
+_conns_lock = threading.Lock()
+
+
+def connect() -> sqlite3.Connection:
+    c = sqlite3.connect(DB_PATH, timeout=DB_BUSY_TIMEOUT_MS / 1000, check_same_thread=False)
+    c.row_factory = sqlite3.Row
+    # WAL: читатели не ждут писателя; с WAL synchronous=NORMAL не теряет целостность
+    c.execute("PRAGMA journal_mode=WAL")
+    c.execute(f"PRAGMA synchronous={DB_SYNCHRONOUS}")
+    c.execute(f"PRAGMA busy_timeout={DB_BUSY_TIMEOUT_MS}")
+    c.execute(f"PRAGMA cache_size=-{DB_CACHE_SIZE_KB}")
+    c.execute(f"PRAGMA mmap_size={DB_MMAP_SIZE}")
+    c.execute("PRAGMA temp_store=MEMORY")
+    return c
+
+
+def _conn() -> sqlite3.Connection:
+    c = getattr(_local, "conn", None)
+    if c is None:
+        c = _local.conn = connect()
+        with _conns_lock:
+            _conns.append(c)
+    return c
+
+
+def close_all():
+    with _conns_lock:
+        for c in _conns:
+            c.close()
+        _conns.clear()
 
 
 def _has_column(table: str, col: str) -> bool:
-    cur.execute(f"PRAGMA table_info({table})")
+    cur = _conn().execute(f"PRAGMA table_info({table})")
     return any(r["name"] == col for r in cur.fetchall())
 
 
-def migrate():
+# ---------- миграции ----------
+
+# Версия схемы хранится в PRAGMA user_version: при старте выполняются только
+# шаги с номером больше текущего, каждый — в своей транзакции.
+# Новые изменения схемы — только новым шагом в конец MIGRATIONS.
+
+def _m1_baseline(cur: sqlite3.Cursor):
+    # схема до версионирования; идемпотентна, т.к. старые базы могут быть в любом виде
     # базовая users (может быть старой)
     cur.execute("""
     CREATE TABLE IF NOT EXISTS users (
@@ -58,7 +108,191 @@ def migrate():
     )
     """)
 
-    conn.commit()
+    # FSM-сессии (storage.SQLiteStorage); key — DefaultKeyBuilder aiogram
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS fsm_sessions (
+        key TEXT PRIMARY KEY,
+        state TEXT,
+        data TEXT NOT NULL,                 -- JSON
+        updated_at TEXT NOT NULL
+    )
+    """)
+
+
+def _m2_indexes(cur: sqlite3.Cursor):
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_answers_user_date_q ON answers(user_id, session_date, q_index)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_users_active_notify ON users(is_active, notify_time)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_users_active_activity ON users(is_active, last_activity_at)")
+
+
+def _m3_questions(cur: sqlite3.Cursor):
+    # тексты вопросов — один раз в questions, в answers только ссылка;
+    # старые строки переводятся на question_id кусками (normalize_answers_chunk)
+    cur.execute("""
+    CREATE TABLE question_sets (
+        id INTEGER PRIMARY KEY,
+        name TEXT NOT NULL UNIQUE
+    )
+    """)
+    cur.execute("""
+    CREATE TABLE questions (
+        id INTEGER PRIMARY KEY,
+        set_id INTEGER NOT NULL REFERENCES question_sets(id),
+        q_index INTEGER NOT NULL,
+        text TEXT NOT NULL,
+        UNIQUE (set_id, q_index, text)
+    )
+    """)
+    cur.execute("ALTER TABLE answers ADD COLUMN question_id INTEGER REFERENCES questions(id)")
+
+    # архив: ответы пользователя за месяц — один zlib-сжатый JSON
+    cur.execute("""
+    CREATE TABLE answers_archive (
+        user_id INTEGER NOT NULL,
+        month TEXT NOT NULL,                -- YYYY-MM (по session_date)
+        rows INTEGER NOT NULL,
+        data BLOB NOT NULL,
+        archived_at TEXT NOT NULL,
+        PRIMARY KEY (user_id, month)
+    ) WITHOUT ROWID
+    """)
+
+    # служебные значения (прогресс фоновых переносов и т.п.)
+    cur.execute("""
+    CREATE TABLE meta (
+        key TEXT PRIMARY KEY,
+        value TEXT NOT NULL
+    )
+    """)
+
+
+def _m4_user_stats(cur: sqlite3.Cursor):
+    # счётчики обновляются по ходу (record_day, save_answers_many) — answers для них не сканируются
+    cur.execute("""
+    CREATE TABLE user_stats (
+        user_id INTEGER PRIMARY KEY,
+        current_streak INTEGER NOT NULL DEFAULT 0,
+        longest_streak INTEGER NOT NULL DEFAULT 0,
+        streak_date TEXT,                   -- последний день серии (выполнен или пропущен)
+        completed_days INTEGER NOT NULL DEFAULT 0,
+        skipped_days INTEGER NOT NULL DEFAULT 0,
+        sessions_started INTEGER NOT NULL DEFAULT 0,
+        last_completed_date TEXT,
+        last_skipped_date TEXT,
+        week_start TEXT,                    -- понедельник текущей недели (локальная дата)
+        week_completed INTEGER NOT NULL DEFAULT 0,
+        week_skipped INTEGER NOT NULL DEFAULT 0,
+        updated_at TEXT NOT NULL
+    )
+    """)
+
+
+def _m5_search(cur: sqlite3.Cursor):
+    # полнотекстовый поиск; rowid = answers.id. Пишется из save_answers_many, а не триггерами:
+    # архивация удаляет строки из answers, а искать по ним всё равно нужно.
+    # owner — токен вида u123, чтобы MATCH сразу ограничивался одним пользователем
+    cur.execute("""
+    CREATE VIRTUAL TABLE answers_fts USING fts5(
+        answer,
+        owner,
+        session_date UNINDEXED,
+        q_index UNINDEXED,
+        tokenize = 'unicode61 remove_diacritics 2',
+        prefix = '2 3'
+    )
+    """)
+    # старые строки индексируются в фоне (search_backfill_chunk): сначала answers до этого id,
+    # затем answers_archive
+    until = cur.execute("SELECT COALESCE(MAX(id), 0) FROM answers").fetchone()[0]
+    cur.executemany(
+        "INSERT INTO meta (key, value) VALUES (?, ?)",
+        [("search_backfill_until", str(until)), ("search_backfill_after", "0"), ("search_archive_after", "")]
+    )
+
+
+def _m6_replicas(cur: sqlite3.Cursor):
+    # аренда: задачи планировщика выполняет только держатель (lease.py)
+    cur.execute("""
+    CREATE TABLE leases (
+        name TEXT PRIMARY KEY,
+        holder TEXT NOT NULL,
+        expires_at REAL NOT NULL            -- unix time
+    )
+    """)
+    # журнал доставок: одна строка на (дата, вид, пользователь) — повторная отправка
+    # с другой реплики или после перезапуска отсекается уникальностью
+    cur.execute("""
+    CREATE TABLE deliveries (
+        local_date TEXT NOT NULL,           -- YYYY-MM-DD (локальная дата пользователя)
+        kind TEXT NOT NULL,
+        user_id INTEGER NOT NULL,
+        sent_at TEXT NOT NULL,
+        PRIMARY KEY (local_date, kind, user_id)
+    ) WITHOUT ROWID
+    """)
+    # до этого момента журнала не было: догонять более ранние слоты нельзя
+    cur.execute("INSERT INTO meta (key, value) VALUES ('deliveries_since', ?)", (datetime.utcnow().isoformat(),))
+
+
+def _m7_flows(cur: sqlite3.Cursor):
+    # вариант набора вопросов (flows.FLOWS); NULL — набор по умолчанию
+    cur.execute("ALTER TABLE users ADD COLUMN flow_id TEXT")
+
+
+def _m8_broadcasts(cur: sqlite3.Cursor):
+    # объявления всем активным: задание с курсором по user_id (докуда дошли)
+    cur.execute("""
+    CREATE TABLE broadcasts (
+        id INTEGER PRIMARY KEY,
+        text TEXT NOT NULL,
+        created_by INTEGER,
+        created_at TEXT NOT NULL,
+        status TEXT NOT NULL DEFAULT 'pending', -- pending | running | done | cancelled
+        cursor INTEGER NOT NULL DEFAULT 0,      -- все user_id <= cursor обработаны
+        sent INTEGER NOT NULL DEFAULT 0,
+        failed INTEGER NOT NULL DEFAULT 0,
+        started_at TEXT,
+        finished_at TEXT
+    )
+    """)
+    # итог по каждому получателю; строка 'sending' ставится до отправки (как в deliveries),
+    # поэтому после падения посреди пачки уже отправленным повторно не пишем
+    cur.execute("""
+    CREATE TABLE broadcast_results (
+        broadcast_id INTEGER NOT NULL,
+        user_id INTEGER NOT NULL,
+        outcome TEXT NOT NULL,                  -- sending | sent | failed
+        at TEXT NOT NULL,
+        PRIMARY KEY (broadcast_id, user_id)
+    ) WITHOUT ROWID
+    """)
+
+
+MIGRATIONS = [
+    _m1_baseline,
+    _m2_indexes,
+    _m3_questions,
+    _m4_user_stats,
+    _m5_search,
+    _m6_replicas,
+    _m7_flows,
+    _m8_broadcasts,
+]
+
+
+def migrate():
+    conn = _conn()
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    for number, step in enumerate(MIGRATIONS[version:], start=version + 1):
+        cur = conn.cursor()
+        cur.execute("BEGIN")
+        try:
+            step(cur)
+            cur.execute(f"PRAGMA user_version={number}")
+        except Exception:
+            conn.rollback()
+            raise
+        conn.commit()
 
 
 migrate()
@@ -68,123 +302,934 @@ def now_utc_iso() -> str:
     return datetime.utcnow().isoformat()
 
 
+def _commit(conn: sqlite3.Connection):
+    with metrics.timer("bot_db_commit_seconds"):
+        conn.commit()
+
+
+@contextmanager
+def _write_tx():
+    # запись без явного BEGIN идёт в неявной транзакции sqlite3: если запрос упал,
+    # транзакция остаётся открытой и следующий BEGIN в потоке писателя падает — откатываем
+    conn = _conn()
+    try:
+        yield conn
+        _commit(conn)
+    except Exception:
+        conn.rollback()
+        raise
+
+
+# ---------- кэш пользователей ----------
+
+# LRU строк users: читают их на каждом шаге, а меняются они редко.
+# Каждая запись в users после commit инвалидирует строку; счётчик поколений
+# не даёт читателю положить в кэш строку, прочитанную до чужой записи.
+_user_cache: OrderedDict[int, dict] = OrderedDict()
+_cache_lock = threading.Lock()
+_cache_gen = 0
+user_cache_stats = {"hits": 0, "misses": 0}
+
+
+def cached_user(user_id: int) -> dict | None:
+    # только из кэша, без похода в БД (можно звать прямо из event loop)
+    with _cache_lock:
+        row = _user_cache.get(user_id)
+        if row is None:
+            return None
+        _user_cache.move_to_end(user_id)
+        user_cache_stats["hits"] += 1
+        return dict(row)
+
+
+def _cache_put(user_id: int, row: dict, gen: int):
+    with _cache_lock:
+        if gen != _cache_gen:
+            return
+        _user_cache[user_id] = row
+        _user_cache.move_to_end(user_id)
+        while len(_user_cache) > USER_CACHE_SIZE:
+            _user_cache.popitem(last=False)
+
+
+def _invalidate(*user_ids: int):
+    global _cache_gen
+    with _cache_lock:
+        _cache_gen += 1
+        for user_id in user_ids:
+            _user_cache.pop(user_id, None)
+
+
+def _invalidate_all():
+    global _cache_gen
+    with _cache_lock:
+        _cache_gen += 1
+        _user_cache.clear()
+
+
+def reset_user_cache():
+    # реплика стала активной: пока активной была другая, строки могли поменяться
+    _invalidate_all()
+
+
+def _cache_touch(rows: list[tuple[int, str]]):
+    # активность меняется постоянно — обновляем строки на месте, а не выкидываем
+    global _cache_gen
+    with _cache_lock:
+        _cache_gen += 1
+        for user_id, ts in rows:
+            row = _user_cache.get(user_id)
+            if row is not None:
+                row["last_activity_at"] = ts
+                row["updated_at"] = ts
+
+
 def upsert_user(user_id: int, notify_time: str | None, timezone_group: str | None, is_active: int):
-    cur.execute(
-        """
-        INSERT INTO users (user_id, notify_time, timezone_group, is_active, updated_at, last_activity_at)
-        VALUES (?, ?, ?, ?, ?, ?)
-        ON CONFLICT(user_id) DO UPDATE SET
-            notify_time=excluded.notify_time,
-            timezone_group=excluded.timezone_group,
-            is_active=excluded.is_active,
-            updated_at=excluded.updated_at
-        """,
-        (user_id, notify_time, timezone_group, is_active, now_utc_iso(), now_utc_iso())
-    )
-    conn.commit()
+    with _write_tx() as conn:
+        conn.execute(
+            """
+            INSERT INTO users (user_id, notify_time, timezone_group, is_active, updated_at, last_activity_at)
+            VALUES (?, ?, ?, ?, ?, ?)
+            ON CONFLICT(user_id) DO UPDATE SET
+                notify_time=excluded.notify_time,
+                timezone_group=excluded.timezone_group,
+                is_active=excluded.is_active,
+                updated_at=excluded.updated_at
+            """,
+            (user_id, notify_time, timezone_group, is_active, now_utc_iso(), now_utc_iso())
+        )
+    _invalidate(user_id)
 
 
 def get_user(user_id: int):
-    cur.execute("SELECT * FROM users WHERE user_id=?", (user_id,))
-    row = cur.fetchone()
-    return dict(row) if row else None
+    u = cached_user(user_id)
+    if u is not None:
+        return u
+    with _cache_lock:
+        user_cache_stats["misses"] += 1
+        gen = _cache_gen
+    conn = _conn()
+    row = conn.execute("SELECT * FROM users WHERE user_id=?", (user_id,)).fetchone()
+    if row is None:
+        return None
+    u = dict(row)
+    _cache_put(user_id, u, gen)
+    return dict(u)
 
 
 def set_active(user_id: int, is_active: int):
-    cur.execute(
-        "UPDATE users SET is_active=?, updated_at=? WHERE user_id=?",
-        (is_active, now_utc_iso(), user_id)
-    )
-    conn.commit()
+    with _write_tx() as conn:
+        conn.execute(
+            "UPDATE users SET is_active=?, updated_at=? WHERE user_id=?",
+            (is_active, now_utc_iso(), user_id)
+        )
+    _invalidate(user_id)
 
 
 def update_timezone_group(user_id: int, timezone_group: str):
-    u = get_user(user_id)
-    if u is None:
-        upsert_user(user_id, None, timezone_group, 1)
-        return
-    cur.execute(
-        "UPDATE users SET timezone_group=?, updated_at=? WHERE user_id=?",
-        (timezone_group, now_utc_iso(), user_id)
-    )
-    conn.commit()
+    # нет пользователя -> создаём (как upsert_user), есть -> меняем только группу
+    with _write_tx() as conn:
+        now = now_utc_iso()
+        conn.execute(
+            """
+            INSERT INTO users (user_id, notify_time, timezone_group, is_active, updated_at, last_activity_at)
+            VALUES (?, NULL, ?, 1, ?, ?)
+            ON CONFLICT(user_id) DO UPDATE SET
+                timezone_group=excluded.timezone_group,
+                updated_at=excluded.updated_at
+            """,
+            (user_id, timezone_group, now, now)
+        )
+    _invalidate(user_id)
 
 
 def update_notify_time(user_id: int, notify_time: str):
-    u = get_user(user_id)
-    if u is None:
-        upsert_user(user_id, notify_time, "Москва", 1)
-        return
-    cur.execute(
-        "UPDATE users SET notify_time=?, is_active=1, updated_at=? WHERE user_id=?",
-        (notify_time, now_utc_iso(), user_id)
-    )
-    conn.commit()
+    with _write_tx() as conn:
+        now = now_utc_iso()
+        conn.execute(
+            """
+            INSERT INTO users (user_id, notify_time, timezone_group, is_active, updated_at, last_activity_at)
+            VALUES (?, ?, 'Москва', 1, ?, ?)
+            ON CONFLICT(user_id) DO UPDATE SET
+                notify_time=excluded.notify_time,
+                is_active=1,
+                updated_at=excluded.updated_at
+            """,
+            (user_id, notify_time, now, now)
+        )
+    _invalidate(user_id)
 
 
-def touch_activity(user_id: int):
-    u = get_user(user_id)
-    if u is None:
-        upsert_user(user_id, None, "Москва", 1)
-        return
-    cur.execute(
-        "UPDATE users SET last_activity_at=?, updated_at=? WHERE user_id=?",
-        (now_utc_iso(), now_utc_iso(), user_id)
-    )
-    conn.commit()
+def touch_activity_many(rows: list[tuple[int, str]]):
+    # rows: (user_id, last_activity_at) — одна транзакция на всю пачку;
+    # отсутствующих пользователей создаём активными, без времени рассылки
+    with _write_tx() as conn:
+        conn.executemany(
+            """
+            INSERT INTO users (user_id, notify_time, timezone_group, is_active, updated_at, last_activity_at)
+            VALUES (?1, NULL, 'Москва', 1, ?2, ?2)
+            ON CONFLICT(user_id) DO UPDATE SET
+                last_activity_at=excluded.last_activity_at,
+                updated_at=excluded.updated_at
+            """,
+            rows
+        )
+    _cache_touch(rows)
+
+
+def set_flow(user_id: int, flow_id: str | None):
+    with _write_tx() as conn:
+        conn.execute(
+            "UPDATE users SET flow_id=?, updated_at=? WHERE user_id=?",
+            (flow_id, now_utc_iso(), user_id)
+        )
+    _invalidate(user_id)
 
 
 def set_skip_date(user_id: int, skip_date: str):
-    u = get_user(user_id)
-    if u is None:
-        upsert_user(user_id, None, "Москва", 1)
-    cur.execute(
-        "UPDATE users SET skip_date=?, updated_at=? WHERE user_id=?",
-        (skip_date, now_utc_iso(), user_id)
-    )
-    conn.commit()
+    with _write_tx() as conn:
+        now = now_utc_iso()
+        conn.execute(
+            """
+            INSERT INTO users (user_id, notify_time, timezone_group, is_active, updated_at, last_activity_at, skip_date)
+            VALUES (?, NULL, 'Москва', 1, ?, ?, ?)
+            ON CONFLICT(user_id) DO UPDATE SET
+                skip_date=excluded.skip_date,
+                updated_at=excluded.updated_at
+            """,
+            (user_id, now, now, skip_date)
+        )
+    _invalidate(user_id)
 
 
 def clear_skip_date(user_id: int):
-    cur.execute(
-        "UPDATE users SET skip_date=NULL, updated_at=? WHERE user_id=?",
-        (now_utc_iso(), user_id)
-    )
-    conn.commit()
+    with _write_tx() as conn:
+        conn.execute(
+            "UPDATE users SET skip_date=NULL, updated_at=? WHERE user_id=?",
+            (now_utc_iso(), user_id)
+        )
+    _invalidate(user_id)
 
 
-def save_nudge_sent(user_id: int):
-    cur.execute(
-        "UPDATE users SET last_nudge_at=?, updated_at=? WHERE user_id=?",
-        (now_utc_iso(), now_utc_iso(), user_id)
-    )
-    conn.commit()
+def backfill_timezone_groups(default_group: str) -> int:
+    # одним запросом вместо update_timezone_group на каждого старого пользователя
+    with _write_tx() as conn:
+        cur = conn.execute(
+            """
+            UPDATE users SET timezone_group=?, updated_at=?
+            WHERE is_active=1 AND notify_time IS NOT NULL AND (timezone_group IS NULL OR timezone_group='')
+            """,
+            (default_group, now_utc_iso())
+        )
+    if cur.rowcount:
+        _invalidate_all()
+    return cur.rowcount
 
 
-def get_active_users_for_schedule():
-    cur.execute("""
-        SELECT user_id, notify_time, timezone_group, skip_date
+def get_slot_sizes() -> dict[tuple[str, str], int]:
+    # (notify_time, timezone_group) -> активных подписанных, одним GROUP BY по idx_users_active_notify
+    cur = _conn().execute("""
+        SELECT notify_time, COALESCE(NULLIF(timezone_group, ''), 'Москва'), COUNT(*)
         FROM users
         WHERE is_active=1 AND notify_time IS NOT NULL
+        GROUP BY 1, 2
     """)
-    return [dict(r) for r in cur.fetchall()]
+    return {(r[0], r[1]): r[2] for r in cur.fetchall()}
 
 
-def get_users_for_nudge():
-    cur.execute("""
-        SELECT user_id, is_active, last_activity_at, last_nudge_at
+def get_slot_users_page(hhmm: str, tz_group: str, after_user_id: int, limit: int) -> list[int]:
+    # получатели слота прямо из БД (по idx_users_active_notify), keyset по user_id
+    cur = _conn().execute("""
+        SELECT user_id
+        FROM users
+        WHERE is_active=1 AND notify_time=? AND user_id > ?
+          AND COALESCE(NULLIF(timezone_group, ''), 'Москва') = ?
+        ORDER BY user_id
+        LIMIT ?
+    """, (hhmm, after_user_id, tz_group, limit))
+    return [r[0] for r in cur.fetchall()]
+
+
+def get_users_for_nudge_page(activity_before: str, nudge_before: str, after: tuple[str, int] | None, limit: int):
+    """
+    Страница кандидатов на мягкий пинг: активны, молчат с activity_before и
+    не пинговались с nudge_before. Метки ISO-8601 в UTC сравниваются как строки.
+    Keyset по (last_activity_at, user_id) идёт прямо по idx_users_active_activity.
+    """
+    last_activity, last_user = after or ("", 0)
+    conn = _conn()
+    cur = conn.execute("""
+        SELECT user_id, last_activity_at
         FROM users
         WHERE is_active=1
-    """)
+          AND last_activity_at < ? AND last_activity_at >= ? AND last_activity_at <> ''
+          AND (last_activity_at > ? OR user_id > ?)
+          AND (last_nudge_at IS NULL OR last_nudge_at < ?)
+        ORDER BY last_activity_at, user_id
+        LIMIT ?
+    """, (activity_before, last_activity, last_activity, last_user, nudge_before, limit))
     return [dict(r) for r in cur.fetchall()]
 
 
-def save_answer(user_id: int, session_date: str, q_index: int, question: str, answer: str):
-    cur.execute(
+def save_nudge_sent_many(user_ids: list[int]):
+    with _write_tx() as conn:
+        now = now_utc_iso()
+        conn.executemany(
+            "UPDATE users SET last_nudge_at=?, updated_at=? WHERE user_id=?",
+            [(now, now, user_id) for user_id in user_ids]
+        )
+    _invalidate(*user_ids)
+
+
+# ---------- вопросы ----------
+
+DEFAULT_QUESTION_SET = "default"
+
+# (набор, номер, текст) -> questions.id; пишет в questions только поток-писатель
+_question_ids: dict[tuple[str, int, str], int] = {}
+
+
+def question_id(conn: sqlite3.Connection, q_index: int, text: str, set_name: str = DEFAULT_QUESTION_SET) -> int:
+    # вызывается внутри транзакции писателя: новый текст вопроса закоммитится вместе с ответом
+    key = (set_name, q_index, text)
+    qid = _question_ids.get(key)
+    if qid is not None:
+        return qid
+    conn.execute("INSERT OR IGNORE INTO question_sets (name) VALUES (?)", (set_name,))
+    set_id = conn.execute("SELECT id FROM question_sets WHERE name=?", (set_name,)).fetchone()[0]
+    conn.execute(
+        "INSERT OR IGNORE INTO questions (set_id, q_index, text) VALUES (?, ?, ?)",
+        (set_id, q_index, text)
+    )
+    qid = conn.execute(
+        "SELECT id FROM questions WHERE set_id=? AND q_index=? AND text=?",
+        (set_id, q_index, text)
+    ).fetchone()[0]
+    _question_ids[key] = qid
+    return qid
+
+
+def _question_texts(conn: sqlite3.Connection, ids) -> dict[int, str]:
+    ids = list(set(ids))
+    if not ids:
+        return {}
+    cur = conn.execute(f"SELECT id, text FROM questions WHERE id IN ({','.join('?' * len(ids))})", ids)
+    return {r["id"]: r["text"] for r in cur.fetchall()}
+
+
+# ---------- answers ----------
+
+def save_answers_many(rows: list[tuple[int, str, int, str, str, str, str, bool]]):
+    """
+    rows: (user_id, session_date, q_index, question, answer, created_at, question_set, completes) —
+    один commit на пачку. Текст вопроса в строку не попадает, только question_id; ответ сразу
+    индексируется для поиска; completes=True (последний шаг набора) обновляет user_stats там же.
+    Commit — с synchronous=FULL: save_answer подтверждает ответ, только когда WAL на диске
+    (с NORMAL последние commit'ы теряются при отключении питания). fsync один на пачку.
+    """
+    conn = _conn()
+    conn.execute("PRAGMA synchronous=FULL")
+    try:
+        indexed = []
+        for user_id, session_date, q_index, question, answer, created_at, question_set, completes in rows:
+            cur = conn.execute(
+                """
+                INSERT INTO answers (user_id, session_date, q_index, question, question_id, answer, created_at)
+                VALUES (?, ?, ?, '', ?, ?, ?)
+                """,
+                (user_id, session_date, q_index, question_id(conn, q_index, question, question_set), answer, created_at)
+            )
+            indexed.append((cur.lastrowid, _fts_text(answer), f"u{user_id}", session_date, q_index))
+            if completes:
+                _record_day(conn, user_id, session_date, True)
+        conn.executemany(
+            "INSERT INTO answers_fts (rowid, answer, owner, session_date, q_index) VALUES (?, ?, ?, ?, ?)",
+            indexed
+        )
+        # первый ответ набора — начатая сессия; в той же транзакции, без отдельного commit'а
+        conn.executemany(
+            """
+            INSERT INTO user_stats (user_id, sessions_started, updated_at) VALUES (?, 1, ?)
+            ON CONFLICT(user_id) DO UPDATE SET
+                sessions_started=sessions_started + 1,
+                updated_at=excluded.updated_at
+            """,
+            [(r[0], r[5]) for r in rows if r[2] == 1]
+        )
+        _commit(conn)
+    except Exception:
+        conn.rollback()
+        _question_ids.clear()  # id из откатанной транзакции больше не существуют
+        raise
+    finally:
+        conn.execute(f"PRAGMA synchronous={DB_SYNCHRONOUS}")
+
+
+def meta_get(key: str) -> str | None:
+    row = _conn().execute("SELECT value FROM meta WHERE key=?", (key,)).fetchone()
+    return row[0] if row else None
+
+
+def _meta_set(conn: sqlite3.Connection, key: str, value: str):
+    conn.execute(
+        "INSERT INTO meta (key, value) VALUES (?, ?) ON CONFLICT(key) DO UPDATE SET value=excluded.value",
+        (key, value)
+    )
+
+
+def normalize_answers_chunk(limit: int) -> int:
+    """
+    Переводит следующие limit строк answers (по id) на question_id и стирает в них текст вопроса.
+    Короткая транзакция на кусок; прогресс — в meta, так что перенос переживает перезапуск.
+    Возвращает число просмотренных строк (0 — всё перенесено).
+    """
+    conn = _conn()
+    after = int(meta_get("normalize_answers_after") or 0)
+    rows = conn.execute(
+        "SELECT id, q_index, question, question_id FROM answers WHERE id > ? ORDER BY id LIMIT ?",
+        (after, limit)
+    ).fetchall()
+    if not rows:
+        return 0
+    conn.execute("BEGIN")
+    try:
+        conn.executemany(
+            "UPDATE answers SET question_id=?, question='' WHERE id=?",
+            [
+                (question_id(conn, r["q_index"], r["question"]), r["id"])
+                for r in rows if r["question_id"] is None
+            ]
+        )
+        _meta_set(conn, "normalize_answers_after", str(rows[-1]["id"]))
+        _commit(conn)
+    except Exception:
+        conn.rollback()
+        _question_ids.clear()
+        raise
+    return len(rows)
+
+
+def _month_bounds(month: str) -> tuple[str, str]:
+    year, mon = map(int, month.split("-"))
+    year, mon = (year + 1, 1) if mon == 12 else (year, mon + 1)
+    return f"{month}-01", f"{year:04d}-{mon:02d}-01"
+
+
+def get_months_to_archive(before_month: str, from_user_id: int, limit: int) -> list[tuple[int, str]]:
+    # (user_id, YYYY-MM) с ответами до начала before_month, начиная с from_user_id;
+    # идёт по idx_answers_user_date_q. Архивированные месяцы из answers уходят,
+    # поэтому следующую страницу можно снова начинать с последнего user_id
+    cur = _conn().execute("""
+        SELECT DISTINCT user_id, substr(session_date, 1, 7) AS month
+        FROM answers
+        WHERE user_id >= ? AND session_date < ?
+        ORDER BY user_id, month
+        LIMIT ?
+    """, (from_user_id, f"{before_month}-01", limit))
+    return [(r["user_id"], r["month"]) for r in cur.fetchall()]
+
+
+def _pack(rows: list[list]) -> bytes:
+    return zlib.compress(json.dumps(rows, ensure_ascii=False, separators=(",", ":")).encode("utf-8"), 9)
+
+
+def _unpack(data: bytes) -> list[list]:
+    return json.loads(zlib.decompress(data).decode("utf-8"))
+
+
+# строка архива: [id, session_date, q_index, question_id, question, answer, created_at]
+# (question заполнен только у строк без question_id)
+
+def archive_user_month(user_id: int, month: str) -> int:
+    """Переносит ответы пользователя за месяц в answers_archive (дописывая к уже архивированным)."""
+    conn = _conn()
+    start, end = _month_bounds(month)
+    conn.execute("BEGIN")
+    try:
+        rows = conn.execute("""
+            SELECT id, session_date, q_index, question_id, question, answer, created_at
+            FROM answers
+            WHERE user_id=? AND session_date >= ? AND session_date < ?
+        """, (user_id, start, end)).fetchall()
+        if not rows:
+            conn.rollback()
+            return 0
+        packed = [list(r) for r in rows]
+        old = conn.execute(
+            "SELECT data FROM answers_archive WHERE user_id=? AND month=?", (user_id, month)
+        ).fetchone()
+        if old is not None:
+            packed = _unpack(old["data"]) + packed
+        packed.sort(key=lambda r: (r[1], r[2], r[0]))
+        conn.execute(
+            """
+            INSERT INTO answers_archive (user_id, month, rows, data, archived_at)
+            VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT(user_id, month) DO UPDATE SET
+                rows=excluded.rows,
+                data=excluded.data,
+                archived_at=excluded.archived_at
+            """,
+            (user_id, month, len(packed), _pack(packed), now_utc_iso())
+        )
+        conn.executemany("DELETE FROM answers WHERE id=?", [(r["id"],) for r in rows])
+        _commit(conn)
+    except Exception:
+        conn.rollback()
+        raise
+    return len(rows)
+
+
+def get_answers_page(user_id: int, after: tuple[str, int, int] | None, limit: int, desc: bool = False) -> list[dict]:
+    """
+    Ответы пользователя по (session_date, q_index, id) — архивные и свежие вперемешку,
+    как будто архива нет. after — ключ последней строки предыдущей страницы;
+    desc=True — от новых к старым.
+    """
+    if desc:
+        after = after or ("9999-12-31", 1 << 30, 1 << 62)
+        cmp, order = "<", "DESC"
+    else:
+        after = after or ("", 0, 0)
+        cmp, order = ">", ""
+    key = lambda r: (r[1], r[2], r[0])
+    beyond = (lambda r: key(r) < after) if desc else (lambda r: key(r) > after)
+    conn = _conn()
+
+    # архив: месяцы с нужного, пока не наберём страницу (месяц — не больше пары сотен строк)
+    archived: list[list] = []
+    cur = conn.execute(
+        f"SELECT data FROM answers_archive WHERE user_id=? AND month {cmp}= ? ORDER BY month {order}",
+        (user_id, after[0][:7])
+    )
+    for row in cur:
+        archived += [r for r in _unpack(row["data"]) if beyond(r)]
+        if len(archived) >= limit:
+            break
+    cur.close()
+
+    sd, qi, rid = after
+    hot = conn.execute(f"""
+        SELECT a.id, a.session_date, a.q_index, a.question_id, a.question, a.answer, a.created_at
+        FROM answers a
+        WHERE a.user_id=? AND a.session_date {cmp}= ?
+          AND (a.session_date {cmp} ? OR a.q_index {cmp} ? OR (a.q_index = ? AND a.id {cmp} ?))
+        ORDER BY a.session_date {order}, a.q_index {order}, a.id {order}
+        LIMIT ?
+    """, (user_id, sd, sd, qi, qi, rid, limit)).fetchall()
+
+    merged = sorted(archived + [list(r) for r in hot], key=key, reverse=desc)[:limit]
+    texts = _question_texts(conn, (r[3] for r in merged if r[3] is not None))
+    return [
+        {
+            "id": r[0], "session_date": r[1], "q_index": r[2],
+            "question": texts.get(r[3], r[4]) if r[3] is not None else r[4],
+            "answer": r[5], "created_at": r[6],
+        }
+        for r in merged
+    ]
+
+
+# ---------- поиск ----------
+
+def search_backfill_chunk(limit: int) -> int:
+    """
+    Индексирует следующий кусок старых ответов: сначала answers (до id на момент миграции),
+    потом архив по (user_id, month). Архив — вторым, чтобы строки, ушедшие туда
+    во время первого прохода, тоже попали в индекс. Возвращает 0, когда всё готово.
+    """
+    conn = _conn()
+    until = int(meta_get("search_backfill_until") or 0)
+    after = int(meta_get("search_backfill_after") or 0)
+    conn.execute("BEGIN")
+    try:
+        if after < until:
+            rows = conn.execute(
+                "SELECT id, answer, user_id, session_date, q_index FROM answers WHERE id > ? AND id <= ? ORDER BY id LIMIT ?",
+                (after, until, limit)
+            ).fetchall()
+            # OR REPLACE: строка могла попасть в индекс через save_answers_many
+            conn.executemany(
+                "INSERT OR REPLACE INTO answers_fts (rowid, answer, owner, session_date, q_index) VALUES (?, ?, ?, ?, ?)",
+                [(r["id"], _fts_text(r["answer"]), f"u{r['user_id']}", r["session_date"], r["q_index"]) for r in rows]
+            )
+            _meta_set(conn, "search_backfill_after", str(rows[-1]["id"] if rows else until))
+            _commit(conn)
+            return max(len(rows), 1)
+
+        archive_after = meta_get("search_archive_after")
+        if archive_after is None:
+            conn.rollback()
+            return 0
+        user_id, month = archive_after.split("|") if archive_after else (0, "")
+        blobs = conn.execute(
+            """
+            SELECT user_id, month, data FROM answers_archive
+            WHERE user_id > ? OR (user_id = ? AND month > ?)
+            ORDER BY user_id, month
+            LIMIT ?
+            """,
+            (int(user_id), int(user_id), month, max(1, limit // 100))
+        ).fetchall()
+        n = 0
+        for b in blobs:
+            packed = _unpack(b["data"])
+            conn.executemany(
+                "INSERT OR REPLACE INTO answers_fts (rowid, answer, owner, session_date, q_index) VALUES (?, ?, ?, ?, ?)",
+                [(r[0], _fts_text(r[5]), f"u{b['user_id']}", r[1], r[2]) for r in packed]
+            )
+            n += len(packed)
+        if blobs:
+            _meta_set(conn, "search_archive_after", f"{blobs[-1]['user_id']}|{blobs[-1]['month']}")
+        else:
+            conn.execute("DELETE FROM meta WHERE key='search_archive_after'")
+        _commit(conn)
+        return max(n, 1)
+    except Exception:
+        conn.rollback()
+        raise
+
+
+def _fts_text(text: str) -> str:
+    # unicode61 не считает «ё» буквой с диакритикой — сводим к «е» сами (и в индексе, и в запросе)
+    return text.replace("ё", "е").replace("Ё", "Е")
+
+
+# стеммера для русского у FTS5 нет: у слова отрезаем гласное окончание
+# и ищем по префиксу («море» -> мор* найдёт «моря», «морем»)
+_ENDING = re.compile(r"[аеиоуыэюяьй]{1,2}$")
+
+
+def _match_expr(query: str, user_id: int) -> str | None:
+    terms = []
+    for word in re.findall(r"\w+", _fts_text(query.lower()))[:8]:
+        stem = _ENDING.sub("", word) if len(word) > 3 else word
+        terms.append(stem if len(stem) >= 3 else word)
+    if not terms:
+        return None
+    phrase = " ".join('"%s"*' % t for t in terms)
+    return f"owner : u{user_id} AND answer : ({phrase})"
+
+
+def search_answers(user_id: int, query: str, limit: int, offset: int = 0) -> list[dict]:
+    """Ответы пользователя по релевантности (bm25) со сниппетами; owner в ранге не участвует."""
+    expr = _match_expr(query, user_id)
+    if expr is None:
+        return []
+    cur = _conn().execute("""
+        SELECT rowid AS id, session_date, q_index, snippet(answers_fts, 0, '«', '»', '…', 16) AS snippet
+        FROM answers_fts
+        WHERE answers_fts MATCH ?
+        ORDER BY bm25(answers_fts, 1.0, 0.0)
+        LIMIT ? OFFSET ?
+    """, (expr, limit, offset))
+    return [dict(r) for r in cur.fetchall()]
+
+
+# ---------- статистика ----------
+
+def _week_start(day: date) -> str:
+    return (day - timedelta(days=day.weekday())).isoformat()
+
+
+def record_day(user_id: int, day: str, completed: bool):
+    with _write_tx() as conn:
+        _record_day(conn, user_id, day, completed)
+
+
+def _record_day(conn: sqlite3.Connection, user_id: int, day: str, completed: bool):
+    """
+    Учитывает день (локальная дата) как выполненный (последний шаг набора) или пропущенный
+    (skip_today); commit — на вызывающем. Пропуск не рвёт серию, но и не удлиняет её. Повтор
+    того же события за тот же день ничего не меняет; поздно завершённый старый набор
+    считается, но серию не трогает.
+    """
+    row = conn.execute("SELECT * FROM user_stats WHERE user_id=?", (user_id,)).fetchone()
+    s = dict(row) if row else {
+        "current_streak": 0, "longest_streak": 0, "streak_date": None,
+        "completed_days": 0, "skipped_days": 0, "sessions_started": 0,
+        "last_completed_date": None, "last_skipped_date": None,
+        "week_start": None, "week_completed": 0, "week_skipped": 0,
+    }
+    d = date.fromisoformat(day)
+    week = _week_start(d)
+    if s["week_start"] is None or week > s["week_start"]:
+        s["week_start"], s["week_completed"], s["week_skipped"] = week, 0, 0
+    this_week = week == s["week_start"]
+    prev = (d - timedelta(days=1)).isoformat()
+    anchor = s["streak_date"]
+
+    if completed:
+        if s["last_completed_date"] == day:
+            return
+        s["completed_days"] += 1
+        s["week_completed"] += 1 if this_week else 0
+        if anchor is None or day >= anchor:
+            s["current_streak"] = s["current_streak"] + 1 if anchor in (prev, day) else 1
+            s["streak_date"] = day
+            s["longest_streak"] = max(s["longest_streak"], s["current_streak"])
+        if s["last_completed_date"] is None or day > s["last_completed_date"]:
+            s["last_completed_date"] = day
+    else:
+        if day in (s["last_skipped_date"], s["last_completed_date"]):
+            return
+        s["skipped_days"] += 1
+        s["week_skipped"] += 1 if this_week else 0
+        if anchor is None or day > anchor:
+            if anchor != prev:
+                s["current_streak"] = 0
+            s["streak_date"] = day
+        if s["last_skipped_date"] is None or day > s["last_skipped_date"]:
+            s["last_skipped_date"] = day
+
+    conn.execute(
         """
-        INSERT INTO answers (user_id, session_date, q_index, question, answer, created_at)
-        VALUES (?, ?, ?, ?, ?, ?)
+        INSERT INTO user_stats (
+            user_id, current_streak, longest_streak, streak_date, completed_days, skipped_days,
+            last_completed_date, last_skipped_date, week_start, week_completed, week_skipped, updated_at
+        ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT(user_id) DO UPDATE SET
+            current_streak=excluded.current_streak,
+            longest_streak=excluded.longest_streak,
+            streak_date=excluded.streak_date,
+            completed_days=excluded.completed_days,
+            skipped_days=excluded.skipped_days,
+            last_completed_date=excluded.last_completed_date,
+            last_skipped_date=excluded.last_skipped_date,
+            week_start=excluded.week_start,
+            week_completed=excluded.week_completed,
+            week_skipped=excluded.week_skipped,
+            updated_at=excluded.updated_at
         """,
-        (user_id, session_date, q_index, question, answer, now_utc_iso())
+        (
+            user_id, s["current_streak"], s["longest_streak"], s["streak_date"], s["completed_days"],
+            s["skipped_days"], s["last_completed_date"], s["last_skipped_date"], s["week_start"],
+            s["week_completed"], s["week_skipped"], now_utc_iso(),
+        )
     )
-    conn.commit()
+
+
+def get_user_stats(user_id: int) -> dict | None:
+    row = _conn().execute("SELECT * FROM user_stats WHERE user_id=?", (user_id,)).fetchone()
+    return dict(row) if row else None
+
+
+def get_digest_page(tz_group: str, week_start: str, after_user_id: int, limit: int) -> list[dict]:
+    # активные пользователи группы, отвечавшие на этой неделе; keyset по user_stats.user_id
+    cur = _conn().execute("""
+        SELECT s.*
+        FROM user_stats s
+        JOIN users u ON u.user_id = s.user_id
+        WHERE s.user_id > ? AND s.week_start = ? AND s.week_completed > 0
+          AND u.is_active = 1 AND COALESCE(NULLIF(u.timezone_group, ''), 'Москва') = ?
+        ORDER BY s.user_id
+        LIMIT ?
+    """, (after_user_id, week_start, tz_group, limit))
+    return [dict(r) for r in cur.fetchall()]
+
+
+# ---------- реплики ----------
+
+def acquire_lease(name: str, holder: str, ttl: float) -> tuple[bool, bool]:
+    """
+    Берёт или продлевает аренду; чужую — только если она истекла.
+    Возвращает (взята, строка и до этого была нашей): во втором случае
+    между нашими продлениями аренду никто другой не держал.
+    """
+    conn = _conn()
+    now = time.time()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        row = conn.execute("SELECT holder FROM leases WHERE name=?", (name,)).fetchone()
+        cur = conn.execute(
+            """
+            INSERT INTO leases (name, holder, expires_at) VALUES (?, ?, ?)
+            ON CONFLICT(name) DO UPDATE SET
+                holder=excluded.holder,
+                expires_at=excluded.expires_at
+            WHERE leases.holder=excluded.holder OR leases.expires_at < ?
+            """,
+            (name, holder, now + ttl, now)
+        )
+        _commit(conn)
+    except Exception:
+        conn.rollback()
+        raise
+    return cur.rowcount == 1, row is not None and row[0] == holder
+
+
+def release_lease(name: str, holder: str):
+    with _write_tx() as conn:
+        conn.execute("DELETE FROM leases WHERE name=? AND holder=?", (name, holder))
+
+
+def claim_deliveries(user_ids: list[int], local_date: str, kind: str) -> list[int]:
+    """
+    Отмечает доставку для пачки пользователей и возвращает тех, кого отметили сейчас
+    (остальным уже отправила другая реплика или прошлый запуск). BEGIN IMMEDIATE —
+    чтобы две реплики не делили одну пачку.
+    """
+    conn = _conn()
+    now = now_utc_iso()
+    claimed = []
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        for user_id in user_ids:
+            cur = conn.execute(
+                "INSERT OR IGNORE INTO deliveries (local_date, kind, user_id, sent_at) VALUES (?, ?, ?, ?)",
+                (local_date, kind, user_id, now)
+            )
+            if cur.rowcount:
+                claimed.append(user_id)
+        _commit(conn)
+    except Exception:
+        conn.rollback()
+        raise
+    return claimed
+
+
+def release_deliveries(user_ids: list[int], local_date: str, kind: str):
+    # отправка не удалась — пусть догонялка попробует ещё раз
+    with _write_tx() as conn:
+        conn.executemany(
+            "DELETE FROM deliveries WHERE local_date=? AND kind=? AND user_id=?",
+            [(local_date, kind, user_id) for user_id in user_ids]
+        )
+
+
+def prune_deliveries(before_date: str) -> int:
+    with _write_tx() as conn:
+        cur = conn.execute("DELETE FROM deliveries WHERE local_date < ?", (before_date,))
+    return cur.rowcount
+
+
+# ---------- рассылки ----------
+
+def create_broadcast(text: str, created_by: int | None = None) -> int:
+    with _write_tx() as conn:
+        cur = conn.execute(
+            "INSERT INTO broadcasts (text, created_by, created_at) VALUES (?, ?, ?)",
+            (text, created_by, now_utc_iso())
+        )
+    return cur.lastrowid
+
+
+def get_broadcast(broadcast_id: int) -> dict | None:
+    row = _conn().execute("SELECT * FROM broadcasts WHERE id=?", (broadcast_id,)).fetchone()
+    return dict(row) if row else None
+
+
+def list_broadcasts(limit: int = 20) -> list[dict]:
+    rows = _conn().execute("SELECT * FROM broadcasts ORDER BY id DESC LIMIT ?", (limit,)).fetchall()
+    return [dict(r) for r in rows]
+
+
+def next_broadcast() -> dict | None:
+    """Самая старая незавершённая рассылка: идут по одной, в порядке создания."""
+    row = _conn().execute(
+        "SELECT * FROM broadcasts WHERE status IN ('pending', 'running') ORDER BY id LIMIT 1"
+    ).fetchone()
+    return dict(row) if row else None
+
+
+def get_broadcast_recipients(after_user_id: int, limit: int) -> list[int]:
+    # keyset по первичному ключу users
+    rows = _conn().execute(
+        "SELECT user_id FROM users WHERE user_id > ? AND is_active=1 ORDER BY user_id LIMIT ?",
+        (after_user_id, limit)
+    ).fetchall()
+    return [r[0] for r in rows]
+
+
+def claim_broadcast(broadcast_id: int, user_ids: list[int]) -> list[int]:
+    """Ставит 'sending' пачке и возвращает тех, кого ещё не было в этой рассылке."""
+    conn = _conn()
+    now = now_utc_iso()
+    claimed = []
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        conn.execute(
+            "UPDATE broadcasts SET status='running', started_at=COALESCE(started_at, ?) WHERE id=? AND status='pending'",
+            (now, broadcast_id)
+        )
+        for user_id in user_ids:
+            cur = conn.execute(
+                "INSERT OR IGNORE INTO broadcast_results (broadcast_id, user_id, outcome, at) VALUES (?, ?, 'sending', ?)",
+                (broadcast_id, user_id, now)
+            )
+            if cur.rowcount:
+                claimed.append(user_id)
+        _commit(conn)
+    except Exception:
+        conn.rollback()
+        raise
+    return claimed
+
+
+def save_broadcast_batch(broadcast_id: int, cursor: int, outcomes: dict[int, str], released: list[int]):
+    """
+    Итоги пачки и новый курсор — одной транзакцией. released — те, до кого очередь
+    не дошла (уступили слоту): их отметка снимается, курсор стоит перед ними.
+    """
+    conn = _conn()
+    now = now_utc_iso()
+    try:
+        conn.executemany(
+            "UPDATE broadcast_results SET outcome=?, at=? WHERE broadcast_id=? AND user_id=?",
+            [(outcome, now, broadcast_id, user_id) for user_id, outcome in outcomes.items()]
+        )
+        conn.executemany(
+            "DELETE FROM broadcast_results WHERE broadcast_id=? AND user_id=?",
+            [(broadcast_id, user_id) for user_id in released]
+        )
+        sent = sum(1 for o in outcomes.values() if o == "sent")
+        conn.execute(
+            "UPDATE broadcasts SET cursor=MAX(cursor, ?), sent=sent+?, failed=failed+? WHERE id=?",
+            (cursor, sent, len(outcomes) - sent, broadcast_id)
+        )
+        _commit(conn)
+    except Exception:
+        conn.rollback()
+        raise
+
+
+def finish_broadcast(broadcast_id: int, status: str = "done") -> bool:
+    with _write_tx() as conn:
+        cur = conn.execute(
+            "UPDATE broadcasts SET status=?, finished_at=? WHERE id=? AND status IN ('pending', 'running')",
+            (status, now_utc_iso(), broadcast_id)
+        )
+    return cur.rowcount == 1
+
+
+def broadcast_outcomes(broadcast_id: int) -> dict[str, int]:
+    rows = _conn().execute(
+        "SELECT outcome, COUNT(*) FROM broadcast_results WHERE broadcast_id=? GROUP BY outcome",
+        (broadcast_id,)
+    ).fetchall()
+    return {outcome: n for outcome, n in rows}
+
+
+# ---------- fsm ----------
+
+def fsm_load(key: str):
+    conn = _conn()
+    row = conn.execute("SELECT state, data FROM fsm_sessions WHERE key=?", (key,)).fetchone()
+    return dict(row) if row else None
+
+
+def fsm_save_many(upserts: list[tuple[str, str | None, str, str]], deletes: list[tuple[str]]):
+    # upserts: (key, state, data_json, updated_at); deletes: (key,)
+    with _write_tx() as conn:
+        conn.executemany(
+            """
+            INSERT INTO fsm_sessions (key, state, data, updated_at)
+            VALUES (?, ?, ?, ?)
+            ON CONFLICT(key) DO UPDATE SET
+                state=excluded.state,
+                data=excluded.data,
+                updated_at=excluded.updated_at
+            """,
+            upserts
+        )
+        conn.executemany("DELETE FROM fsm_sessions WHERE key=?", deletes)
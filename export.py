@@ -0,0 +1,74 @@
+"""
+Выгрузка истории ответов пользователя в файл (md / csv / json).
+
+История читается кусками через adb.iter_answers и сразу дописывается
+во временный файл: в памяти держится только один кусок, запись в файл
+идёт вне event loop.
+"""
+import asyncio
+import csv
+import io
+import json
+import os
+import tempfile
+from typing import AsyncIterator
+
+import adb
+
+FORMATS = ("md", "csv", "json")
+
+_CSV_FIELDS = ("session_date", "q_index", "question", "answer", "created_at")
+
+
+async def _markdown(user_id: int) -> AsyncIterator[str]:
+    yield "# Вопросы для хорошей жизни — мои ответы\n"
+    day = None
+    async for chunk in adb.iter_answers(user_id):
+        out = []
+        for r in chunk:
+            if r["session_date"] != day:
+                day = r["session_date"]
+                out.append(f"\n## {day}\n")
+            out.append(f"\n**{r['question']}**\n\n{r['answer']}\n")
+        yield "".join(out)
+
+
+async def _csv(user_id: int) -> AsyncIterator[str]:
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    writer.writerow(_CSV_FIELDS)
+    async for chunk in adb.iter_answers(user_id):
+        writer.writerows([r[f] for f in _CSV_FIELDS] for r in chunk)
+        yield buf.getvalue()
+        buf.seek(0)
+        buf.truncate()
+    yield buf.getvalue()
+
+
+async def _json(user_id: int) -> AsyncIterator[str]:
+    yield "["
+    sep = "\n"
+    async for chunk in adb.iter_answers(user_id):
+        out = []
+        for r in chunk:
+            out.append(sep + json.dumps({f: r[f] for f in _CSV_FIELDS}, ensure_ascii=False))
+            sep = ",\n"
+        yield "".join(out)
+    yield "\n]\n"
+
+
+_WRITERS = {"md": _markdown, "csv": _csv, "json": _json}
+
+
+async def export_answers(user_id: int, fmt: str) -> tuple[str, int]:
+    """Пишет историю во временный файл. Возвращает (путь, размер); файл удаляет вызывающий."""
+    fd, path = tempfile.mkstemp(prefix=f"answers-{user_id}-", suffix=f".{fmt}")
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8", newline="") as f:
+            async for part in _WRITERS[fmt](user_id):
+                if part:
+                    await asyncio.to_thread(f.write, part)
+        return path, os.path.getsize(path)
+    except BaseException:
+        os.remove(path)
+        raise
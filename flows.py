@@ -0,0 +1,106 @@
+"""
+Наборы вопросов (flows).
+
+Набор — просто данные: id, вопросы по порядку и финальная фраза. Один хендлер
+(bot.answer_step) проводит пользователя по любому набору: в данных FSM лежат
+flow и step, состояние — Form.answering. Встроенный набор — "default"; другие
+можно описать в JSON-файле FLOWS_FILE, без нового кода:
+
+    {"flows": [{"id": "short", "questions": ["...", "..."], "done": "..."}]}
+
+Какой набор получает пользователь — users.flow_id (NULL — default):
+
+    python flows.py list
+    python flows.py assign USER_ID FLOW_ID     # FLOW_ID=default — вернуть набор по умолчанию
+"""
+import argparse
+import json
+from dataclasses import dataclass
+
+import db
+from config import FLOWS_FILE
+from states import Form
+
+
+@dataclass(frozen=True)
+class Flow:
+    id: str
+    questions: tuple[str, ...]
+    done: str = "Спасибо за ответы. До завтра!"
+
+
+QUESTIONS = [
+    "1) Что за сегодняшний день Вы сделали хорошо?",
+    "2) Что люди вокруг Вас сделали такого, за что Вы им благодарны (неважно, сделали они это по отношению к Вам или нет)? Кому Вы за это благодарны?",
+    "3) Что Вы в течение сегодняшнего дня видели, слышали, пробовали на вкус, осязали, обоняли, что наполняет Вас благодарностью к миру / что принесло Вам удовлетворение?",
+    "4) Какие мелочи порадовали / повеселили Вас сегодня?",
+]
+
+# id набора = question_sets.name, под которым сохраняются его вопросы
+DEFAULT = Flow(db.DEFAULT_QUESTION_SET, tuple(QUESTIONS))
+
+
+def load(path: str) -> dict[str, Flow]:
+    with open(path, encoding="utf-8") as f:
+        raw = json.load(f)
+    flows = {}
+    for item in raw["flows"]:
+        questions = tuple(item["questions"])
+        if not questions:
+            raise ValueError(f"flow {item['id']!r} has no questions")
+        flows[item["id"]] = Flow(item["id"], questions, item.get("done", Flow.done))
+    return flows
+
+
+FLOWS: dict[str, Flow] = {DEFAULT.id: DEFAULT}
+if FLOWS_FILE:
+    FLOWS.update(load(FLOWS_FILE))
+
+
+def get(flow_id: str | None) -> Flow:
+    # набор могли убрать из файла — тогда пользователь просто вернётся на default
+    return FLOWS.get(flow_id or DEFAULT.id, DEFAULT)
+
+
+def for_user(user: dict | None) -> Flow:
+    return get((user or {}).get("flow_id"))
+
+
+def start_data(flow: Flow, session_date: str) -> dict:
+    """Данные FSM в начале набора."""
+    return {"flow": flow.id, "step": 0, "session_date": session_date, "pending_date": None}
+
+
+# сессии, начатые до движка, лежат в FSM как Form.q1..q4 — продолжаем их как default
+_LEGACY_STEPS = {Form.q1.state: 0, Form.q2.state: 1, Form.q3.state: 2, Form.q4.state: 3}
+
+
+def position(raw_state: str | None, data: dict) -> tuple[Flow, int]:
+    """Набор и номер текущего шага (с нуля) по состоянию и данным FSM."""
+    if raw_state in _LEGACY_STEPS:
+        return DEFAULT, _LEGACY_STEPS[raw_state]
+    flow = get(data.get("flow"))
+    # набор мог стать короче посреди сессии — тогда текущий шаг последний
+    return flow, min(int(data.get("step") or 0), len(flow.questions) - 1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest="command", required=True)
+    sub.add_parser("list")
+    assign = sub.add_parser("assign")
+    assign.add_argument("user_id", type=int)
+    assign.add_argument("flow_id")
+    args = parser.parse_args()
+
+    if args.command == "list":
+        for flow in FLOWS.values():
+            print(f"{flow.id}: {len(flow.questions)} questions")
+        return
+    if args.flow_id not in FLOWS:
+        parser.error(f"unknown flow {args.flow_id!r}")
+    db.set_flow(args.user_id, None if args.flow_id == DEFAULT.id else args.flow_id)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+"""
+Аренда (leader election) через общую БД.
+
+Несколько копий бота могут работать одновременно, но активен только держатель
+аренды: он выполняет задачи планировщика (слоты, пинги, сводки, ночное
+обслуживание) и только он принимает апдейты (webhook.py), остальные — горячий
+резерв. Поэтому кэши процесса (FSM-сессии, строки users) не расходятся с БД:
+пока реплика активна, никто другой пользователей не обслуживает; при потере
+аренды она сбрасывает накопленное в БД (on_lost), при получении — забывает
+кэши, устаревшие, пока активной была другая (on_acquired(changed_hands=True));
+если же аренда просто вернулась к нам после сбоя продления, кэши верны.
+
+Держатель продлевает её каждые ttl/3 секунд; если он умер, аренда истекает
+через ttl и её забирает следующая реплика. При штатной остановке аренда
+отпускается сразу.
+
+Продление идёт в отдельном потоке со своим соединением (adb._lease_thread),
+а не через поток-писатель: очередь записей не задерживает его. Держателем себя
+считаем только до локального дедлайна (момент запроса продления + ttl с запасом):
+если диск подвис и продление не прошло, реплика перестаёт запускать задачи
+раньше, чем аренду заберут.
+"""
+import asyncio
+import logging
+import time
+from typing import Awaitable, Callable
+
+import adb
+import metrics
+
+log = logging.getLogger(__name__)
+
+
+class Lease:
+    def __init__(self, name: str, holder: str, ttl: float,
+                 on_acquired: Callable[[bool], Awaitable[None]] | None = None,
+                 on_lost: Callable[[], Awaitable[None]] | None = None):
+        self.name = name
+        self.holder = holder
+        self.ttl = ttl
+        self.on_acquired = on_acquired
+        self.on_lost = on_lost
+        self._held_until = 0.0  # time.monotonic()
+        self._task: asyncio.Task | None = None
+
+    @property
+    def held(self) -> bool:
+        return time.monotonic() < self._held_until
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+        if self.held:
+            self._held_until = 0.0
+            await adb.release_lease(self.name, self.holder)
+            log.info("lease %s released by %s", self.name, self.holder)
+
+    async def _run(self):
+        while True:
+            asked = time.monotonic()
+            was_held = self.held
+            try:
+                ok, ours = await adb.acquire_lease(self.name, self.holder, self.ttl)
+            except Exception:
+                log.exception("lease %s renew failed", self.name)
+                ok = ours = False
+            if ok:
+                # запас на расхождение часов и задержку записи
+                self._held_until = asked + self.ttl * 0.8
+                if not was_held:
+                    metrics.inc("bot_lease_acquired_total")
+                    log.info("lease %s %s by %s", self.name, "resumed" if ours else "acquired", self.holder)
+                    if self.on_acquired is not None:
+                        asyncio.create_task(self.on_acquired(not ours))
+            elif was_held:
+                self._held_until = 0.0
+                log.warning("lease %s lost by %s", self.name, self.holder)
+                if self.on_lost is not None:
+                    asyncio.create_task(self.on_lost())
+            await asyncio.sleep(self.ttl / 3)
+
+    def only_leader(self, fn: Callable[..., Awaitable[None]]):
+        """Обёртка для задач планировщика: на не-лидере задача пропускается."""
+        async def wrapper(*args, **kwargs):
+            if not self.held:
+                return None
+            return await fn(*args, **kwargs)
+        wrapper.__name__ = fn.__name__
+        wrapper.__qualname__ = fn.__qualname__
+        return wrapper
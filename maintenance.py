@@ -0,0 +1,141 @@
+"""
+Обслуживание истории ответов.
+
+    python maintenance.py normalize              # перевести старые ответы на questions.id
+    python maintenance.py index                  # проиндексировать старые ответы для поиска
+    python maintenance.py search USER_ID ТЕКСТ   # поиск по ответам пользователя (для поддержки)
+    python maintenance.py archive [--days N]     # сжать ответы старше N дней в answers_archive
+    python maintenance.py vacuum                 # вернуть освободившееся место ОС (бот лучше остановить)
+
+normalize, index и archive работают короткими транзакциями через поток-писатель adb,
+поэтому их можно запускать и на живой базе; в боте они же выполняются
+в фоне при старте и ночной задачей.
+"""
+import argparse
+import asyncio
+import logging
+import time
+from datetime import datetime, timedelta
+
+import adb
+import db
+from config import ARCHIVE_AFTER_DAYS, DELIVERIES_KEEP_DAYS, MAINTENANCE_CHUNK_SIZE
+
+log = logging.getLogger(__name__)
+
+
+async def _pause():
+    # отдаём поток-писатель хендлерам между кусками, а при перегрузке ждём, пока она спадёт
+    await asyncio.sleep(0)
+    while adb.overloaded:
+        await asyncio.sleep(1)
+
+
+async def normalize_answers(chunk_size: int = MAINTENANCE_CHUNK_SIZE) -> int:
+    total = 0
+    started = time.monotonic()
+    while True:
+        n = await adb.normalize_answers_chunk(chunk_size)
+        if not n:
+            break
+        total += n
+        await _pause()
+    if total:
+        log.info("answers normalized: %s rows in %.1fs", total, time.monotonic() - started)
+    return total
+
+
+async def backfill_search(chunk_size: int = MAINTENANCE_CHUNK_SIZE) -> int:
+    total = 0
+    started = time.monotonic()
+    while True:
+        n = await adb.search_backfill_chunk(chunk_size)
+        if not n:
+            break
+        total += n
+        await _pause()
+    if total:
+        log.info("search index backfilled: %s rows in %.1fs", total, time.monotonic() - started)
+    return total
+
+
+async def background():
+    # при старте бота: доводим старые данные до текущей схемы
+    await normalize_answers()
+    await backfill_search()
+
+
+async def archive_answers(after_days: int = ARCHIVE_AFTER_DAYS, chunk_size: int = MAINTENANCE_CHUNK_SIZE) -> int:
+    """Архивирует целые месяцы, закончившиеся раньше чем after_days дней назад."""
+    if after_days <= 0:
+        return 0
+    before_month = (datetime.utcnow() - timedelta(days=after_days)).strftime("%Y-%m")
+    total = months = 0
+    from_user = 0
+    started = time.monotonic()
+    while True:
+        groups = await adb.get_months_to_archive(before_month, from_user, chunk_size)
+        if not groups:
+            break
+        for user_id, month in groups:
+            total += await adb.archive_user_month(user_id, month)
+            months += 1
+        from_user = groups[-1][0]
+        await _pause()
+    log.info("answers archived before %s: %s rows in %s user-months, %.1fs",
+             before_month, total, months, time.monotonic() - started)
+    return total
+
+
+async def nightly():
+    await archive_answers()
+    keep_from = (datetime.utcnow() - timedelta(days=DELIVERIES_KEEP_DAYS)).date().isoformat()
+    pruned = await adb.prune_deliveries(keep_from)
+    log.info("deliveries pruned before %s: %s rows", keep_from, pruned)
+
+
+def vacuum():
+    # VACUUM держит эксклюзивную блокировку на всё время — только руками
+    conn = db._conn()
+    before = conn.execute("PRAGMA page_count").fetchone()[0]
+    conn.execute("VACUUM")
+    after = conn.execute("PRAGMA page_count").fetchone()[0]
+    page = conn.execute("PRAGMA page_size").fetchone()[0]
+    log.info("vacuum: %.1f MB -> %.1f MB", before * page / 2**20, after * page / 2**20)
+
+
+async def _cli(args):
+    try:
+        if args.command == "normalize":
+            await normalize_answers(args.chunk_size)
+        elif args.command == "index":
+            await backfill_search(args.chunk_size)
+        elif args.command == "archive":
+            await archive_answers(args.days, args.chunk_size)
+        elif args.command == "search":
+            user_id, query = int(args.args[0]), " ".join(args.args[1:])
+            for r in await adb.search_answers(user_id, query, args.limit):
+                print(f"{r['session_date']} #{r['q_index']}: {r['snippet']}")
+    finally:
+        adb.shutdown()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("command", choices=("normalize", "index", "archive", "search", "vacuum"))
+    parser.add_argument("args", nargs="*", help="для search: USER_ID ТЕКСТ")
+    parser.add_argument("--limit", type=int, default=20)
+    parser.add_argument("--days", type=int, default=ARCHIVE_AFTER_DAYS)
+    parser.add_argument("--chunk-size", type=int, default=MAINTENANCE_CHUNK_SIZE)
+    args = parser.parse_args()
+    if args.command == "search" and len(args.args) < 2:
+        parser.error("search: нужны USER_ID и текст")
+    logging.basicConfig(level=logging.INFO)
+    if args.command == "vacuum":
+        vacuum()
+    else:
+        asyncio.run(_cli(args))
+
+
+if __name__ == "__main__":
+    main()
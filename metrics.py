@@ -0,0 +1,162 @@
+"""
+Метрики в формате Prometheus (text exposition) без внешних зависимостей.
+
+Счётчики и гистограммы с метками; запись — словарь + lock, так что
+наблюдения можно делать и из потоков БД. Отдаются по HTTP (METRICS_PORT,
+путь /metrics) и/или периодически пишутся в файл (METRICS_FILE).
+"""
+import bisect
+import logging
+import os
+import threading
+import time
+from typing import Callable
+
+from aiohttp import web
+
+log = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+_Labels = tuple[tuple[str, str], ...]
+
+_lock = threading.Lock()
+_counters: dict[str, dict[_Labels, float]] = {}
+_histograms: dict[str, dict[_Labels, list]] = {}  # labels -> [bucket_counts, sum, count]
+_buckets: dict[str, tuple[float, ...]] = {}
+_help: dict[str, str] = {}
+_gauges: dict[str, Callable[[], dict[_Labels, float] | float]] = {}
+
+
+def _labels(labels: dict) -> _Labels:
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def describe(name: str, text: str, buckets: tuple[float, ...] | None = None):
+    _help[name] = text
+    if buckets is not None:
+        _buckets[name] = buckets
+
+
+def inc(name: str, value: float = 1, **labels):
+    key = _labels(labels)
+    with _lock:
+        series = _counters.setdefault(name, {})
+        series[key] = series.get(key, 0) + value
+
+
+def observe(name: str, value: float, **labels):
+    key = _labels(labels)
+    buckets = _buckets.get(name, DEFAULT_BUCKETS)
+    with _lock:
+        series = _histograms.setdefault(name, {})
+        h = series.get(key)
+        if h is None:
+            h = series[key] = [[0] * len(buckets), 0.0, 0]
+        i = bisect.bisect_left(buckets, value)
+        if i < len(buckets):
+            h[0][i] += 1
+        h[1] += value
+        h[2] += 1
+
+
+class timer:
+    """with metrics.timer("name", label=...): ... — наблюдение длительности в секундах."""
+
+    def __init__(self, name: str, **labels):
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        observe(self.name, time.perf_counter() - self.started, **self.labels)
+
+
+def gauge(name: str, fn: Callable[[], dict[tuple, float] | float], text: str = ""):
+    """Значение считается в момент выдачи: fn() -> число или {((label, value), ...): число}."""
+    _gauges[name] = fn
+    if text:
+        _help[name] = text
+
+
+def _fmt_labels(labels: _Labels, extra: tuple = ()) -> str:
+    items = labels + extra
+    if not items:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in items) + "}"
+
+
+def _escape(v: str) -> str:
+    return v.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def render() -> str:
+    lines: list[str] = []
+    with _lock:
+        counters = {n: dict(s) for n, s in _counters.items()}
+        histograms = {n: {k: [list(h[0]), h[1], h[2]] for k, h in s.items()} for n, s in _histograms.items()}
+
+    for name, series in sorted(counters.items()):
+        if name in _help:
+            lines.append(f"# HELP {name} {_help[name]}")
+        lines.append(f"# TYPE {name} counter")
+        for labels, value in series.items():
+            lines.append(f"{name}{_fmt_labels(labels)} {value}")
+
+    for name, series in sorted(histograms.items()):
+        buckets = _buckets.get(name, DEFAULT_BUCKETS)
+        if name in _help:
+            lines.append(f"# HELP {name} {_help[name]}")
+        lines.append(f"# TYPE {name} histogram")
+        for labels, (counts, total, count) in series.items():
+            cumulative = 0
+            for le, c in zip(buckets, counts):
+                cumulative += c
+                lines.append(f"{name}_bucket{_fmt_labels(labels, (('le', repr(float(le))),))} {cumulative}")
+            lines.append(f"{name}_bucket{_fmt_labels(labels, (('le', '+Inf'),))} {count}")
+            lines.append(f"{name}_sum{_fmt_labels(labels)} {total}")
+            lines.append(f"{name}_count{_fmt_labels(labels)} {count}")
+
+    for name, fn in sorted(_gauges.items()):
+        try:
+            value = fn()
+        except Exception:
+            log.exception("gauge %s failed", name)
+            continue
+        if name in _help:
+            lines.append(f"# HELP {name} {_help[name]}")
+        lines.append(f"# TYPE {name} gauge")
+        if isinstance(value, dict):
+            for labels, v in value.items():
+                lines.append(f"{name}{_fmt_labels(tuple(labels))} {v}")
+        else:
+            lines.append(f"{name} {value}")
+
+    return "\n".join(lines) + "\n"
+
+
+# ---------- выдача ----------
+
+async def _handle(request: web.Request) -> web.Response:
+    return web.Response(text=render(), content_type="text/plain", charset="utf-8")
+
+
+async def serve(host: str, port: int) -> web.AppRunner:
+    app = web.Application()
+    app.router.add_get("/metrics", _handle)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    log.info("metrics on http://%s:%s/metrics", host, port)
+    return runner
+
+
+def dump(path: str):
+    # атомарно: пишем рядом и переименовываем
+    tmp = f"{path}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        f.write(render())
+    os.replace(tmp, path)
@@ -0,0 +1,184 @@
+"""
+Профилирование медленных путей (включается PROFILE_ENABLED=1).
+
+- Фоновый поток раз в PROFILE_INTERVAL_MS снимает стек потока event loop
+  в кольцевой буфер. Если хендлер или задача планировщика длились дольше
+  PROFILE_SLOW_MS, сэмплы за это время сворачиваются в collapsed stacks
+  (формат flamegraph) и пишутся в PROFILE_DIR вместе с user_id и состоянием.
+- Доля PROFILE_SAMPLE_RATE апдейтов целиком идёт под cProfile (.prof для
+  pstats/snakeviz). cProfile видит весь поток, поэтому в профиль попадают
+  и соседние корутины, выполнявшиеся между await'ами.
+- Тот же поток следит за сердцебиением loop: если loop не отвечал дольше
+  LOOP_BLOCK_MS, в лог уходит предупреждение со стеком, который его держит
+  (обычно это синхронный вызов sqlite или тяжёлый цикл).
+В PROFILE_DIR хранятся только PROFILE_KEEP последних файлов.
+"""
+import asyncio
+import cProfile
+import logging
+import os
+import random
+import sys
+import threading
+import time
+from collections import Counter, deque
+from datetime import datetime
+
+import metrics
+from config import (
+    LOOP_BLOCK_MS, PROFILE_DIR, PROFILE_INTERVAL_MS, PROFILE_KEEP, PROFILE_SAMPLE_RATE, PROFILE_SLOW_MS,
+)
+
+log = logging.getLogger(__name__)
+
+# сколько секунд истории стеков держать (дольше медленный хендлер всё равно не разобрать)
+_WINDOW_SECONDS = 120
+
+
+def _stack(frame) -> tuple:
+    out = []
+    while frame is not None:
+        out.append((frame.f_code, frame.f_lineno))
+        frame = frame.f_back
+    return tuple(reversed(out))
+
+
+def _fmt(entry) -> str:
+    code, lineno = entry
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{lineno})"
+
+
+class Profiler:
+    def __init__(self):
+        self.interval = PROFILE_INTERVAL_MS / 1000
+        self.slow = PROFILE_SLOW_MS / 1000
+        self.block = LOOP_BLOCK_MS / 1000
+        self._samples: deque = deque(maxlen=int(_WINDOW_SECONDS / self.interval))
+        self._loop_thread_id: int | None = None
+        self._beat = time.monotonic()
+        self._blocked_since: float | None = None
+        self._stop = threading.Event()
+        self._thread: threading.Thread | None = None
+        self._heartbeat_task: asyncio.Task | None = None
+        self._cprofile_busy = False
+
+    def start(self):
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        self._loop_thread_id = threading.get_ident()
+        self._heartbeat_task = asyncio.create_task(self._heartbeat())
+        self._thread = threading.Thread(target=self._run, name="profiler", daemon=True)
+        self._thread.start()
+        log.info("profiler on: slow=%sms sample_rate=%s loop_block=%sms dir=%s",
+                 PROFILE_SLOW_MS, PROFILE_SAMPLE_RATE, LOOP_BLOCK_MS, PROFILE_DIR)
+
+    def stop(self):
+        self._stop.set()
+        if self._heartbeat_task is not None:
+            self._heartbeat_task.cancel()
+
+    async def _heartbeat(self):
+        while True:
+            self._beat = time.monotonic()
+            await asyncio.sleep(self.block / 2)
+
+    # ---------- поток-сэмплер ----------
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self._loop_thread_id)
+            if frame is None:
+                continue
+            now = time.monotonic()
+            stack = _stack(frame)
+            self._samples.append((now, stack))
+            self._check_blocked(now, stack)
+
+    def _check_blocked(self, now: float, stack: tuple):
+        lag = now - self._beat
+        if lag < self.block:
+            self._blocked_since = None
+            return
+        if self._blocked_since == self._beat:
+            return  # об этой блокировке уже сообщили
+        self._blocked_since = self._beat
+        metrics.inc("bot_loop_blocked_total")
+        log.warning(
+            "event loop blocked for %.0fms+, stack:\n  %s",
+            lag * 1000, "\n  ".join(_fmt(e) for e in stack[-15:]),
+        )
+
+    # ---------- дампы ----------
+
+    def _collapsed(self, started: float, ended: float) -> Counter:
+        stacks: Counter = Counter()
+        for ts, stack in list(self._samples):
+            if started <= ts <= ended:
+                stacks[";".join(_fmt(e) for e in stack)] += 1
+        return stacks
+
+    def _write(self, name: str, header: dict, body: str):
+        path = os.path.join(PROFILE_DIR, name)
+        with open(path, "w", encoding="utf-8") as f:
+            for k, v in header.items():
+                f.write(f"# {k}={v}\n")
+            f.write(body)
+        self._rotate()
+
+    def _rotate(self):
+        files = sorted(
+            (os.path.join(PROFILE_DIR, n) for n in os.listdir(PROFILE_DIR)),
+            key=os.path.getmtime,
+        )
+        for path in files[:-PROFILE_KEEP]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def _stamp(self) -> str:
+        return datetime.utcnow().strftime("%Y%m%dT%H%M%S.%f")
+
+    def slow_path(self, kind: str, label: str, started: float, ended: float, **meta):
+        elapsed = ended - started
+        metrics.inc("bot_slow_paths_total", kind=kind)
+        stacks = self._collapsed(started, ended)
+        body = "".join(f"{stack} {n}\n" for stack, n in stacks.most_common())
+        header = {"kind": kind, "label": label, "elapsed_ms": round(elapsed * 1000, 1), "samples": sum(stacks.values()), **meta}
+        name = f"{self._stamp()}-{kind}-{label}.stacks.txt".replace("/", "_").replace(":", "_")
+        log.warning("slow %s %s: %.0fms %s", kind, label, elapsed * 1000, meta)
+        # файл пишем не в потоке loop
+        asyncio.get_running_loop().run_in_executor(None, self._write, name, header, body)
+
+    # ---------- точки входа ----------
+
+    async def middleware(self, handler, event, data):
+        name = data["handler"].callback.__name__
+        user = data.get("event_from_user")
+        meta = {"user_id": user.id if user else None, "state": data.get("raw_state")}
+
+        profile = None
+        if not self._cprofile_busy and random.random() < PROFILE_SAMPLE_RATE:
+            self._cprofile_busy = True
+            profile = cProfile.Profile()
+            profile.enable()
+
+        started = time.monotonic()
+        try:
+            return await handler(event, data)
+        finally:
+            ended = time.monotonic()
+            if profile is not None:
+                profile.disable()
+                self._cprofile_busy = False
+                path = os.path.join(PROFILE_DIR, f"{self._stamp()}-sampled-{name}-{meta['user_id']}.prof")
+                asyncio.get_running_loop().run_in_executor(None, self._dump_profile, profile, path)
+            if ended - started >= self.slow:
+                self.slow_path("handler", name, started, ended, **meta)
+
+    def _dump_profile(self, profile: cProfile.Profile, path: str):
+        profile.dump_stats(path)
+        self._rotate()
+
+    def job_done(self, label: str, started: float, ended: float):
+        if ended - started >= self.slow:
+            self.slow_path("job", label, started, ended)
@@ -0,0 +1,168 @@
+"""
+Запись входящих апдейтов для воспроизведения нагрузки (bench/replay.py).
+
+Outer middleware на dp.update: каждый апдейт — одна JSON-строка
+
+    {"at": 1760641200.123, "state": "Form:answering", "fsm": {"flow": "default", "step": 1, ...}, "update": {...}}
+
+at — время прихода (unix), state и fsm — состояние пользователя до обработки
+(по ним replay восстанавливает сессии, начатые до начала записи). Строки копятся
+в памяти и дописываются в RECORD_FILE раз в RECORD_FLUSH_SECONDS из отдельного
+потока, так что хендлеры диска не ждут.
+
+С RECORD_ANONYMIZE=1 (по умолчанию) id пользователей и чатов заменяются ключевым
+хэшем, имена убираются, а свободный текст (ответы, запросы поиска, тексты
+сообщений бота в callback'ах) — словами той же длины: одно и то же слово
+в записи всегда становится одним и тем же, так что нагрузка на поиск и на
+размер строк сохраняется. Команды и тексты кнопок остаются как есть —
+по ним идёт маршрутизация.
+"""
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import re
+import time
+
+from aiogram.types import Update
+
+import metrics
+from config import RECORD_ANONYMIZE, RECORD_FLUSH_SECONDS, RECORD_SALT
+
+log = logging.getLogger(__name__)
+
+# сколько строк держать, если запись на диск не успевает (дальше — теряем и считаем)
+_MAX_BUFFER = 100_000
+
+# ключи FSM, нужные для продолжения набора (без запросов поиска и прочего личного)
+_FSM_KEYS = ("flow", "step", "session_date", "pending_date")
+
+_WORD = re.compile(r"\w+")
+_LETTERS = "абвгдежзийклмнопрстуфхцчшщыэюя"
+_PERSONAL = ("last_name", "username", "language_code", "title")
+
+
+class Recorder:
+    def __init__(self, path: str, anonymize: bool = RECORD_ANONYMIZE, keep_texts: set[str] = frozenset(),
+                 salt: str = RECORD_SALT, flush_seconds: float = RECORD_FLUSH_SECONDS):
+        self.path = path
+        self.anonymize = anonymize
+        self.keep_texts = keep_texts
+        self.salt = salt.encode() if salt else os.urandom(16)
+        self.flush_seconds = flush_seconds
+        self._buf: list[str] = []
+        self._file = None
+        self._lock = asyncio.Lock()
+        self._task: asyncio.Task | None = None
+
+    def start(self):
+        self._file = open(self.path, "a", encoding="utf-8")
+        self._task = asyncio.create_task(self._run())
+        log.info("recording updates to %s (anonymize=%s)", self.path, self.anonymize)
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+        await self.flush()
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.flush_seconds)
+            try:
+                await self.flush()
+            except Exception:
+                log.exception("recorder flush failed")
+
+    async def flush(self):
+        async with self._lock:
+            if not self._buf or self._file is None:
+                return
+            lines, self._buf = self._buf, []
+            await asyncio.to_thread(self._write, "".join(lines))
+
+    def _write(self, chunk: str):
+        self._file.write(chunk)
+        self._file.flush()
+
+    # ---------- анонимизация ----------
+
+    def _digest(self, value: str) -> bytes:
+        return hashlib.blake2b(value.encode(), key=self.salt, digest_size=16).digest()
+
+    def _id(self, value: int) -> int:
+        # положительный, в пределах id Telegram; одинаковый для одного пользователя
+        return int.from_bytes(self._digest(str(value))[:6], "big") or 1
+
+    def _word(self, m: re.Match) -> str:
+        w = m.group()
+        if w.isdigit():
+            return w
+        h = self._digest(w.lower())
+        return "".join(_LETTERS[h[i % len(h)] % len(_LETTERS)] for i in range(len(w)))
+
+    def _text(self, text: str) -> str:
+        return _WORD.sub(self._word, text)
+
+    def _command(self, text: str) -> str:
+        command, _, rest = text.partition(" ")
+        return f"{command} {self._text(rest)}" if rest else command
+
+    def _scrub(self, obj):
+        # id людей и чатов, имена, тексты вложенных сообщений (сообщения бота в callback'ах)
+        if isinstance(obj, dict):
+            out = {}
+            for k, v in obj.items():
+                if k in _PERSONAL:
+                    continue
+                if k == "first_name":
+                    out[k] = "u"  # обязательное поле User
+                    continue
+                if k == "id" and ("is_bot" in obj or "type" in obj) and isinstance(v, int):
+                    out[k] = self._id(v)
+                elif k in ("text", "caption") and isinstance(v, str):
+                    out[k] = self._text(v)
+                else:
+                    out[k] = self._scrub(v)
+            return out
+        if isinstance(obj, list):
+            return [self._scrub(v) for v in obj]
+        return obj
+
+    def _anonymize(self, raw: dict) -> dict:
+        message = raw.get("message")
+        text = message.get("text") if message else None
+        raw = self._scrub(raw)
+        if text is not None:
+            if text.startswith("/"):
+                raw["message"]["text"] = self._command(text)
+            elif text in self.keep_texts:
+                raw["message"]["text"] = text
+        return raw
+
+    # ---------- middleware ----------
+
+    async def _record(self, event: Update, data: dict) -> str:
+        raw = event.model_dump(mode="json", exclude_none=True, by_alias=True)
+        if self.anonymize:
+            raw = self._anonymize(raw)
+        line = {"at": round(time.time(), 3), "state": data.get("raw_state")}
+        state = data.get("state")
+        if line["state"] is not None and state is not None:
+            fsm = await state.get_data()
+            line["fsm"] = {k: fsm[k] for k in _FSM_KEYS if k in fsm}
+        line["update"] = raw
+        return json.dumps(line, ensure_ascii=False) + "\n"
+
+    async def __call__(self, handler, event: Update, data):
+        if len(self._buf) < _MAX_BUFFER:
+            try:
+                self._buf.append(await self._record(event, data))
+            except Exception:
+                log.exception("failed to record update %s", event.update_id)
+        else:
+            metrics.inc("bot_record_dropped_total")
+        return await handler(event, data)
@@ -0,0 +1,201 @@
+"""
+Массовая отправка сообщений с учётом лимитов Telegram.
+
+- общий token bucket на все рассылки (SEND_RATE сообщений в секунду);
+- ограниченный пул воркеров на одну рассылку;
+- TelegramRetryAfter -> ждём retry_after и притормаживаем весь bucket;
+- сетевые/серверные ошибки -> несколько повторов с backoff;
+- бот заблокирован / чат не найден -> постоянная ошибка, отдаём в on_permanent_failure.
+"""
+import asyncio
+import contextvars
+import logging
+import time
+from dataclasses import dataclass
+from typing import AsyncIterable, Awaitable, Callable, Iterable
+
+from aiogram import Bot
+from aiogram.exceptions import (
+    TelegramBadRequest,
+    TelegramForbiddenError,
+    TelegramNetworkError,
+    TelegramRetryAfter,
+    TelegramServerError,
+)
+from aiogram.types import Message
+
+import metrics
+from config import SEND_MAX_RETRIES, SEND_RATE, SEND_WORKERS
+
+log = logging.getLogger(__name__)
+
+# BadRequest с такими текстами повторять бессмысленно: пользователя больше нет
+_PERMANENT_BAD_REQUEST = ("chat not found", "user not found", "user is deactivated", "peer_id_invalid")
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float | None = None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self._tokens = self.capacity
+        self._ts = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                self._tokens = min(self.capacity, self._tokens + (now - self._ts) * self.rate)
+                self._ts = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+    def pause(self, seconds: float):
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+
+@dataclass
+class SendStats:
+    name: str
+    total: int = 0
+    sent: int = 0
+    failed: int = 0
+    permanent: int = 0
+    retries: int = 0
+    retry_after_wait: float = 0.0
+    elapsed: float = 0.0
+
+    @property
+    def rate(self) -> float:
+        return self.sent / self.elapsed if self.elapsed else 0.0
+
+
+# статистика текущей рассылки (у каждого воркера своя копия контекста)
+_current_stats: contextvars.ContextVar[SendStats | None] = contextvars.ContextVar("send_stats", default=None)
+
+
+class Sender:
+    def __init__(
+        self,
+        bot: Bot,
+        rate: float = SEND_RATE,
+        workers: int = SEND_WORKERS,
+        max_retries: int = SEND_MAX_RETRIES,
+        on_permanent_failure: Callable[[int], Awaitable[None]] | None = None,
+    ):
+        self.bot = bot
+        self.bucket = TokenBucket(rate)
+        self.workers = workers
+        self.max_retries = max_retries
+        self.on_permanent_failure = on_permanent_failure
+
+    async def send_message(self, chat_id: int, text: str, **kwargs) -> Message | None:
+        """Отправляет с учётом лимитов. None — сообщение так и не ушло (ошибка уже обработана)."""
+        stats = _current_stats.get()
+        attempt = 0
+        while True:
+            await self.bucket.acquire()
+            try:
+                msg = await self.bot.send_message(chat_id, text, **kwargs)
+            except TelegramRetryAfter as e:
+                # флуд-контроль касается всех, поэтому тормозим весь bucket
+                self.bucket.pause(e.retry_after)
+                metrics.inc("bot_send_retry_after_total")
+                metrics.inc("bot_send_retry_after_seconds_total", e.retry_after)
+                if stats:
+                    stats.retries += 1
+                    stats.retry_after_wait += e.retry_after
+                await asyncio.sleep(e.retry_after)
+                continue
+            except TelegramForbiddenError:
+                await self._permanent(chat_id, stats)
+                return None
+            except TelegramBadRequest as e:
+                if any(s in e.message.lower() for s in _PERMANENT_BAD_REQUEST):
+                    await self._permanent(chat_id, stats)
+                else:
+                    log.warning("send to %s rejected: %s", chat_id, e.message)
+                    metrics.inc("bot_sends_total", result="failed")
+                    if stats:
+                        stats.failed += 1
+                return None
+            except (TelegramNetworkError, TelegramServerError) as e:
+                attempt += 1
+                if attempt > self.max_retries:
+                    log.warning("send to %s failed after %s retries: %r", chat_id, self.max_retries, e)
+                    metrics.inc("bot_sends_total", result="failed")
+                    if stats:
+                        stats.failed += 1
+                    return None
+                metrics.inc("bot_send_retries_total")
+                if stats:
+                    stats.retries += 1
+                await asyncio.sleep(min(2 ** attempt, 30))
+                continue
+            metrics.inc("bot_sends_total", result="sent")
+            if stats:
+                stats.sent += 1
+            return msg
+
+    async def _permanent(self, chat_id: int, stats: SendStats | None):
+        metrics.inc("bot_sends_total", result="permanent")
+        if stats:
+            stats.permanent += 1
+        if self.on_permanent_failure is not None:
+            try:
+                await self.on_permanent_failure(chat_id)
+            except Exception:
+                log.exception("on_permanent_failure(%s) failed", chat_id)
+
+    async def run(self, user_ids: Iterable[int] | AsyncIterable[int], fn: Callable[[int], Awaitable[None]],
+                  name: str) -> SendStats:
+        """
+        Прогоняет fn(user_id) для всех пользователей пулом из self.workers воркеров.
+        user_ids может быть и асинхронным итератором (например, пачки из БД).
+        Внутри fn отправлять через self.send_message — тогда отправки попадут в статистику.
+        """
+        stats = SendStats(name=name)
+        queue: asyncio.Queue[int] = asyncio.Queue(maxsize=self.workers * 2)
+
+        async def worker():
+            _current_stats.set(stats)
+            while True:
+                user_id = await queue.get()
+                try:
+                    await fn(user_id)
+                except Exception:
+                    stats.failed += 1
+                    log.exception("%s: user %s failed", name, user_id)
+                finally:
+                    queue.task_done()
+
+        started = time.monotonic()
+        tasks = [asyncio.create_task(worker()) for _ in range(self.workers)]
+        try:
+            if isinstance(user_ids, AsyncIterable):
+                async for user_id in user_ids:
+                    stats.total += 1
+                    await queue.put(user_id)
+            else:
+                for user_id in user_ids:
+                    stats.total += 1
+                    await queue.put(user_id)
+            await queue.join()
+        finally:
+            for t in tasks:
+                t.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+        stats.elapsed = time.monotonic() - started
+
+        log.info(
+            "%s: total=%s sent=%s failed=%s permanent=%s retries=%s retry_after=%.1fs elapsed=%.1fs rate=%.1f/s",
+            name, stats.total, stats.sent, stats.failed, stats.permanent,
+            stats.retries, stats.retry_after_wait, stats.elapsed, stats.rate,
+        )
+        return stats
@@ -3,6 +3,8 @@ from aiogram.fsm.state import StatesGroup, State
 class Form(StatesGroup):
     wait_region = State()
     wait_time = State()
+    # шаг любого набора вопросов (flows.py); q1..q4 — состояния старых сессий
+    answering = State()
     q1 = State()
     q2 = State()
     q3 = State()
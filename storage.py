@@ -0,0 +1,129 @@
+"""
+FSM-хранилище aiogram поверх нашей SQLite.
+
+Горячий слой — LRU активных сессий в памяти: хендлеры читают и пишут состояние
+без похода в БД. Изменённые сессии раз в FSM_FLUSH_SECONDS уходят в таблицу
+fsm_sessions одной транзакцией, при остановке — тоже. Сессии, которых давно
+не трогали, выгружаются из памяти (в БД они остаются), так что после
+рестарта/деплоя недоотвеченный набор продолжается с того же вопроса.
+"""
+import json
+import time
+from collections import Counter, OrderedDict
+from dataclasses import dataclass, field
+from typing import Any, Mapping
+
+from aiogram.exceptions import DataNotDictLikeError
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, DefaultKeyBuilder, StateType, StorageKey
+
+import adb
+import db
+from config import FSM_CACHE_SIZE, FSM_IDLE_SECONDS
+
+
+@dataclass
+class _Session:
+    state: str | None = None
+    data: dict[str, Any] = field(default_factory=dict)
+    touched: float = field(default_factory=time.monotonic)
+
+
+class SQLiteStorage(BaseStorage):
+    def __init__(self, cache_size: int = FSM_CACHE_SIZE, idle_seconds: int = FSM_IDLE_SECONDS):
+        self.cache_size = cache_size
+        self.idle_seconds = idle_seconds
+        self.key_builder = DefaultKeyBuilder(with_bot_id=True, with_destiny=True)
+        self._hot: OrderedDict[str, _Session] = OrderedDict()
+        self._dirty: set[str] = set()
+
+    async def _session(self, key: StorageKey) -> tuple[str, _Session]:
+        k = self.key_builder.build(key)
+        s = self._hot.get(k)
+        if s is None:
+            row = await adb.fsm_load(k)
+            # пока ждали БД, сессию мог создать/загрузить соседний апдейт — его версия свежее
+            s = self._hot.get(k)
+            if s is None:
+                s = _Session()
+                if row is not None:
+                    s.state = row["state"]
+                    s.data = json.loads(row["data"])
+                self._hot[k] = s
+        self._hot.move_to_end(k)
+        s.touched = time.monotonic()
+        return k, s
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        k, s = await self._session(key)
+        s.state = state.state if isinstance(state, State) else state
+        self._dirty.add(k)
+
+    async def get_state(self, key: StorageKey) -> str | None:
+        _, s = await self._session(key)
+        return s.state
+
+    async def set_data(self, key: StorageKey, data: Mapping[str, Any]) -> None:
+        if not isinstance(data, dict):
+            msg = f"Data must be a dict or dict-like object, got {type(data).__name__}"
+            raise DataNotDictLikeError(msg)
+        k, s = await self._session(key)
+        s.data = data.copy()
+        self._dirty.add(k)
+
+    async def get_data(self, key: StorageKey) -> dict[str, Any]:
+        _, s = await self._session(key)
+        return s.data.copy()
+
+    async def flush(self) -> int:
+        """Сбрасывает изменённые сессии в БД одной транзакцией."""
+        if not self._dirty:
+            return 0
+        dirty, self._dirty = self._dirty, set()
+        now = db.now_utc_iso()
+        upserts, deletes = [], []
+        for k in dirty:
+            s = self._hot.get(k)
+            if s is None:
+                continue
+            if s.state is None and not s.data:
+                deletes.append((k,))
+            else:
+                upserts.append((k, s.state, json.dumps(s.data, ensure_ascii=False), now))
+        try:
+            await adb.fsm_save_many(upserts, deletes)
+        except Exception:
+            self._dirty |= dirty
+            raise
+        return len(upserts) + len(deletes)
+
+    def evict(self) -> int:
+        """Выгружает из памяти давно не тронутые сессии и лишнее сверх cache_size (только уже сохранённые)."""
+        deadline = time.monotonic() - self.idle_seconds
+        evicted = 0
+        for k in list(self._hot):
+            if k in self._dirty:
+                continue
+            s = self._hot[k]
+            if s.touched > deadline and len(self._hot) <= self.cache_size:
+                # дальше по LRU только более свежие
+                break
+            del self._hot[k]
+            evicted += 1
+        return evicted
+
+    async def maintain(self):
+        await self.flush()
+        self.evict()
+
+    async def reset(self):
+        """Сохраняет изменённое и забывает все сессии: дальше каждая заново читается из БД."""
+        await self.flush()
+        self._hot.clear()
+
+    def state_counts(self) -> Counter:
+        # сколько активных (горячих) сессий в каждом состоянии
+        return Counter(s.state for s in self._hot.values() if s.state is not None)
+
+    async def close(self) -> None:
+        await self.flush()
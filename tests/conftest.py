@@ -0,0 +1,13 @@
+"""
+Общие настройки тестов. db.py мигрирует базу при импорте, поэтому DB_PATH
+выставляется до первого импорта — тесты не трогают users.db из репозитория.
+"""
+import os
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+os.environ["DB_PATH"] = os.path.join(tempfile.mkdtemp(prefix="goodlife-tests-"), "test.db")
+os.environ.setdefault("BOT_TOKEN", "123456:TEST-TOKEN")
@@ -0,0 +1,176 @@
+import os
+import shutil
+import sqlite3
+import subprocess
+import sys
+
+import db
+from conftest import ROOT
+
+
+# ---------- миграции ----------
+
+def _columns(conn: sqlite3.Connection, table: str) -> set[str]:
+    return {r[1] for r in conn.execute(f"PRAGMA table_info({table})")}
+
+
+def _tables(conn: sqlite3.Connection) -> set[str]:
+    return {r[0] for r in conn.execute("SELECT name FROM sqlite_master WHERE type IN ('table', 'view')")}
+
+
+def _migrate(path: str):
+    env = dict(os.environ, DB_PATH=path)
+    subprocess.run([sys.executable, "-c", "import db"], cwd=ROOT, env=env, check=True)
+
+
+def test_migrations_upgrade_existing_db(tmp_path):
+    path = str(tmp_path / "users.db")
+    shutil.copy(os.path.join(ROOT, "users.db"), path)
+    conn = sqlite3.connect(path)
+    assert conn.execute("PRAGMA user_version").fetchone()[0] == 0
+    users_before = conn.execute("SELECT user_id, notify_time, is_active FROM users ORDER BY user_id").fetchall()
+    conn.execute("INSERT OR IGNORE INTO users (user_id, notify_time, is_active) VALUES (42, '09:00', 1)")
+    conn.executemany(
+        "INSERT INTO answers (user_id, session_date, q_index, question, answer, created_at) VALUES (?, ?, ?, ?, ?, ?)",
+        [
+            (42, "2024-01-10", 1, "Что хорошего сегодня?", "солнце", "2024-01-10T18:00:00"),
+            (42, "2024-01-10", 2, "За что благодарен?", "друзьям", "2024-01-10T18:01:00"),
+        ]
+    )
+    conn.commit()
+    conn.close()
+
+    _migrate(path)
+
+    conn = sqlite3.connect(path)
+    assert conn.execute("PRAGMA user_version").fetchone()[0] == len(db.MIGRATIONS)
+    assert {
+        "question_sets", "questions", "answers_archive", "meta", "user_stats", "answers_fts",
+        "leases", "deliveries", "broadcasts", "broadcast_results",
+    } <= _tables(conn)
+    assert {"timezone_group", "flow_id"} <= _columns(conn, "users")
+    assert "question_id" in _columns(conn, "answers")
+    rows = conn.execute(
+        "SELECT session_date, q_index, answer FROM answers WHERE user_id=42 ORDER BY q_index"
+    ).fetchall()
+    assert rows == [("2024-01-10", 1, "солнце"), ("2024-01-10", 2, "друзьям")]
+    users_after = conn.execute(
+        "SELECT user_id, notify_time, is_active FROM users WHERE user_id != 42 ORDER BY user_id"
+    ).fetchall()
+    assert users_after == [u for u in users_before if u[0] != 42]
+    schema = conn.execute("SELECT sql FROM sqlite_master ORDER BY name").fetchall()
+    conn.close()
+
+    # повторный запуск — ничего не делает
+    _migrate(path)
+    conn = sqlite3.connect(path)
+    assert conn.execute("PRAGMA user_version").fetchone()[0] == len(db.MIGRATIONS)
+    assert conn.execute("SELECT sql FROM sqlite_master ORDER BY name").fetchall() == schema
+    assert conn.execute("SELECT COUNT(*) FROM answers WHERE user_id=42").fetchone()[0] == 2
+    conn.close()
+
+
+# ---------- серии ----------
+
+def _streak(user_id: int) -> tuple[int, int, int, int]:
+    s = db.get_user_stats(user_id)
+    return s["current_streak"], s["longest_streak"], s["completed_days"], s["skipped_days"]
+
+
+def test_streak_across_gaps_and_skips():
+    uid = 1001
+    db.record_day(uid, "2024-03-01", True)
+    db.record_day(uid, "2024-03-02", True)
+    assert _streak(uid) == (2, 2, 2, 0)
+
+    # пропуск на следующий день серию не рвёт и не удлиняет
+    db.record_day(uid, "2024-03-03", False)
+    assert _streak(uid) == (2, 2, 2, 1)
+    db.record_day(uid, "2024-03-04", True)
+    assert _streak(uid) == (3, 3, 3, 1)
+
+    # повтор того же события — без изменений
+    db.record_day(uid, "2024-03-04", True)
+    db.record_day(uid, "2024-03-03", False)
+    assert _streak(uid) == (3, 3, 3, 1)
+
+    # день без ответа и без пропуска — серия начинается заново
+    db.record_day(uid, "2024-03-06", True)
+    assert _streak(uid) == (1, 3, 4, 1)
+
+    # пропуск после разрыва обнуляет серию
+    db.record_day(uid, "2024-03-09", False)
+    assert _streak(uid) == (0, 3, 4, 2)
+    db.record_day(uid, "2024-03-10", True)
+    assert _streak(uid) == (1, 3, 5, 2)
+
+
+def test_late_completion_counts_without_touching_streak():
+    uid = 1002
+    db.record_day(uid, "2024-03-10", True)
+    db.record_day(uid, "2024-03-11", True)
+    db.record_day(uid, "2024-03-05", True)
+    assert _streak(uid) == (2, 2, 3, 0)
+    assert db.get_user_stats(uid)["last_completed_date"] == "2024-03-11"
+
+
+# ---------- история ----------
+
+def _save_days(user_id: int, days: list[str], per_day: int = 2):
+    db.save_answers_many([
+        (user_id, day, q, f"Вопрос {q}", f"{day} #{q}", f"{day}T20:0{q}:00", db.DEFAULT_QUESTION_SET, False)
+        for day in days
+        for q in range(1, per_day + 1)
+    ])
+
+
+def _read_all(user_id: int, limit: int, desc: bool) -> list[dict]:
+    rows, after = [], None
+    while True:
+        page = db.get_answers_page(user_id, after, limit, desc=desc)
+        if not page:
+            return rows
+        assert len(page) <= limit
+        rows += page
+        last = page[-1]
+        after = (last["session_date"], last["q_index"], last["id"])
+
+
+def test_answers_page_across_archive_boundary():
+    uid = 1003
+    _save_days(uid, ["2024-01-30", "2024-01-31", "2024-02-01", "2024-02-02"])
+    # повторный ответ на тот же шаг: порядок внутри шага — по id
+    _save_days(uid, ["2024-01-31"], per_day=1)
+    _save_days(uid, ["2024-03-01"])
+    expected = [
+        tuple(r) for r in db._conn().execute(
+            "SELECT session_date, q_index, id FROM answers WHERE user_id=? ORDER BY session_date, q_index, id", (uid,)
+        )
+    ]
+    assert len(expected) == 11
+    assert db.archive_user_month(uid, "2024-01") == 5
+    assert db._conn().execute("SELECT COUNT(*) FROM answers WHERE user_id=?", (uid,)).fetchone()[0] == 6
+
+    for limit in (1, 2, 3, 4):
+        asc = [(r["session_date"], r["q_index"], r["id"]) for r in _read_all(uid, limit, desc=False)]
+        desc = [(r["session_date"], r["q_index"], r["id"]) for r in _read_all(uid, limit, desc=True)]
+        assert asc == expected
+        assert desc == expected[::-1]
+
+    first = db.get_answers_page(uid, None, 1)[0]
+    assert first["question"] == "Вопрос 1" and first["answer"] == "2024-01-30 #1"
+
+
+# ---------- доставки ----------
+
+def test_claim_deliveries_is_idempotent():
+    day, kind = "2024-04-01", "daily"
+    assert db.claim_deliveries([2001, 2002, 2003], day, kind) == [2001, 2002, 2003]
+    assert db.claim_deliveries([2002, 2003, 2004], day, kind) == [2004]
+    assert db.claim_deliveries([2001, 2002], day, kind) == []
+    # другой день и другой вид рассылки — отдельные отметки
+    assert db.claim_deliveries([2001], "2024-04-02", kind) == [2001]
+    assert db.claim_deliveries([2001], day, "nudge") == [2001]
+
+    db.release_deliveries([2003], day, kind)
+    assert db.claim_deliveries([2001, 2002, 2003, 2004], day, kind) == [2003]
@@ -0,0 +1,19 @@
+import flows
+from states import Form
+
+
+def test_legacy_states_continue_default_flow():
+    for step, state in enumerate((Form.q1, Form.q2, Form.q3, Form.q4)):
+        assert flows.position(state.state, {}) == (flows.DEFAULT, step)
+        # данные FSM старой сессии не влияют на шаг
+        assert flows.position(state.state, {"flow": "other", "step": 9}) == (flows.DEFAULT, step)
+
+
+def test_answering_state_uses_data():
+    last = len(flows.DEFAULT.questions) - 1
+    assert flows.position(Form.answering.state, {"flow": flows.DEFAULT.id, "step": 1}) == (flows.DEFAULT, 1)
+    assert flows.position(Form.answering.state, {}) == (flows.DEFAULT, 0)
+    # набор стал короче посреди сессии — остаёмся на последнем шаге
+    assert flows.position(Form.answering.state, {"flow": flows.DEFAULT.id, "step": 99}) == (flows.DEFAULT, last)
+    # набор убрали из файла — продолжаем default
+    assert flows.position(Form.answering.state, {"flow": "removed", "step": 2}) == (flows.DEFAULT, 2)
@@ -0,0 +1,211 @@
+"""
+Защита от флуда и перегрузки — outer middleware на dp.update.
+
+- У каждого пользователя токен-ведро: THROTTLE_BURST апдейтов подряд, дальше
+  THROTTLE_RATE в секунду. Лишние апдейты отбрасываются до хендлеров (и до БД);
+  о том, что сообщения не обработаны, пользователь узнаёт один раз за всплеск.
+  Ответы на вопросы набора (текст, не команда, в состоянии ответа) ведро не
+  отбрасывает, только тратит на них токены: набор конечен, а от двойных
+  нажатий защищает проверка повторов ниже.
+  Вёдра лежат в OrderedDict в порядке последнего апдейта, и те, что простаивают
+  дольше THROTTLE_IDLE_SECONDS, снимаются с головы на каждом апдейте: за это
+  время ведро всё равно наполнилось бы доверху, так что отсутствие ведра
+  и полное ведро — одно и то же.
+- Тот же текст на тот же шаг набора в течение DEDUP_SECONDS (двойная отправка,
+  пока первое сообщение ещё обрабатывается) второй раз не сохраняется — но
+  только если первое действительно сдвинуло набор: тогда следующий вопрос
+  пользователь уже получил. Если набор остался на месте (первое упало),
+  повтор обрабатывается как обычный ответ. Тот же текст на следующий вопрос
+  («-», «ничего») — это новый ответ, не повтор.
+- Режим перегрузки: если event loop отстаёт больше чем на OVERLOAD_LAG_MS или
+  к потоку-писателю стоит больше OVERLOAD_DB_QUEUE вызовов, выставляется
+  adb.overloaded: плановый сброс активности и фоновое обслуживание ждут,
+  а необязательные тяжёлые запросы (/history, /search, /export, /stats и их
+  кнопки) получают просьбу повторить позже. Ответы на вопросы не
+  отбрасываются никогда.
+"""
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+
+from aiogram.types import Update
+
+import adb
+import flows
+import metrics
+from config import (
+    DEDUP_SECONDS, OVERLOAD_DB_QUEUE, OVERLOAD_LAG_MS, THROTTLE_BURST, THROTTLE_IDLE_SECONDS, THROTTLE_RATE,
+)
+from states import Form
+
+log = logging.getLogger(__name__)
+
+# в этих состояниях текст — ответ на вопрос набора
+_ANSWER_STATES = {Form.answering.state, Form.q1.state, Form.q2.state, Form.q3.state, Form.q4.state}
+
+# что при перегрузке откладываем: чтение истории, поиск, выгрузка, статистика
+_SHED_COMMANDS = {"/history", "/search", "/export", "/stats"}
+_SHED_CALLBACKS = ("hist:", "srch:")
+
+# как часто мерить отставание loop и сколько держать режим перегрузки после последнего превышения
+_WATCH_SECONDS = 0.1
+_HOLD_SECONDS = 5
+
+
+class _Bucket:
+    __slots__ = ("tokens", "seen", "warned", "answer")
+
+    def __init__(self, tokens: float, seen: float):
+        self.tokens = tokens
+        self.seen = seen  # time.monotonic() последнего апдейта
+        self.warned = False
+        # (session_date, flow, шаг, hash текста), время, Event «обработан» — последний принятый ответ
+        self.answer: tuple | None = None
+
+
+class Throttle:
+    def __init__(self, rate: float = THROTTLE_RATE, burst: int = THROTTLE_BURST,
+                 idle_seconds: int = THROTTLE_IDLE_SECONDS, dedup_seconds: float = DEDUP_SECONDS,
+                 lag_ms: int = OVERLOAD_LAG_MS, db_queue: int = OVERLOAD_DB_QUEUE):
+        self.rate = rate
+        self.burst = burst
+        self.idle = idle_seconds
+        self.dedup = dedup_seconds
+        self.lag = lag_ms / 1000
+        self.db_queue = db_queue
+        self._buckets: OrderedDict[int, _Bucket] = OrderedDict()
+        self._calm_at = 0.0
+        self._task: asyncio.Task | None = None
+
+    def size(self) -> int:
+        return len(self._buckets)
+
+    def start(self):
+        self._task = asyncio.create_task(self._watch())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+        adb.overloaded = False
+
+    # ---------- токен-ведро ----------
+
+    def _bucket(self, user_id: int, now: float) -> _Bucket:
+        b = self._buckets.get(user_id)
+        if b is None:
+            b = self._buckets[user_id] = _Bucket(self.burst, now)
+        else:
+            b.tokens = min(self.burst, b.tokens + (now - b.seen) * self.rate)
+            b.seen = now
+            self._buckets.move_to_end(user_id)
+        # голова — самые давние; обычно снимается 0-1 ведро
+        idle_before = now - self.idle
+        while True:
+            oldest = next(iter(self._buckets.values()))
+            if oldest.seen >= idle_before:
+                break
+            self._buckets.popitem(last=False)
+        return b
+
+    # ---------- повторы ответов ----------
+
+    @staticmethod
+    async def _position(state, raw_state: str | None) -> tuple:
+        fsm = await state.get_data()
+        flow, step = flows.position(raw_state, fsm)
+        return fsm.get("session_date"), flow.id, step
+
+    async def _duplicate(self, b: _Bucket, text: str, data: dict, now: float) -> bool:
+        state = data["state"]
+        key = (*await self._position(state, data.get("raw_state")), hash(text))
+        last = b.answer
+        if last is None or last[0] != key or now - last[1] >= self.dedup:
+            b.answer = (key, now, asyncio.Event())
+            return False
+        # тот же текст на тот же шаг: ждём первый и отбрасываем повтор, только если
+        # первый сдвинул набор (и, значит, следующий вопрос уже отправлен)
+        await last[2].wait()
+        raw_state = await state.get_state()
+        if raw_state not in _ANSWER_STATES or await self._position(state, raw_state) != key[:3]:
+            return True
+        b.answer = (key, now, asyncio.Event())
+        return False
+
+    # ---------- перегрузка ----------
+
+    async def _watch(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            started = loop.time()
+            await asyncio.sleep(_WATCH_SECONDS)
+            now = loop.time()
+            lag = now - started - _WATCH_SECONDS
+            depth = adb.write_queue_depth()
+            if lag > self.lag or depth > self.db_queue:
+                self._calm_at = now + _HOLD_SECONDS
+                if not adb.overloaded:
+                    adb.overloaded = True
+                    metrics.inc("bot_overload_total")
+                    log.warning("overload on: loop lag %.0fms, db write queue %s", lag * 1000, depth)
+            elif adb.overloaded and now >= self._calm_at:
+                adb.overloaded = False
+                log.warning("overload off: db write queue %s", depth)
+
+    @staticmethod
+    def _optional(event: Update) -> bool:
+        if event.message is not None:
+            text = event.message.text or ""
+            return text.startswith("/") and text.split(maxsplit=1)[0].split("@")[0] in _SHED_COMMANDS
+        if event.callback_query is not None:
+            return (event.callback_query.data or "").startswith(_SHED_CALLBACKS)
+        return False
+
+    # ---------- middleware ----------
+
+    @staticmethod
+    async def _notify(event: Update, text: str):
+        try:
+            if event.callback_query is not None:
+                await event.callback_query.answer(text)
+            elif event.message is not None:
+                await event.message.answer(text)
+        except Exception:
+            log.debug("throttle notice failed", exc_info=True)
+
+    async def __call__(self, handler, event: Update, data):
+        user = data.get("event_from_user")
+        if user is None:
+            return await handler(event, data)
+        now = time.monotonic()
+        b = self._bucket(user.id, now)
+        message = event.message
+        answer = (
+            message is not None and bool(message.text) and not message.text.startswith("/")
+            and data.get("raw_state") in _ANSWER_STATES
+        )
+
+        if b.tokens < 1 and not answer:
+            metrics.inc("bot_updates_throttled_total", reason="rate")
+            if not b.warned:
+                b.warned = True
+                await self._notify(event, "Слишком много сообщений подряд — подождите немного 🙏")
+            return None
+        b.tokens = max(0.0, b.tokens - 1)
+        b.warned = False
+
+        if adb.overloaded and self._optional(event):
+            metrics.inc("bot_updates_shed_total", type=event.event_type)
+            await self._notify(event, "Сейчас большая нагрузка — повторите, пожалуйста, через минуту 🙏")
+            return None
+
+        if not (self.dedup and answer):
+            return await handler(event, data)
+        if await self._duplicate(b, message.text, data, now):
+            metrics.inc("bot_updates_throttled_total", reason="duplicate")
+            return None
+        done = b.answer[2]
+        try:
+            return await handler(event, data)
+        finally:
+            done.set()
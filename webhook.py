@@ -0,0 +1,160 @@
+"""
+Приём апдейтов через webhook (aiohttp).
+
+Telegram получает ответ сразу, а апдейт попадает в ограниченный конвейер:
+WEBHOOK_WORKERS партиций-очередей, у каждой свой воркер. Партиция выбирается
+по пользователю (или чату), поэтому апдейты одного пользователя обрабатываются
+строго по порядку, а разных — параллельно. Очереди ограничены: при переполнении
+запрос ждёт места (backpressure), и Telegram сам притормаживает доставку.
+
+Реплик может быть несколько, но апдейты принимает только активная — держатель
+аренды (lease.py): FSM-сессии и строки users кэшируются в памяти процесса, и
+две реплики, принимающие апдейты одного пользователя, затирали бы друг другу
+состояние. Резервные отвечают на POST 503 (Telegram повторит доставку позже),
+а GET на тот же путь — 200 только у активной: по нему балансировщик
+направляет трафик.
+
+SIGTERM/SIGINT (docker stop, systemctl stop) останавливают приём штатно:
+принятые апдейты дорабатываются, а main() успевает сбросить буферы и
+отпустить аренду.
+"""
+import asyncio
+import logging
+import signal
+from typing import Any, Awaitable, Callable
+
+from aiogram import Bot, Dispatcher
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+from aiohttp import web
+
+from config import (
+    WEBHOOK_HOST, WEBHOOK_PATH, WEBHOOK_PORT, WEBHOOK_QUEUE_SIZE, WEBHOOK_SECRET, WEBHOOK_URL, WEBHOOK_WORKERS,
+)
+
+log = logging.getLogger(__name__)
+
+
+def routing_key(update: dict[str, Any]) -> int:
+    # первый объект события в апдейте: message, callback_query, ...
+    for value in update.values():
+        if not isinstance(value, dict):
+            continue
+        for field in ("from", "user", "chat"):
+            obj = value.get(field)
+            if isinstance(obj, dict) and "id" in obj:
+                return obj["id"]
+        msg = value.get("message")
+        if isinstance(msg, dict) and isinstance(msg.get("chat"), dict):
+            return msg["chat"]["id"]
+    return update.get("update_id", 0)
+
+
+class UpdatePipeline:
+    def __init__(
+        self,
+        process: Callable[[dict[str, Any]], Awaitable[None]],
+        workers: int = WEBHOOK_WORKERS,
+        queue_size: int = WEBHOOK_QUEUE_SIZE,
+    ):
+        self.process = process
+        per_queue = max(1, queue_size // workers)
+        self._queues: list[asyncio.Queue] = [asyncio.Queue(maxsize=per_queue) for _ in range(workers)]
+        self._tasks: list[asyncio.Task] = []
+
+    def start(self):
+        self._tasks = [asyncio.create_task(self._worker(q)) for q in self._queues]
+
+    async def put(self, update: dict[str, Any]):
+        await self._queues[routing_key(update) % len(self._queues)].put(update)
+
+    def depth(self) -> int:
+        return sum(q.qsize() for q in self._queues)
+
+    async def _worker(self, queue: asyncio.Queue):
+        while True:
+            update = await queue.get()
+            try:
+                await self.process(update)
+            except Exception:
+                log.exception("update %s failed", update.get("update_id"))
+            finally:
+                queue.task_done()
+
+    async def stop(self):
+        # дорабатываем то, что уже принято, и гасим воркеры
+        for q in self._queues:
+            await q.join()
+        for t in self._tasks:
+            t.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+
+class QueuedRequestHandler(SimpleRequestHandler):
+    """SimpleRequestHandler aiogram, но фоновая обработка идёт через UpdatePipeline, а не create_task на апдейт."""
+
+    def __init__(self, dispatcher: Dispatcher, bot: Bot, active: Callable[[], bool] = lambda: True, **kwargs: Any):
+        super().__init__(dispatcher=dispatcher, bot=bot, handle_in_background=True, **kwargs)
+        self.active = active
+        self.pipeline = UpdatePipeline(lambda update: self._background_feed_update(self.bot, update))
+
+    def register(self, app: web.Application, /, path: str, **kwargs: Any) -> None:
+        super().register(app, path=path, **kwargs)
+        app.router.add_route("GET", path, self.health)
+
+    async def health(self, request: web.Request) -> web.Response:
+        return web.Response(text="active" if self.active() else "standby", status=200 if self.active() else 503)
+
+    async def _handle_request_background(self, bot: Bot, request: web.Request) -> web.Response:
+        if not self.active():
+            return web.Response(text="standby", status=503)
+        await self.pipeline.put(await request.json(loads=bot.session.json_loads))
+        return web.json_response({}, dumps=bot.session.json_dumps)
+
+
+async def run_webhook(dp: Dispatcher, bot: Bot, active: Callable[[], bool] = lambda: True):
+    """active — принимает ли эта реплика апдейты сейчас."""
+    if WEBHOOK_URL and not WEBHOOK_SECRET:
+        # сгенерировать свой нельзя: у каждой реплики он был бы другим,
+        # и setWebhook последней запущенной отрезал бы остальные
+        raise RuntimeError("WEBHOOK_URL задан без WEBHOOK_SECRET — задайте общий секрет для всех реплик")
+    handler = QueuedRequestHandler(dp, bot, active=active, secret_token=WEBHOOK_SECRET or None)
+    app = web.Application()
+    handler.register(app, path=WEBHOOK_PATH)
+    setup_application(app, dp, bot=bot)
+
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT)
+    handler.pipeline.start()
+    await site.start()
+    log.info("webhook listening on %s:%s%s", WEBHOOK_HOST, WEBHOOK_PORT, WEBHOOK_PATH)
+
+    # без WEBHOOK_URL считаем, что webhook уже настроен снаружи (или это локальный стенд)
+    if WEBHOOK_URL:
+        await bot.set_webhook(
+            WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+            secret_token=WEBHOOK_SECRET or None,
+            allowed_updates=dp.resolve_used_update_types(),
+        )
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    signals = (signal.SIGTERM, signal.SIGINT)
+    for sig in signals:
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except NotImplementedError:  # Windows: остаётся Ctrl+C через KeyboardInterrupt
+            pass
+
+    try:
+        await stop.wait()
+        log.info("webhook stopping")
+    finally:
+        for sig in signals:
+            try:
+                loop.remove_signal_handler(sig)
+            except NotImplementedError:
+                pass
+        await site.stop()
+        await handler.pipeline.stop()
+        await runner.cleanup()